@@ -0,0 +1,43 @@
+import os, unittest
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # The VM only runs, it isn't shown
+os.chdir(os.path.dirname(os.path.abspath(__file__))) # The VM loads its GUI from here
+
+from PyQt6.QtWidgets import QApplication
+from xsharp_shell import xs_compile
+from xasm_assembler import assemble
+from xenon_vm import VirtualMachine
+
+# Runs example programs at every optimization level, which have to leave the same result behind.
+
+app = QApplication([])
+
+def run(fn: str, opt_level: int, use_ir: bool = False) -> tuple[int, list]:
+	with open(fn, "r") as f:
+		ftxt = f.read().strip()
+	result, error = xs_compile(fn, ftxt, use_ir=use_ir, opt_level=opt_level)
+	if error:
+		raise AssertionError(f"{error}")
+
+	vm = VirtualMachine()
+	vm.clock_speed.setValue(0)
+	if vm.run("\n".join(assemble("\n".join(result))), 1_000_000):
+		raise AssertionError(f"{fn} didn't halt")
+	return vm.d_reg_value, sorted(vm.screen)
+
+class OptimizationLevels(unittest.TestCase):
+	def check(self, fn: str, expected: int) -> None:
+		baseline = run(fn, 0)
+		self.assertEqual(baseline[0], expected)
+		for opt_level in (1, 2):
+			for use_ir in (False, True):
+				with self.subTest(opt_level=opt_level, use_ir=use_ir):
+					self.assertEqual(run(fn, opt_level, use_ir), baseline)
+
+	def test_constant_conditions(self):
+		self.check("xsharp examples/constant_conditions.xs", 11070)
+
+	def test_division(self):
+		self.check("xsharp examples/division.xs", 1307)
+
+if __name__ == "__main__":
+	unittest.main()
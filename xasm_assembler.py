@@ -26,136 +26,210 @@ def convert_to_bin(value: int, width: int = 14):
 	difference: int = 16384 + value
 	return f"{bin(difference)[2:].zfill(width)}"
 
-def assemble(ftxt: str):
-	try:
-		binary_result: list[str] = []
-		labels: dict[str, int] = {}
-		skips: int = 0
-
-		file_text: str = ftxt
-
-		for i in range(16): # Remove register labels r0 - r15
-			file_text = file_text.replace(f"LDIA r{i}", f"LDIA {i}")
-
-		# Preliminary scan
-		for line_num, line in enumerate(file_text.splitlines()):
-			ln = line
-			try: comment_index = ln.index("//")
-			except: pass
-			else: ln = ln[:comment_index] # Remove comments
-			ln = ln.strip()
-
-			if ln.startswith(".") and " " not in ln:
-				labels[ln] = line_num - skips
-				skips += 1
-
-		# Assemble
-		for line_num, line in enumerate(file_text.splitlines()):
-			line = line.strip()
-			# print(line)
-
-			try: comment_index = line.index("//")
-			except: pass
-			else: line = line[:comment_index] # Remove comments
-
-			if line.strip() == "":
-				binary_result.append("0" * 16) # NOOP
-				continue # Skip empty lines
-
-			ln = line.strip().split(" ")
-			inst = ln[0]
-
-			match inst:
-				case "NOOP": # No operation
-					if len(ln) != 1: raise SyntaxError(f"Line {line_num + 1}: Expected 0 arguments for instruction NOOP, found {len(ln) - 1} arguments instead.")
-					binary_result.append("0" * 16)
-				
-				case "HALT": # Halts the execution of the program
-					if len(ln) != 1: raise SyntaxError(f"Line {line_num + 1}: Expected 0 arguments for instruction HALT, found {len(ln) - 1} arguments instead.")
-					binary_result.append("0" * 13 + "100")
+REGISTERS = {f"r{i}": i for i in range(16)} # Register labels r0 - r15
+
+# A single line of XAssembly, kept around so it can be re-encoded on its own.
+class AssembledLine:
+	def __init__(self, text: str):
+		self.text = text
+		self.label: str | None = None # Label defined by this line
+		self.word: str | None = None # Encoded instruction (None for labels)
+		self.reference: str | None = None # Label the operand refers to
+		self.instruction: str = ""
+		self.error: Exception | None = None
+
+		try: self.parse(text)
+		except (SyntaxError, ValueError, NotImplementedError) as e:
+			self.error = e
+
+	def parse(self, text: str):
+		line = text.strip()
+
+		try: comment_index = line.index("//")
+		except: pass
+		else: line = line[:comment_index] # Remove comments
+		line = line.strip()
+
+		if line == "":
+			self.word = "0" * 16 # NOOP
+			return # Skip empty lines
+
+		ln = line.split(" ")
+		inst = ln[0]
+		self.instruction = inst
+
+		match inst:
+			case "NOOP": # No operation
+				if len(ln) != 1: raise SyntaxError(f"Line {{line}}: Expected 0 arguments for instruction NOOP, found {len(ln) - 1} arguments instead.")
+				self.word = "0" * 16
+			
+			case "HALT": # Halts the execution of the program
+				if len(ln) != 1: raise SyntaxError(f"Line {{line}}: Expected 0 arguments for instruction HALT, found {len(ln) - 1} arguments instead.")
+				self.word = "0" * 13 + "100"
+			
+			case "LDIA": # Load immediate value into A register
+				if len(ln) != 2: raise SyntaxError(f"Line {{line}}: Expected 1 argument for instruction LDIA, found {len(ln) - 1} arguments instead.")
+				self.resolve_operand(ln[1])
+			
+			case "COMP": # Compute ALU instruction
+				if len(ln) not in (2, 3, 4): raise SyntaxError(f"Line {{line}}: Expected 1 - 3 arguments for instruction COMP, found {len(ln) - 1} arguments instead.")
+
+				code = ALU_CODES.get(ln[1], None)
+				if code == None: raise ValueError(f"Code '{ln[1]}' is not in the available codes.")
+
+				jump: int = 0
+				dest: list[str] = ["0"] * 3
+				if len(ln) > 2:
+					if ln[2] in JUMPS.keys():
+						# Jump
+						jump = JUMPS.get(ln[2])
+					else:
+						for i, location in enumerate("DAM"):
+							if location in ln[2]:
+								dest[i] = "1"
 				
-				case "LDIA": # Load immediate value into A register
-					if len(ln) != 2: raise SyntaxError(f"Line {line_num + 1}: Expected 1 argument for instruction LDIA, found {len(ln) - 1} arguments instead.")
+				if len(ln) == 4:
+					if ln[3] in JUMPS.keys():
+						# Jump
+						jump = JUMPS.get(ln[3])
+					else:
+						raise ValueError(f"Unrecognized jump: {ln[3]}")
 
-					immediate = ln[1]
-					if immediate in labels: immediate = labels[immediate]
+				self.word = f"{bin(code)[2:].zfill(8)}{''.join(dest)}{bin(jump)[2:].zfill(3)}11"
 
-					try:
-						value = int(immediate)
-					except ValueError:
-						return ValueError(f"Label '{immediate}' unbound (line {line_num + 1}).")
+			case "PLOT": # Plot pixel to buffer
+				if len(ln) != 2: raise SyntaxError(f"Line {{line}}: Expected 1 argument for instruction PLOT, found {len(ln) - 1} arguments instead.")
 
-					binary_result.append(f"{convert_to_bin(value)}10")
-				
-				case "COMP": # Compute ALU instruction
-					if len(ln) not in (2, 3, 4): raise SyntaxError(f"Line {line_num + 1}: Expected 1 - 3 arguments for instruction COMP, found {len(ln) - 1} arguments instead.")
-
-					code = ALU_CODES.get(ln[1], None)
-					if code == None: raise ValueError(f"Code '{ln[1]}' is not in the available codes.")
-
-					jump: int = 0
-					dest: list[str] = ["0"] * 3
-					if len(ln) > 2:
-						if ln[2] in JUMPS.keys():
-							# Jump
-							jump = JUMPS.get(ln[2])
-						else:
-							for i, location in enumerate("DAM"):
-								if location in ln[2]:
-									dest[i] = "1"
-					
-					if len(ln) == 4:
-						if ln[3] in JUMPS.keys():
-							# Jump
-							jump = JUMPS.get(ln[3])
-						else:
-							raise ValueError(f"Unrecognized jump: {ln[3]}")
-
-					binary_result.append(f"{bin(code)[2:].zfill(8)}{''.join(dest)}{bin(jump)[2:].zfill(3)}11")
-
-				case "PLOT": # Plot pixel to buffer
-					if len(ln) != 2: raise SyntaxError(f"Line {line_num + 1}: Expected 1 argument for instruction PLOT, found {len(ln) - 1} arguments instead.")
-
-					binary_result.append(f"{'0' * 12}{ln[1]}101")
-
-				case "BUFR": # Buffer instructions
-					if len(ln) != 2: raise SyntaxError(f"Line {line_num + 1}: Expected 1 argument for instruction BUFR, found {len(ln) - 1} arguments instead.")
-
-					op_code: str = ""
-					match ln[1]:
-						case "move": op_code = "10"
-						case "update": op_code = "00"
-						case _: raise ValueError(f"Line {line_num + 1}: Expected 'move' or 'update', got '{ln[1]}' instead.")
-					
-					binary_result.append(f"{'0' * 11}{op_code}001")
-
-				case "CALL": # Call instruction
-					if len(ln) != 2: raise SyntaxError(f"Line {line_num + 1}: Expected 1 argument for instruction CALL, found {len(ln) - 1} arguments instead.")
-
-					address = ln[1]
-					if address in labels: address = labels[address]
-
-					try:
-						value = int(address)
-					except ValueError:
-						return ValueError(f"Label '{address}' unbound.")
-
-					binary_result.append(f"{convert_to_bin(value, 12)}1000")
-				
-				case "RETN": # Return instruction
-					if len(ln) != 1: raise SyntaxError(f"Line {line_num + 1}: Expected 0 arguments for instruction RETN, found {len(ln) - 1} arguments instead.")
+				self.word = f"{'0' * 12}{ln[1]}101"
+
+			case "BUFR": # Buffer instructions
+				if len(ln) != 2: raise SyntaxError(f"Line {{line}}: Expected 1 argument for instruction BUFR, found {len(ln) - 1} arguments instead.")
 
-					binary_result.append("0" * 12 + "1100")
+				op_code: str = ""
+				match ln[1]:
+					case "move": op_code = "10"
+					case "update": op_code = "00"
+					case _: raise ValueError(f"Line {{line}}: Expected 'move' or 'update', got '{ln[1]}' instead.")
+				
+				self.word = f"{'0' * 11}{op_code}001"
 
-				case _:
-					if not (line.startswith(".") and len(ln) == 1):
-						raise NotImplementedError(f"Unknown instruction: {inst}.")
+			case "CALL": # Call instruction
+				if len(ln) != 2: raise SyntaxError(f"Line {{line}}: Expected 1 argument for instruction CALL, found {len(ln) - 1} arguments instead.")
+				self.resolve_operand(ln[1])
 			
+			case "RETN": # Return instruction
+				if len(ln) != 1: raise SyntaxError(f"Line {{line}}: Expected 0 arguments for instruction RETN, found {len(ln) - 1} arguments instead.")
+
+				self.word = "0" * 12 + "1100"
+
+			case _:
+				if not (line.startswith(".") and len(ln) == 1):
+					raise NotImplementedError(f"Unknown instruction: {inst}.")
+				self.label = line
+
+	def resolve_operand(self, operand: str):
+		if self.instruction == "LDIA" and operand in REGISTERS:
+			operand = str(REGISTERS[operand])
+
+		try:
+			value = int(operand)
+		except ValueError:
+			self.reference = operand # Encoded once the label is bound
+		else:
+			self.encode(value)
+
+	def encode(self, value: int):
+		if self.instruction == "LDIA":
+			self.word = f"{convert_to_bin(value)}10"
+		else: # CALL
+			self.word = f"{convert_to_bin(value, 12)}1000"
+
+	def get_error(self, line_num: int):
+		if self.error is not None:
+			return type(self.error)(str(self.error).replace("{line}", f"{line_num + 1}"))
+		
+		if self.reference is not None and self.word is None:
+			if self.instruction == "LDIA":
+				return ValueError(f"Label '{self.reference}' unbound (line {line_num + 1}).")
+			return ValueError(f"Label '{self.reference}' unbound.")
+		
+		return None
+
+# Keeps the encoding of every line and the address of every label, so that
+# an edit only re-encodes the lines that changed and the words that refer
+# to labels whose addresses moved.
+class IncrementalAssembler:
+	def __init__(self, ftxt: str = ""):
+		self.lines: list[AssembledLine] = []
+		self.labels: dict[str, int] = {}
+		self.references: dict[str, set[AssembledLine]] = {}
+
+		self.update(0, 0, ftxt.split("\n"))
+
+	def update(self, start: int, removed: int, new_lines: list[str]):
+		"""Replaces `removed` lines starting at line `start` with `new_lines`."""
+		old_lines = self.lines[start:start + removed]
+		added = [AssembledLine(text) for text in new_lines]
+		self.lines[start:start + removed] = added
+
+		for line in old_lines:
+			if line.reference is not None:
+				self.references[line.reference].discard(line)
+		for line in added:
+			if line.reference is not None:
+				self.references.setdefault(line.reference, set()).add(line)
+		
+		# Labels only move when a label or a whole instruction is added or removed
+		moved: set[str] = set()
+		if (
+			any(line.label is not None for line in old_lines + added)
+			or len(old_lines) != len(added)
+		):
+			labels: dict[str, int] = {}
+			address: int = 0
+			for line in self.lines:
+				if line.label is not None:
+					labels[line.label] = address
+				else:
+					address += 1
+
+			moved = {
+				label for label in labels.keys() | self.labels.keys()
+				if labels.get(label) != self.labels.get(label)
+			}
+			self.labels = labels
+
+		# Patch the words referring to moved labels
+		for line in added:
+			if line.reference is not None and line.reference not in moved:
+				self.bind(line)
+		for label in moved:
+			for line in self.references.get(label, ()):
+				self.bind(line)
+
+	def bind(self, line: AssembledLine):
+		if line.reference in self.labels:
+			line.encode(self.labels[line.reference])
+		else:
+			line.word = None
+
+	def result(self):
+		lines = self.lines
+		if lines and lines[-1].text == "":
+			lines = lines[:-1] # A trailing newline does not start a new line
+
+		binary_result: list[str] = []
+		for line_num, line in enumerate(lines):
+			error = line.get_error(line_num)
+			if error is not None: return error
+
+			if line.word is not None:
+				binary_result.append(line.word)
+
 		return binary_result
 
-	except SyntaxError as e: return e
-	except ValueError as e: return e
-	except NotImplementedError as e: return e
+def assemble(ftxt: str):
+	return IncrementalAssembler(ftxt).result()
 
 class ASMSyntaxHighlighter(SyntaxHighlighter):
 	def __init__(self, document):
@@ -202,6 +276,10 @@ class XAsmAssembler(QMainWindow):
 		self.file_text.installEventFilter(self)
 		self.ftxt_highlighter = ASMSyntaxHighlighter(self.file_text.document())
 
+		# Re-assemble live as the document changes
+		self.assembler = IncrementalAssembler()
+		self.file_text.document().contentsChange.connect(self.reassemble)
+
 	def load_file(self):
 		self.fn, _ = QFileDialog.getOpenFileName(self, "Open File", "assembly", "XAsm Files (*.xasm)")
 		if self.fn:
@@ -224,11 +302,32 @@ class XAsmAssembler(QMainWindow):
 
 		return super().eventFilter(a0, a1)
 
+	def reassemble(self, position: int, chars_removed: int, chars_added: int):
+		document = self.file_text.document()
+
+		# Map the changed characters to the blocks (lines) they now span
+		first: int = document.findBlock(position).blockNumber()
+		last_block = document.findBlock(min(position + chars_added, document.characterCount() - 1))
+		last: int = last_block.blockNumber() if last_block.isValid() else document.blockCount() - 1
+
+		line_delta: int = document.blockCount() - len(self.assembler.lines)
+		new_lines: list[str] = [
+			document.findBlockByNumber(i).text() for i in range(first, last + 1)
+		]
+		self.assembler.update(first, len(new_lines) - line_delta, new_lines)
+
+		result = self.assembler.result()
+		if isinstance(result, Exception):
+			self.error.setText(f"{result}")
+		else:
+			self.error.setText("")
+			self.result.setText("\n".join(result))
+
 	def assemble(self):
 		self.error.setText("")
 		self.result.setText("")
 
-		result = assemble(self.file_text.toPlainText())
+		result = self.assembler.result()
 		if isinstance(result, Exception):
 			self.error.setText(f"{result}")
 		else:
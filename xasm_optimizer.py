@@ -0,0 +1,518 @@
+import re, sys
+
+# Optimizations working on the XAssembly text produced by the compiler.
+
+# ALU codes that can be evaluated from the A and D registers alone
+EVALUATE = {
+	"0": lambda d, a: 0, "1": lambda d, a: 1, "-1": lambda d, a: -1, "-2": lambda d, a: -2,
+	"D": lambda d, a: d, "A": lambda d, a: a,
+	"!D": lambda d, a: ~d, "!A": lambda d, a: ~a, "-D": lambda d, a: -d, "-A": lambda d, a: -a,
+	"D++": lambda d, a: d + 1, "A++": lambda d, a: a + 1, "D--": lambda d, a: d - 1, "A--": lambda d, a: a - 1,
+	"D+A": lambda d, a: d + a, "D-A": lambda d, a: d - a, "A-D": lambda d, a: a - d,
+	"D&A": lambda d, a: d & a, "D|A": lambda d, a: d | a, "D^A": lambda d, a: d ^ a,
+	"!(D&A)": lambda d, a: ~(d & a), "!(D|A)": lambda d, a: ~(d | a), "!(D^A)": lambda d, a: ~(d ^ a),
+	">>D": lambda d, a: d >> 1, ">>A": lambda d, a: a >> 1,
+}
+
+def wrap(value: int) -> int:
+	"""Wraps a value to a signed 16-bit integer."""
+	return (value + 32768) % 65536 - 32768
+
+class AsmLine:
+	"""A single line of XAssembly, split into its parts."""
+
+	def __init__(self, text: str):
+		self.text = text
+		code = text.split("//")[0].strip()
+		parts = code.split(" ") if code else []
+
+		self.instruction: str = parts[0] if parts else ""
+		self.label: str | None = code if code.startswith(".") else None
+		self.operand: int | str | None = None
+		self.dest: str = ""
+		self.jump: str | None = None
+
+		if self.instruction in ("LDIA", "CALL") and len(parts) == 2:
+			operand = parts[1]
+			if operand.lstrip("-").isdigit():
+				self.operand = int(operand)
+			elif operand[0] == "r" and operand[1:].isdigit():
+				self.operand = int(operand[1:])
+			else:
+				self.operand = operand
+
+		elif self.instruction == "COMP":
+			self.operand = parts[1]
+			for part in parts[2:]:
+				if part.startswith("J"):
+					self.jump = part
+				else:
+					self.dest = part
+
+	@property
+	def ends_block(self) -> bool:
+		return self.jump is not None or self.instruction in ("RETN", "HALT")
+
+	@property
+	def falls_through(self) -> bool:
+		return self.jump != "JMP" and self.instruction not in ("RETN", "HALT")
+
+class RegisterTracker:
+	"""
+	Forward dataflow analysis of what the A and D registers hold, and of which
+	RAM address, if any, holds the same value as D.
+
+	A register value is either an integer, a label, or None when unknown. Each
+	basic block starts with the meet of its predecessors' states: fall-through,
+	jumps whose target is known from A, and calls, which know nothing. Once the
+	analysis settles, loads and computations that would leave the registers as
+	they already are get removed, along with reloads of a value D still holds
+	and stores of one the RAM address already holds.
+	"""
+
+	def __init__(self, instructions: list[str]):
+		self.lines = [AsmLine(text) for text in instructions]
+
+	def step(self, state: tuple, line: AsmLine) -> tuple:
+		"""Returns the register state after a line runs."""
+		a, d, m = state
+
+		if line.instruction == "LDIA":
+			return line.operand, d, m
+
+		if line.instruction == "CALL":
+			return None, None, None # The subroutine may leave anything behind
+
+		if line.instruction == "COMP":
+			address = a if isinstance(a, int) else None
+			code, value = line.operand, a
+			if "M" in code and address is not None and address == m:
+				code, value = code.replace("M", "A"), d # M holds the same value as D
+			result = self.evaluate(code, value, d)
+
+			if "A" in line.dest and "M" in line.dest:
+				m = None # The store goes wherever the result points
+			elif "D" in line.dest:
+				if address is not None and ("M" in line.dest or line.operand == "M"):
+					m = address
+				elif result is None or result != d:
+					m = None # Unless D gets the value it already held
+			elif "M" in line.dest:
+				m = address if address is not None and line.operand == "D" else None if address in (None, m) else m
+
+			if "A" in line.dest: a = result
+			if "D" in line.dest: d = result
+
+		return a, d, m
+
+	def evaluate(self, code: str, a: int | str | None, d: int | str | None) -> int | str | None:
+		if code in ("A", "D"):
+			return a if code == "A" else d # Copies also carry labels
+		if code not in EVALUATE:
+			return None # Reads M
+		if ("A" in code and not isinstance(a, int)) or ("D" in code and not isinstance(d, int)):
+			return None
+		return wrap(EVALUATE[code](d if isinstance(d, int) else 0, a if isinstance(a, int) else 0))
+
+	def meet(self, first: tuple | None, second: tuple) -> tuple:
+		if first is None:
+			return second
+		return tuple(x if x == y else None for x, y in zip(first, second))
+
+	def split_blocks(self) -> list[list[int]]:
+		blocks: list[list[int]] = [[]]
+		for i, line in enumerate(self.lines):
+			if line.label and blocks[-1]:
+				blocks.append([])
+			blocks[-1].append(i)
+			if line.ends_block:
+				blocks.append([])
+		return [block for block in blocks if block]
+
+	def analyze(self) -> tuple[list[list[int]], list[tuple | None], dict[int, set[int]]]:
+		blocks = self.split_blocks()
+		labels = {self.lines[block[0]].label: b for b, block in enumerate(blocks) if self.lines[block[0]].label}
+
+		entry: list[tuple | None] = [None] * len(blocks) # None until the block is reached
+		entry[0] = (0, 0, None) # Both registers start cleared
+
+		for line in self.lines:
+			if line.instruction == "CALL" and line.operand in labels:
+				entry[labels[line.operand]] = (None, None, None)
+
+		edges: dict[int, set[int]] = {}
+		worklist = [b for b in range(len(blocks)) if entry[b] is not None]
+		while worklist:
+			b = worklist.pop()
+			state = entry[b]
+			successors: list[tuple[int, tuple]] = []
+
+			for i in blocks[b]:
+				line = self.lines[i]
+				if line.jump is not None:
+					if state[0] in labels:
+						successors.append((labels[state[0]], state))
+					else:
+						# A computed jump could land on any label
+						successors += [(target, (None, None, None)) for target in labels.values()]
+				state = self.step(state, line)
+
+			if self.lines[blocks[b][-1]].falls_through and b + 1 < len(blocks):
+				successors.append((b + 1, state))
+
+			edges[b] = {target for target, _ in successors}
+			for target, state in successors:
+				merged = self.meet(entry[target], state)
+				if merged != entry[target]:
+					entry[target] = merged
+					worklist.append(target)
+
+		return blocks, entry, edges
+
+	def computed_jumps(self) -> bool:
+		"""Whether any reachable jump goes to an address that isn't a known label, like a jump table."""
+		blocks, entry, _ = self.analyze()
+		labels = {self.lines[block[0]].label for block in blocks if self.lines[block[0]].label}
+
+		for block, state in zip(blocks, entry):
+			if state is None:
+				continue
+			for i in block:
+				if self.lines[i].jump is not None and state[0] not in labels:
+					return True
+				state = self.step(state, self.lines[i])
+		return False
+
+	def reads_a(self, line: AsmLine) -> bool:
+		"""Whether a line depends on the A register, conservatively."""
+		if line.instruction == "COMP":
+			return "A" in line.operand or "M" in line.operand or "M" in line.dest or line.jump is not None
+		return line.instruction not in ("LDIA", "HALT", "RETN", "PLOT", "BUFR", "NOOP", "") and not line.label
+
+	def writes_a(self, line: AsmLine) -> bool:
+		return line.instruction == "LDIA" or (line.instruction == "COMP" and "A" in line.dest)
+
+	def dead_loads(self, blocks: list[list[int]], edges: dict[int, set[int]]) -> set[int]:
+		"""Finds every LDIA whose value is overwritten before anything reads it."""
+		live_in: dict[int, bool] = {b: False for b in edges}
+		dead: set[int] = set()
+
+		changed = True
+		while changed:
+			changed = False
+			dead.clear()
+			for b in reversed(list(edges)):
+				live = any(live_in.get(target, True) for target in edges[b])
+				for i in reversed(blocks[b]):
+					line = self.lines[i]
+					if line.instruction == "LDIA" and not live:
+						dead.add(i)
+					if self.writes_a(line):
+						live = False
+					if self.reads_a(line):
+						live = True
+				if live != live_in[b]:
+					live_in[b] = live
+					changed = True
+
+		return dead
+
+	def dead_stores(self, blocks: list[list[int]], entry: list[tuple | None], edges: dict[int, set[int]]) -> set[int]:
+		"""
+		Finds every store to a known RAM address that's overwritten before
+		anything reads it. A read from an unknown address, a call, a return and
+		any instruction other than LDIA and COMP, like PLOT reading its
+		coordinates or HALT leaving RAM to be inspected, may read every address.
+		"""
+		overwritten: dict[int, set[int]] = {b: set() for b in edges} # Addresses stored to before being read
+		dead: set[int] = set()
+
+		changed = True
+		while changed:
+			changed = False
+			dead.clear()
+			for b in reversed(list(edges)):
+				after = set.intersection(*(overwritten.get(target, set()) for target in edges[b])) if edges[b] else set()
+
+				states = [entry[b]]
+				for i in blocks[b]:
+					states.append(self.step(states[-1], self.lines[i]))
+
+				for i, state in reversed(list(zip(blocks[b], states))):
+					line = self.lines[i]
+					address = state[0] if isinstance(state[0], int) else None
+					if line.instruction == "COMP":
+						if "M" in line.dest and "A" not in line.dest and address is not None:
+							if address in after:
+								dead.add(i)
+							after.add(address)
+						if "M" in line.operand:
+							after = after - {address} if address is not None else set()
+					elif line.instruction not in ("LDIA", "NOOP", "") and not line.label:
+						after = set()
+
+				if after != overwritten[b]:
+					overwritten[b] = after
+					changed = True
+
+		return dead
+
+	def optimize(self) -> list[str]:
+		"""
+		Removes every LDIA and register-only COMP that doesn't change anything,
+		along with reloads and stores of the value D and the RAM address in A
+		already share, then stores nothing reads and every LDIA nothing reads.
+		Each step runs on the result of the one before, since removing a store
+		or a load can leave the load before it unused.
+		"""
+		blocks, entry, _ = self.analyze()
+		removed: set[int] = set()
+
+		for block, state in zip(blocks, entry):
+			if state is None:
+				continue # Unreachable
+
+			for i in block:
+				line = self.lines[i]
+				after = self.step(state, line)
+
+				if line.instruction == "LDIA" and state[0] is not None and line.operand == state[0]:
+					removed.add(i)
+				elif (
+					line.instruction == "COMP" and line.jump is None and "M" not in line.dest
+					and after == state and None not in [after[0 if reg == "A" else 1] for reg in line.dest]
+				):
+					removed.add(i)
+				elif (
+					line.instruction == "COMP" and line.jump is None and isinstance(state[0], int)
+					and state[2] == state[0] and line.operand in ("D", "M") and line.dest in ("D", "M")
+				):
+					removed.add(i) # D and the RAM address in A already hold the same value
+
+				state = after
+
+		self.lines = [line for i, line in enumerate(self.lines) if i not in removed]
+		blocks, entry, edges = self.analyze()
+		for i in self.dead_stores(blocks, entry, edges):
+			line = self.lines[i]
+			dest = line.dest.replace("M", "")
+			indent = line.text[:len(line.text) - len(line.text.lstrip())]
+			comment = " //" + line.text.split("//", 1)[1] if "//" in line.text else ""
+			self.lines[i] = AsmLine(indent + " ".join(part for part in ("COMP", line.operand, dest, line.jump) if part) + comment)
+
+		self.lines = [line for line in self.lines if line.instruction != "COMP" or line.dest or line.jump]
+		blocks, _, edges = self.analyze()
+		removed = self.dead_loads(blocks, edges)
+
+		return [line.text for i, line in enumerate(self.lines) if i not in removed]
+
+class JumpThreader:
+	"""
+	Retargets every jump to a label that only leads on to another unconditional
+	jump, so that chains of jumps take a single one, and turns unconditional
+	jumps to a RETN or HALT into that instruction. Labels nothing refers to are
+	then removed, which lets the peephole optimizer drop the jumps that now land
+	on the next line and the code no jump reaches any more.
+
+	A computed jump can land right after any label, so a program with one, like
+	a jump table, keeps its labels and the size of every jump. So does a program
+	whose labels mark places to profile, and its jumps don't skip any of them.
+	"""
+
+	def __init__(self, instructions: list[str], keep_labels: bool = False):
+		self.lines = [AsmLine(text) for text in instructions]
+		self.keep_labels = keep_labels
+		self.positions = {line.label: i for i, line in enumerate(self.lines) if line.label}
+
+	def destination(self, label: str) -> str:
+		"""Follows a label through the unconditional jumps it leads to."""
+		seen: set[str] = set()
+		while label in self.positions and label not in seen:
+			seen.add(label)
+			i = self.next_instruction(self.positions[label])
+			if i is None or not self.is_jump(i) or self.lines[i + 1].jump != "JMP" or self.lines[i + 1].dest:
+				break
+			# A kept label has to be passed through to be counted
+			if self.keep_labels and any(line.label for line in self.lines[self.positions[label] + 1:i]):
+				break
+			label = self.lines[i].operand
+		return label
+
+	def next_instruction(self, i: int) -> int | None:
+		"""Returns the first line at or after i that isn't a label or a comment."""
+		while i < len(self.lines) and (self.lines[i].label or not self.lines[i].instruction):
+			i += 1
+		return i if i < len(self.lines) else None
+
+	def is_jump(self, i: int) -> bool:
+		"""Whether line i loads a label only for the jump on the next line to use."""
+		line = self.lines[i]
+		if line.instruction != "LDIA" or not isinstance(line.operand, str) or not line.operand.startswith("."):
+			return False
+		if i + 1 >= len(self.lines):
+			return False
+		jump = self.lines[i + 1]
+		return jump.instruction == "COMP" and jump.jump is not None and not (
+			{"A", "M"} & set(jump.operand + jump.dest)
+		)
+
+	def optimize(self) -> list[str]:
+		fixed = self.keep_labels or RegisterTracker([line.text for line in self.lines]).computed_jumps()
+		output: list[str] = []
+
+		i = 0
+		while i < len(self.lines):
+			line = self.lines[i]
+			if not self.is_jump(i):
+				output.append(line.text)
+				i += 1
+				continue
+
+			target = self.destination(line.operand)
+			jump = self.lines[i + 1]
+			landing = self.next_instruction(self.positions[target]) if target in self.positions else None
+			if (
+				not fixed and jump.jump == "JMP" and not jump.dest and landing is not None
+				and self.lines[landing].instruction in ("RETN", "HALT")
+			):
+				output.append(self.retarget(line.text, self.lines[landing].instruction))
+			else:
+				output.append(self.retarget(line.text, f"LDIA {target}"))
+				output.append(jump.text)
+			i += 2
+
+		if fixed:
+			return output
+
+		lines = [AsmLine(text) for text in output]
+		referenced = {line.operand for line in lines if line.instruction in ("LDIA", "CALL")}
+		return [line.text for line in lines if not line.label or line.label in referenced]
+
+	@staticmethod
+	def retarget(text: str, code: str) -> str:
+		"""Replaces the code on a line, keeping its indentation and comment."""
+		indent = text[:len(text) - len(text.lstrip())]
+		comment = text.split("//", 1)[1] if "//" in text else None
+		return indent + code + (f" //{comment}" if comment is not None else "")
+
+# Peephole rules: name, window of patterns, replacement.
+# A window is matched line by line against the code without comments, so a
+# pattern can only match a label if it asks for one; no jump can land inside a
+# window except on its first line. "{n}" keeps the n-th matched line as it was,
+# other replacement lines are formatted with the named groups. Every rule
+# shrinks the code, which keeps the optimizer linear.
+PEEPHOLE_RULES = [
+	("store then reload", (r"COMP D M", r"COMP M D"), ("{0}",)),
+	("load then store back", (r"COMP M D", r"COMP D M"), ("{0}",)),
+	("repeated store", (r"COMP D M", r"COMP D M"), ("{0}",)),
+	("double negation", (r"COMP (?P<op>-|!)D D", r"COMP (?P=op)D D"), ()),
+	("unary on loaded value", (
+		r"COMP (?P<src>[AM]) D", r"COMP (?P<pre>-|!|>>)?D(?P<post>\+\+|--)? D",
+	), ("COMP {pre}{src}{post} D",)),
+	("compute then store", (r"COMP (?P<expr>\S+) D", r"COMP D M"), ("COMP {expr} DM",)),
+	("compute, address then store", (
+		r"COMP (?P<expr>[^AM\s]+) D", r"LDIA (?P<address>\S+)", r"COMP D M",
+	), ("{1}", "COMP {expr} DM")),
+	("compute then address", (r"COMP (?P<expr>\S+) D", r"COMP D A"), ("COMP {expr} DA",)),
+	("overwritten D", (
+		r"COMP (?P<expr>\S+) D", r"COMP (?P<next>[^D\s]+) D(?P<rest>\S*)(?P<jump> J\S+)?",
+	), ("{1}",)),
+	("overwritten A", (r"LDIA \S+", r"LDIA \S+"), ("{1}",)),
+	("jump to next line", (
+		r"LDIA (?P<label>\.\S+)", r"COMP (?P<expr>\S+) J\S+", r"(?P=label)",
+	), ("{0}", "{2}")),
+	("jump over a label to the next line", (
+		r"LDIA (?P<label>\.\S+)", r"COMP (?P<expr>\S+) J\S+", r"\.\S+", r"(?P=label)",
+	), ("{0}", "{2}", "{3}")),
+	("jump and assign to next line", (
+		r"LDIA (?P<label>\.\S+)", r"COMP (?P<expr>\S+) (?P<dest>[DM]+) J\S+", r"(?P=label)",
+	), ("{0}", "COMP {expr} {dest}", "{2}")),
+	("unreachable code", (r"COMP \S+ (\S+ )?JMP|RETN|HALT", r"[^.].*"), ("{0}",)),
+]
+
+class PeepholeOptimizer:
+	"""
+	Rewrites short windows of XAssembly using PEEPHOLE_RULES until none apply.
+
+	Lines are pushed onto the output one at a time, and after each push or
+	rewrite the rules are tried on the windows ending at the last line, so a
+	rewrite can enable another one further back. Since every rule removes at
+	least one line, the whole run is linear in the length of the code.
+	"""
+
+	def __init__(self):
+		self.rules = [
+			(name, len(window), re.compile("\n".join(f"(?:{line})" for line in window)), replacement)
+			for name, window, replacement in PEEPHOLE_RULES
+		]
+		self.fired: dict[str, int] = {name: 0 for name, _, _ in PEEPHOLE_RULES}
+
+	def optimize(self, instructions: list[str]) -> list[str]:
+		output: list[str] = []
+		codes: list[str] = []
+
+		for text in instructions:
+			output.append(text)
+			codes.append(text.split("//")[0].strip())
+
+			while self.rewrite(output, codes):
+				pass
+
+		return output
+
+	def rewrite(self, output: list[str], codes: list[str]) -> bool:
+		"""Applies the first rule matching at the end of the output."""
+		for name, size, pattern, replacement in self.rules:
+			if size > len(codes):
+				continue
+
+			match = pattern.fullmatch("\n".join(codes[-size:]))
+			if not match:
+				continue
+
+			window = output[-size:]
+			indent = window[0][:len(window[0]) - len(window[0].lstrip())]
+			groups = match.groupdict(default="")
+			lines = [
+				window[int(line[1:-1])] if re.fullmatch(r"\{\d\}", line) else indent + line.format(**groups)
+				for line in replacement
+			]
+
+			del output[-size:], codes[-size:]
+			output += lines
+			codes += [line.split("//")[0].strip() for line in lines]
+			self.fired[name] += 1
+			return True
+
+		return False
+
+def remove_redundant_loads(instructions: list[str]) -> list[str]:
+	"""Removes loads of values the A and D registers already hold."""
+	return RegisterTracker(instructions).optimize()
+
+def thread_jumps(instructions: list[str], keep_labels: bool = False) -> list[str]:
+	"""Makes jumps go straight to their final destination."""
+	return JumpThreader(instructions, keep_labels).optimize()
+
+def optimize(instructions: list[str], peephole: PeepholeOptimizer | None = None, keep_labels: bool = False) -> list[str]:
+	"""Runs the jump threader, the peephole optimizer and the register tracker until the code stops shrinking."""
+	peephole = peephole or PeepholeOptimizer()
+
+	while True:
+		size = len(instructions)
+		instructions = remove_redundant_loads(peephole.optimize(thread_jumps(instructions, keep_labels)))
+		if len(instructions) == size:
+			return instructions
+
+if __name__ == "__main__":
+	# Usage: python xasm_optimizer.py <file.xasm>
+	with open(sys.argv[1], "r") as f:
+		instructions = f.read().splitlines()
+
+	peephole = PeepholeOptimizer()
+	optimized = optimize(instructions, peephole)
+
+	print("\n".join(optimized))
+	print(f"\n// {len(instructions)} -> {len(optimized)} lines")
+	for name, count in peephole.fired.items():
+		print(f"// {name}: {count}")
@@ -61,6 +61,7 @@ class VirtualMachine(QMainWindow):
 			self.file_text.toPlainText().strip().splitlines(), None
 		))
 		self.steps = 0
+		self.executions: list[int] = [0] * MAX_INSTRUCTIONS # Times each instruction ran, for profiles
 
 	def init_memory(self):
 		self.memory_value = [0] * (Compiler.INPUT_ADDR + 1)
@@ -125,6 +126,7 @@ class VirtualMachine(QMainWindow):
 		HALT = "0000000000000100"
 
 		current_inst = PROM[self.program_counter]
+		self.executions[self.program_counter] += 1
 		self.current_inst.setText(f"Instruction: {self.program_counter}")
 		self.branch.setText("Branch not taken")
 
@@ -267,6 +269,7 @@ class VirtualMachine(QMainWindow):
 
 		self.program_counter = 0
 		self.steps = 0
+		self.executions = [0] * MAX_INSTRUCTIONS
 
 		self.set_value(self.a_reg, 0, "A")
 		self.set_value(self.d_reg, 0, "D")
@@ -0,0 +1,21 @@
+// Conditions the optimizer can work out or hoist still hold when they're true, leaving 11070 in D
+include operations
+var a: int = 1
+var b: int = 3
+var c: int = 0
+var d: int = 0
+c = 1
+d = 3
+var n: int = 0
+var m: int = 0
+while 1 < 3 {
+	while c < d {
+		m = m + 1
+		if m == 10 { n = n + 100 }
+		if m == 20 { n * 10 + m; halt() }
+		while a < b {
+			n = n + 1
+			if n == 5 { n = n + 1000; a = b }
+		}
+	}
+}
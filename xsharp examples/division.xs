@@ -0,0 +1,8 @@
+include operations
+// Division and modulo written with and without spaces around the operator, leaving 1307 in D
+var a: int = 100
+var b: int = 7
+var c: int = 3
+var q: int = a/b + a/2 + a/(c) + a / c
+var r: int = a%b + a%(c) + a % 8
+q * 10 + r
@@ -1,8 +1,10 @@
 from xsharp_parser import *
 from xsharp_helper import CompilationError
+from xsharp_optimizer import assigned_names, constant_value, halts, walk, wrap
+from xsharp_profile import PROBE_PREFIX, SOURCE_PREFIX, Profile
 from typing import Literal
 
-# Error codes: [0..11]
+# Error codes: [0..12]
 
 
 class CompileResult:
@@ -36,6 +38,9 @@ class Environment:
 		self.constants = ["true", "false", "N_BITS"]
 		self.subroutines = {}
 		self.arrays = {}
+		self.parameters: dict[str, dict[str, int]] = {}
+		self.shadowed: dict[str, int | None] = {}
+		self.shadowed_constants: list[str] = []
 
 		self.assign_address = 16
 
@@ -70,6 +75,39 @@ class Environment:
 			self.assign_address += 1
 		return res.success(None)
 
+	def define_parameters(self, node: SubroutineDef):
+		"""Reserves the RAM slots of a subroutine's parameters, which are only visible inside its body."""
+		res = CompileResult()
+
+		if len(set(node.parameters)) != len(node.parameters):
+			return res.fail(
+				CompilationError(node.start_pos, node.end_pos, f"Duplicate parameters in subroutine {node.name}.", 3)
+			)
+
+		self.parameters[node.name] = {
+			param: self.assign_address + i for i, param in enumerate(node.parameters)
+		}
+		self.assign_address += len(node.parameters)
+		return res.success(None)
+
+	def enter_subroutine(self, name: str):
+		"""Brings a subroutine's parameters into scope, shadowing any global with the same name."""
+		self.shadowed = {param: self.symbols.get(param) for param in self.parameters[name]}
+		self.shadowed_constants = [param for param in self.shadowed if param in self.constants]
+
+		self.symbols.update(self.parameters[name])
+		self.constants = [const for const in self.constants if const not in self.shadowed]
+
+	def exit_subroutine(self):
+		for param, value in self.shadowed.items():
+			if value is None:
+				del self.symbols[param]
+			else:
+				self.symbols[param] = value
+
+		self.constants += self.shadowed_constants
+		self.shadowed, self.shadowed_constants = {}, []
+
 	def get_symbol(self, iden: Identifier | str):
 		res = CompileResult()
 		symbol = iden.symbol if isinstance(iden, Identifier) else iden
@@ -90,12 +128,38 @@ class Compiler:
 	INPUT_ADDR = MAX_RAM_ADDR + 3
 
 	KNOWN_VALUES = (-2, -1, 0, 1)
+	COMPARISONS = ("LT", "LE", "GT", "GE", "EQ", "NE")
+	INVERSE_RELATIONS = {"LT": "GE", "LE": "GT", "GT": "LE", "GE": "LT", "EQ": "NE", "NE": "EQ"}
+	LOGICAL = ("LAND", "LOR")
+	MIN_TABLE_CASES = 4 # Shorter if/elseif chains test each case faster than a jump table dispatches
+	MIN_IMMEDIATE, MAX_IMMEDIATE = -8192, 8191 # LDIA takes a 14-bit signed value
 
-	def __init__(self):
+	def __init__(self, runtime_library: bool = False, profile_source: str | None = None, profile: Profile | None = None):
 		self.instructions: list[str] = []
 
-		self.available_registers = {i for i in range(16)}
-		self.allocated_registers = set()
+		# Free temporary slots, lowest register on top
+		self.free_registers: list[str | int] = [f"r{i}" for i in range(15, -1, -1)]
+		self.used_registers: set[str | int] = set()
+		self.spilled: int = 0
+		self.ram_used: int = 0
+
+		# Calls the shared runtime routines instead of inlining them, trading cycles for PROM
+		self.runtime_library: bool = runtime_library
+		self.runtime: set[str] = set()
+		self.runtime_addresses: list[int] = []
+
+		# Slots holding the address of array[counter] in the loops being compiled, by array and counter
+		self.pointers: dict[tuple[str, str], int | str] = {}
+
+		# Calls whose value the subroutine being compiled returns, which jump instead of calling
+		self.subroutine: str | None = None
+		self.tail_calls: set[int] = set()
+
+		# A profile_generate build labels every statement with its position in the source,
+		# a profile_use build decides with how often each one ran
+		self.profile_source: str | None = profile_source
+		self.probes: int = 0
+		self.profile: Profile | None = profile
 
 	def compile(self, ast: Statements, remove_that_one_line: bool = False):
 		res = CompileResult()
@@ -103,10 +167,11 @@ class Compiler:
 
 		self.jumps: int = 0
 		self.tabs: int = 0
-		self.address: int | str = 0
 
 		if not ast.body + ast.subroutine_defs:
 			return res.success(["HALT"])
+		if self.profile_source is not None:
+			self.write(f"{SOURCE_PREFIX}{self.profile_source}")
 
 		# Predefine subroutines
 		for sub in ast.subroutine_defs:
@@ -121,16 +186,39 @@ class Compiler:
 
 		# Generate subroutine bodies
 		for sub in ast.subroutine_defs:
+			# Temporaries live across a call must survive the callee, so every
+			# subroutine gets its own slots instead of sharing r0 - r15
+			self.free_registers = []
+
 			self.write(f".sub_{sub.name}")
 			self.comment(f"{len(sub.parameters)} params")
 
 			self.tabs += 1
+			self.subroutine = sub.name
+			self.tail_calls = {id(call) for call in self.tail_position(sub.body)}
+			env.enter_subroutine(sub.name)
 			res.register(self.visit(sub.body, env))
+			env.exit_subroutine()
 			if res.error:
 				return res
 			self.write("RETN")
 			self.tabs -= 1
 
+		if "mul" in self.runtime:
+			for instruction in self.multiply_routine(*self.runtime_slots(3)):
+				self.write(instruction)
+		if "div" in self.runtime:
+			for instruction in self.divide_routine(*self.runtime_slots(5)):
+				self.write(instruction)
+
+		if env.assign_address > self.MAX_RAM_ADDR + 1 - self.spilled:
+			return res.fail(
+				CompilationError(
+					ast.start_pos, ast.end_pos, "Allocation limit exceeded!", 1
+				)
+			)
+
+		self.ram_used = env.assign_address - 16 + len(self.used_registers)
 		return res.success(self.instructions)
 
 	def visit(self, node, env: Environment):
@@ -150,49 +238,30 @@ class Compiler:
 
 	def allocate(self, node) -> CompileResult:
 		res = CompileResult()
-		if not self.available_registers:
-			return res.fail(
-				CompilationError(
-					node.start_pos, node.end_pos, "Allocation limit exceeded!", 1
-				)
-			)
-
-		free_register: int = tuple(self.available_registers - self.allocated_registers)[
-			0
-		]
-		self.allocated_registers.add(free_register)
-		self.available_registers.remove(free_register)
 
-		return res.success(f"r{free_register}")
+		if not self.free_registers:
+			# Spill to a fresh slot at the top of RAM, growing downwards
+			self.spilled += 1
+			self.used_registers.add(self.MAX_RAM_ADDR + 1 - self.spilled)
+			return res.success(self.MAX_RAM_ADDR + 1 - self.spilled)
 
-	def free_register(self, register: str) -> None:
-		int_reg: int = int(register[1:])
+		register = self.free_registers.pop()
+		self.used_registers.add(register)
+		return res.success(register)
 
-		self.allocated_registers.remove(int_reg)
-		self.available_registers.add(int_reg)
+	def free_register(self, register: str | int) -> None:
+		self.free_registers.append(register)
 
 	def write(self, instruction: str) -> None:
 		self.instructions.append("\t" * self.tabs + instruction)
 
-	def truncate(self, pos: int) -> None:
-		self.instructions = self.instructions[:pos]
-
 	def make_jump(self) -> int:
 		self.jumps += 1
 		return self.jumps - 1
 
-	def load_immediate(self, value: int | str, forced: bool = False) -> None:
-		"""Load an immediate value into the A register."""
-		if self.address != value or forced or '.' in self.instructions[-1]:
-			self.write(f"LDIA {value}")
-
-		if isinstance(value, int):
-			self.address = value
-		else:
-			if value.startswith("r"):
-				self.address = int(value[1:])
-			else:
-				self.address = value
+	def load_immediate(self, value: int | str) -> None:
+		"""Load an immediate value into the A register. Redundant loads are removed after compiling."""
+		self.write(f"LDIA {value}")
 
 	def comment(self, comment: str) -> None:
 		"""Comments the last instruction."""
@@ -202,6 +271,9 @@ class Compiler:
 		res = CompileResult()
 
 		for stmt in node.body:
+			if self.profile_source is not None and hasattr(stmt, "start_pos"):
+				self.write(f"{PROBE_PREFIX}{stmt.start_pos.line}_{stmt.start_pos.col}_{self.probes}")
+				self.probes += 1
 			res.register(self.visit(stmt, env))
 			if res.error:
 				return res
@@ -209,12 +281,25 @@ class Compiler:
 		return res.success(self.instructions)
 
 	def visitIntLiteral(self, node: IntLiteral, env: Environment) -> CompileResult:
-		if node.value in self.KNOWN_VALUES:
-			self.write(f"COMP {node.value} D")
+		value = wrap(node.value)
+
+		if value in self.KNOWN_VALUES:
+			self.write(f"COMP {value} D")
+		elif self.MIN_IMMEDIATE <= value <= self.MAX_IMMEDIATE:
+			self.load_immediate(value)
+			self.write("COMP A D")
 		else:
-			self.load_immediate(node.value)
+			# Too wide for LDIA: load the top bits, then double them back into place and add the rest
+			shift = 1 if self.MIN_IMMEDIATE * 2 <= value <= self.MAX_IMMEDIATE * 2 else 2
+			self.load_immediate(value >> shift)
 			self.write("COMP A D")
-		return CompileResult().success(node.value)
+			for _ in range(shift):
+				self.write("COMP D A")
+				self.write("COMP D+A D")
+			if value & ((1 << shift) - 1):
+				self.load_immediate(value & ((1 << shift) - 1))
+				self.write("COMP D+A D")
+		return CompileResult().success(value)
 
 	def visitArrayLiteral(self, node: ArrayLiteral, env: Environment) -> CompileResult:
 		res = CompileResult()
@@ -236,227 +321,813 @@ class Compiler:
 		self, node: BinaryOperation, env: Environment
 	) -> CompileResult:
 		res = CompileResult()
+		# Every other operation is handled on its own below
 		op_map = {
 			"ADD": "D+M",
 			"SUB": "M-D",
 			"AND": "D&M",
 			"OR": "D|M",
 			"XOR": "D^M",
-			"MUL": "D*M",
-			"RSHIFT": "D>>M",
-			"LSHIFT": "D<<M",
-			"LT": "D<M",
-			"LE": "D<=M",
-			"EQ": "D==M",
-			"GT": "D>M",
-			"NE": "D!=M",
-			"GE": "D>=M",
 		}
 		operation: str = str(node.op.token_type)
-		expr: str = op_map[operation]
 
-		left_pos = len(self.instructions)
-		left = res.register(self.visit(node.left, env))
+		value = self.constant(node, env)
+		if value is not None:
+			return self.visitIntLiteral(IntLiteral(value, node.start_pos, node.end_pos), env)
+
+		if operation in self.COMPARISONS:
+			res.register(self.difference(node, env))
+			if res.error:
+				return res
+			self.materialize_comparison(operation)
+			return res.success(None)
+
+		if operation in self.LOGICAL:
+			# Branch on the operands like a condition would, then set D once on each side
+			jmp = self.make_jump()
+			res.register(self.branch(node, f".false{jmp}", False, env))
+			if res.error:
+				return res
+			self.load_immediate(f".end{jmp}")
+			self.write("COMP -1 D JMP")
+			self.write(f".false{jmp}")
+			self.write("COMP 0 D")
+			self.write(f".end{jmp}")
+			return res.success(None)
+
+		if operation in ("DIV", "MOD"):
+			return self.divide(node, operation, env)
+
+		if operation in ("LSHIFT", "RSHIFT"):
+			amount = self.constant(node.right, env)
+			if amount is not None:
+				res.register(self.visit(node.left, env))
+				if res.error:
+					return res
+				for instruction in self.shift_constant(f"shift{self.make_jump()}", operation, amount):
+					self.write(instruction)
+				return res.success(None)
+
+		if operation not in ("MUL", "RSHIFT", "LSHIFT"):
+			# Keep one side in D and read a constant or variable on the other side straight from A or M
+			right_operand = self.leaf_operand(node.right, env)
+			left_operand = self.leaf_operand(node.left, env)
+
+			if right_operand is not None:
+				res.register(self.visit(node.left, env))
+				if res.error:
+					return res
+
+				location, right = right_operand
+				self.operate(operation, location, right, node.right)
+				return res.success(None)
+
+			if left_operand is not None:
+				res.register(self.visit(node.right, env))
+				if res.error:
+					return res
+
+				location, left = left_operand
+				self.operate(operation, location, left, node.left, reversed=True)
+				return res.success(None)
+
+		if operation == "MUL":
+			# Multiplying by a constant needs no loop
+			operand, factor = node.left, self.constant(node.right, env)
+			if factor is None:
+				operand, factor = node.right, self.constant(node.left, env)
+			if factor is not None:
+				return self.multiply_constant(operand, factor, env)
+
+		if operation == "MUL" and self.runtime_library:
+			# Pass a variable on the right straight to __mul
+			right_operand = self.leaf_operand(node.right, env)
+			if right_operand is not None and right_operand[0] == "M":
+				res.register(self.visit(node.left, env))
+				if res.error:
+					return res
+				self.call_multiply(right_operand[1])
+				return res.success(None)
+
+		res.register(self.visit(node.left, env))
 		if res.error:
 			return res
-		reg_left: str = res.register(self.allocate(node.left))
+		reg_left: str | int = res.register(self.allocate(node.left))
 		if res.error:
 			return res
 
 		self.load_immediate(reg_left)
 		self.write("COMP D M")
 
-		right_pos = len(self.instructions)
-		right = res.register(self.visit(node.right, env))
-		if res.error:
-			return res
-		reg_right: str = res.register(self.allocate(node.right))
+		res.register(self.visit(node.right, env))
 		if res.error:
 			return res
 
-		if isinstance(left, int) and isinstance(right, int):
-			self.truncate(left_pos)
-			value = eval(expr.replace("D", f"{left}").replace("M", f"{right}"))
-			if isinstance(value, bool):
-				value = -int(value)  # Ensures true = -1, false = 0
-			if operation == "SUB":
-				value = -value  # Subtraction fix
+		if operation == "MUL" and self.runtime_library:
+			self.call_multiply(reg_left)
 
-			return self.visitIntLiteral(IntLiteral(value, None, None), env)
+		elif operation == "MUL":
+			# Shift-and-add loop, inlined
+			reg_right: str | int = res.register(self.allocate(node.right))
+			if res.error:
+				return res
+			self.load_immediate(reg_right)
+			self.write("COMP D M")
+			product: str | int = res.register(self.allocate(node))
+			if res.error:
+				return res
 
-		def comparison(op: Literal["LT", "LE", "GT", "GE", "EQ", "NE"]) -> None:
-			jmp = self.make_jump()
+			for instruction in self.multiply_loop(f"mul{self.make_jump()}", reg_left, reg_right, product):
+				self.write(instruction)
+			self.free_register(product)
+			self.free_register(reg_right)
 
-			if right == 0:
-				self.truncate(right_pos)
-			else:
-				self.load_immediate(reg_left)
-				self.write("COMP M-D D")
+		elif operation in ("LSHIFT", "RSHIFT"):
+			count: str | int | None = None
+			if operation == "LSHIFT":
+				count = res.register(self.allocate(node.right))
+				if res.error:
+					return res
 
-			self.load_immediate(f".true{jmp}")
-			self.write(f"COMP D J{op}")
-			self.load_immediate(f".end{jmp}")
-			self.write("COMP 0 D JMP")
+			for instruction in self.shift_loop(f"shift{self.make_jump()}", operation, reg_left, count):
+				self.write(instruction)
+			if count is not None:
+				self.free_register(count)
 
-			self.write(f".true{jmp}")
-			self.write("COMP -1 D")
-			self.write(f".end{jmp}")
+		else:
+			self.load_immediate(reg_left)
+			self.write(f"COMP {op_map[operation]} D")
 
-		if operation == "MUL":
-			# Shift-and-add algorithm
-			self.load_immediate(reg_right)
-			self.write("COMP D M")
-			product: str = res.register(self.allocate(node))
+		self.free_register(reg_left)
+		return res.success(None)
+
+	def call_multiply(self, address: str | int) -> None:
+		"""Multiplies the D register by the value at `address` with the shared __mul routine."""
+		multiplicand, multiplier, _ = self.runtime_slots(3)
+		self.load_immediate(multiplicand)
+		self.write("COMP D M")
+		self.load_immediate(address)
+		self.write("COMP M D")
+		self.write("CALL .__mul")
+		self.runtime.add("mul")
+
+	def runtime_slots(self, count: int) -> tuple[int, ...]:
+		"""Reserves the RAM slots shared by the runtime routines, at the top of RAM."""
+		while len(self.runtime_addresses) < count:
+			self.spilled += 1
+			self.used_registers.add(self.MAX_RAM_ADDR + 1 - self.spilled)
+			self.runtime_addresses.append(self.MAX_RAM_ADDR + 1 - self.spilled)
+		return tuple(self.runtime_addresses[:count])
+
+	@staticmethod
+	def multiply_loop(
+		label: str, multiplicand: str | int, multiplier: str | int, product: str | int
+	) -> list[str]:
+		"""Shift-and-add multiplication of two values in RAM, leaving the product in D.
+		The loop stops as soon as the multiplier runs out of set bits, or the multiplicand
+		is shifted out entirely, so a small multiplier takes only a few iterations."""
+		return [
+			f"LDIA {product}",
+			"COMP 0 M",
+			f".{label}_loop",
+			f"LDIA {multiplier}",
+			"COMP M D",
+			f"LDIA .{label}_end",
+			"COMP D JEQ",
+			"LDIA 1",
+			"COMP D&A D", # Get LSB
+			f"LDIA .{label}_shift",
+			"COMP D JEQ",
+			f"LDIA {multiplicand}",
+			"COMP M D",
+			f"LDIA {product}",
+			"COMP D+M M",
+			f".{label}_shift",
+			f"LDIA {multiplier}",
+			"COMP >>M M",
+			f"LDIA {multiplicand}",
+			"COMP M D",
+			"COMP D+M DM",
+			f"LDIA .{label}_loop",
+			"COMP D JNE",
+			f".{label}_end",
+			f"LDIA {product}",
+			"COMP M D",
+		]
+
+	@staticmethod
+	def multiply_routine(
+		multiplicand: str | int, multiplier: str | int, product: str | int
+	) -> list[str]:
+		"""The shared __mul routine, which multiplies D by the value at `multiplicand` and returns the product in D.
+		It makes the multiplier non-negative, then loops over whichever operand is smaller."""
+		return [
+			".__mul",
+			"LDIA .__mul_sign",
+			"COMP D JGE",
+			# Negate both operands, so the multiplier is non-negative
+			"COMP -D D",
+			f"LDIA {multiplicand}",
+			"COMP -M M",
+			".__mul_sign",
+			f"LDIA {multiplier}",
+			"COMP D M",
+			f"LDIA {multiplicand}",
+			"COMP D-M D",
+			"LDIA .__mul_start",
+			"COMP D JLE",
+			f"LDIA {multiplicand}",
+			"COMP M D",
+			"LDIA .__mul_start",
+			"COMP D JLT",
+			# Swap the operands to loop over the smaller one
+			f"LDIA {multiplier}",
+			"COMP D+M M",
+			"COMP M-D D",
+			f"LDIA {multiplicand}",
+			"COMP D M",
+			f"LDIA {multiplier}",
+			"COMP M-D M",
+			".__mul_start",
+			*Compiler.multiply_loop("__mul", multiplicand, multiplier, product),
+			"RETN",
+		]
+
+	@staticmethod
+	def shift_constant(label: str, operation: Literal["LSHIFT", "RSHIFT"], amount: int) -> list[str]:
+		"""Shifts D by a constant amount. A negative amount leaves D as it is."""
+		if operation == "LSHIFT":
+			return ["COMP 0 D"] if amount >= 16 else ["COMP D A", "COMP D+A D"] * max(amount, 0)
+
+		if amount >= 15:
+			# Only the sign is left
+			return [
+				f"LDIA .{label}",
+				"COMP D JLT",
+				f"LDIA .{label}_end",
+				"COMP 0 D JMP",
+				f".{label}",
+				"COMP -1 D",
+				f".{label}_end",
+			]
+		return ["COMP >>D D"] * max(amount, 0)
+
+	@staticmethod
+	def shift_loop(
+		label: str, operation: Literal["LSHIFT", "RSHIFT"], value: str | int, count: str | int | None
+	) -> list[str]:
+		"""Shifts the value at `value` by the amount in D, one bit per iteration, leaving the result in D.
+		A left shift counts down at `count`, while a right shift counts down in D itself.
+		Amounts of zero or less leave the value as it is, and larger amounts than the 16 bits of a
+		left shift or the 15 of a right shift can change it are cut down to that."""
+		limit = 16 if operation == "LSHIFT" else 15
+		clamp = [
+			f"LDIA .{label}_end",
+			"COMP D JLE",
+			f"LDIA {limit}",
+			"COMP D-A D",
+			f"LDIA .{label}_clamped",
+			"COMP D JLE",
+			"COMP 0 D",
+			f".{label}_clamped",
+			f"LDIA {limit}",
+			"COMP D+A D",
+		]
+
+		if operation == "RSHIFT":
+			return clamp + [
+				f".{label}",
+				f"LDIA {value}",
+				"COMP >>M M",
+				f"LDIA .{label}",
+				"COMP D-- D JGT",
+				f".{label}_end",
+				f"LDIA {value}",
+				"COMP M D",
+			]
+
+		return clamp + [
+			f"LDIA {count}",
+			"COMP D M",
+			f".{label}",
+			f"LDIA {value}",
+			"COMP M D",
+			"COMP D+M M",
+			f"LDIA {count}",
+			"COMP M-- DM",
+			f"LDIA .{label}",
+			"COMP D JGT",
+			f".{label}_end",
+			f"LDIA {value}",
+			"COMP M D",
+		]
+
+	def divide(self, node: BinaryOperation, operation: Literal["DIV", "MOD"], env: Environment) -> CompileResult:
+		"""Divides with truncation towards zero, with shifts for powers of two and the shared __div routine otherwise."""
+		res = CompileResult()
+		divisor = self.constant(node.right, env)
+
+		if divisor is not None and self.power_of_two(divisor) is not None:
+			res.register(self.visit(node.left, env))
 			if res.error:
 				return res
-			self.load_immediate(product)
-			self.write("COMP 0 M")
+			for instruction in self.divide_power_of_two(f"div{self.make_jump()}", divisor, operation == "MOD"):
+				self.write(instruction)
+			return res.success(None)
+
+		dividend_slot, divisor_slot = self.runtime_slots(5)[:2]
+		res.register(self.visit(node.left, env))
+		if res.error:
+			return res
 
-			self.visitIntLiteral(IntLiteral(16, None, None), env)
-			bits: str = res.register(self.allocate(node))
+		if self.leaf_operand(node.right, env) is not None:
+			self.load_immediate(dividend_slot)
+			self.write("COMP D M")
+			res.register(self.visit(node.right, env))
 			if res.error:
 				return res
-
-			self.load_immediate(f"{bits}")
+			self.load_immediate(divisor_slot)
+			self.write("COMP D M")
+		else:
+			reg_left: str | int = res.register(self.allocate(node.left))
+			if res.error:
+				return res
+			self.load_immediate(reg_left)
 			self.write("COMP D M")
 
-			mul_loop: int = self.make_jump()
-
-			self.write(f".mul_loop{mul_loop}")
-			self.tabs += 1
-			self.write("COMP 1 D")
-			self.load_immediate(reg_right)
-			self.comment("Get LSB")
-			self.write("COMP D&M D")
-			self.load_immediate(f".mul_shift{mul_loop}")
-			self.write("COMP D JEQ")
-
-			# Add multiplier to product
+			res.register(self.visit(node.right, env))
+			if res.error:
+				return res
+			self.load_immediate(divisor_slot)
+			self.write("COMP D M")
 			self.load_immediate(reg_left)
-			self.comment("Multiplier")
 			self.write("COMP M D")
-			self.load_immediate(product)
-			self.comment("Product")
-			self.write("COMP D+M M")
+			self.load_immediate(dividend_slot)
+			self.write("COMP D M")
+			self.free_register(reg_left)
 
-			# Shift multiplier and multiplicand
-			self.write(f".mul_shift{mul_loop}")
-			self.load_immediate(reg_right)
-			self.write("COMP >>M M")
-			self.load_immediate(reg_left)
+		self.write("CALL .__div")
+		self.runtime.add("div")
+		if operation == "MOD":
+			self.load_immediate(dividend_slot)
+			self.comment("Remainder")
 			self.write("COMP M D")
-			self.write("COMP D+M M")
+		return res.success(None)
 
-			# Looping
-			self.load_immediate(f"{bits}")
-			self.write("COMP M-- DM")
-			self.load_immediate(f".mul_loop{mul_loop}")
-			self.write("COMP D JGE")
-			self.tabs -= 1
+	@staticmethod
+	def power_of_two(divisor: int) -> int | None:
+		"""Returns k if a divisor is ±2^k, with a 2^k - 1 mask that fits in LDIA, otherwise None."""
+		magnitude = abs(wrap(divisor))
+		if magnitude == 0 or magnitude & (magnitude - 1) or magnitude > Compiler.MAX_IMMEDIATE + 1:
+			return None
+		return magnitude.bit_length() - 1
+
+	@staticmethod
+	def divide_power_of_two(label: str, divisor: int, modulo: bool) -> list[str]:
+		"""Divides D by ±2^k with shifts, rounding negative dividends towards zero like __div."""
+		shift = Compiler.power_of_two(divisor)
+		mask = (1 << shift) - 1
+
+		if modulo:
+			if not mask:
+				return ["COMP 0 D"]
+			# The remainder takes the sign of the dividend
+			return [
+				f"LDIA .{label}",
+				"COMP D JLT",
+				f"LDIA {mask}",
+				"COMP D&A D",
+				f"LDIA .{label}_end",
+				"COMP 0 JMP",
+				f".{label}",
+				"COMP -D D",
+				f"LDIA {mask}",
+				"COMP D&A D",
+				"COMP -D D",
+				f".{label}_end",
+			]
+
+		instructions: list[str] = []
+		if mask:
+			# Bias negative dividends so the arithmetic shift rounds towards zero
+			instructions += [f"LDIA .{label}", "COMP D JGE", f"LDIA {mask}", "COMP D+A D", f".{label}"]
+		instructions += ["COMP >>D D"] * shift
+		if divisor < 0:
+			instructions.append("COMP -D D")
+		return instructions
+
+	@staticmethod
+	def divide_routine(
+		dividend: str | int, divisor: str | int, quotient: str | int, bit: str | int, signs: str | int
+	) -> list[str]:
+		"""The shared __div routine. It divides the value at `dividend` by the value at `divisor`,
+		returning the quotient in D and leaving the remainder at `dividend`. The quotient is truncated
+		towards zero and the remainder takes the sign of the dividend. Dividing by zero gives 0,
+		and leaves the dividend as the remainder.
+
+		It runs on negative magnitudes, since -32768 has no positive counterpart, and aligns the
+		divisor with the dividend first, so it only runs as many steps as the quotient has bits."""
+		return [
+			".__div",
+			f"LDIA {divisor}",
+			"COMP M D",
+			"LDIA .__div_zero",
+			"COMP D JEQ",
+			f"LDIA {quotient}",
+			"COMP 0 M",
+			f"LDIA {bit}",
+			"COMP -1 M",
+			f"LDIA {signs}",
+			"COMP 0 M",
+			# The signs are 1 for a positive divisor, and inverted for a positive dividend
+			"LDIA .__div_divisor",
+			"COMP D JLT",
+			f"LDIA {divisor}",
+			"COMP -M M",
+			f"LDIA {signs}",
+			"COMP 1 M",
+			".__div_divisor",
+			f"LDIA {dividend}",
+			"COMP M D",
+			"LDIA .__div_zero",
+			"COMP D JEQ",
+			"LDIA .__div_align",
+			"COMP D JLT",
+			f"LDIA {dividend}",
+			"COMP -M M",
+			f"LDIA {signs}",
+			"COMP !M M",
+
+			# Double the divisor while it fits in the dividend
+			".__div_align",
+			f"LDIA {divisor}",
+			"COMP M D",
+			"COMP D+M D",
+			"LDIA .__div_loop",
+			"COMP D JGE", # Doubling would overflow
+			f"LDIA {dividend}",
+			"COMP D-M D",
+			"LDIA .__div_loop",
+			"COMP D JLT",
+			f"LDIA {divisor}",
+			"COMP M D",
+			"COMP D+M M",
+			f"LDIA {bit}",
+			"COMP M D",
+			"COMP D+M M",
+			"LDIA .__div_align",
+			"COMP 0 JMP",
+
+			# Subtract the divisor wherever it fits, restoring the dividend otherwise
+			".__div_loop",
+			f"LDIA {divisor}",
+			"COMP M D",
+			f"LDIA {dividend}",
+			"COMP M-D D",
+			"LDIA .__div_shift",
+			"COMP D JGT",
+			f"LDIA {dividend}",
+			"COMP D M",
+			f"LDIA {bit}",
+			"COMP M D",
+			f"LDIA {quotient}",
+			"COMP D+M M",
+			".__div_shift",
+			f"LDIA {bit}",
+			"COMP M D",
+			"COMP D++ D",
+			"LDIA .__div_sign",
+			"COMP D JEQ",
+			f"LDIA {bit}",
+			"COMP >>M M",
+			f"LDIA {divisor}",
+			"COMP >>M M",
+			"LDIA .__div_loop",
+			"COMP 0 JMP",
+
+			# Give the remainder the sign of the dividend, and the quotient the sign of their product
+			".__div_sign",
+			f"LDIA {signs}",
+			"COMP M D",
+			"LDIA .__div_remainder",
+			"COMP D JGE",
+			f"LDIA {dividend}",
+			"COMP -M M",
+			".__div_remainder",
+			"LDIA 1",
+			"COMP D&A D",
+			"LDIA .__div_negative",
+			"COMP D JNE",
+			f"LDIA {quotient}",
+			"COMP -M D",
+			"RETN",
+			".__div_negative",
+			f"LDIA {quotient}",
+			"COMP M D",
+			"RETN",
+			".__div_zero",
+			"COMP 0 D",
+			"RETN",
+		]
 
-			self.load_immediate(f"{product}", forced=True)
-			self.write("COMP M D")
-			self.free_register(product)
-			self.free_register(bits)
+	def multiply_constant(self, node, factor: int, env: Environment) -> CompileResult:
+		"""Multiplies an expression by a constant with a sequence of doublings, additions and subtractions."""
+		res = CompileResult()
+		res.register(self.visit(node, env))
+		if res.error:
+			return res
 
-		elif operation in ("LT", "LE", "GT", "GE", "EQ", "NE"):
-			comparison(operation)
+		steps = self.multiplication_steps(factor)
+		address, save = None, "add" in steps or "sub" in steps
+		if save:
+			# Keep the multiplicand in RAM, unless it's a variable already there
+			operand = self.leaf_operand(node, env)
+			if operand is not None and operand[0] == "M":
+				address, save = operand[1], False
+			else:
+				address = res.register(self.allocate(node))
+				if res.error:
+					return res
 
-		else:
-			self.load_immediate(reg_left)
-			self.write(f"COMP {expr} D")
+		for instruction in self.multiplication_code(steps, address, save):
+			self.write(instruction)
+
+		if save:
+			self.free_register(address)
+		return res.success(None)
+
+	@staticmethod
+	def multiplication_steps(factor: int) -> list[str]:
+		"""Plans a multiplication of D by a constant as doublings, additions and subtractions.
+		The binary and canonical signed digits of both 16-bit representations of the factor
+		are tried, and the cheapest plan is kept."""
+		factor = wrap(factor)
+		if factor == 0:
+			return ["zero"]
+
+		plans: list[list[str]] = []
+		for candidate in (factor, factor + 65536 if factor < 0 else factor - 65536):
+			negative, magnitude = candidate < 0, abs(candidate)
+			binary = [(magnitude >> bit) & 1 for bit in range(magnitude.bit_length())]
+
+			# Non-adjacent form, least significant digit first
+			signed: list[int] = []
+			while candidate:
+				digit = 2 - (candidate & 3) if candidate & 1 else 0
+				signed.append(digit)
+				candidate = (candidate - digit) >> 1
+
+			for digits, negate in ((signed, False), (binary, negative)):
+				steps = [] if digits[-1] == 1 else ["neg"]
+				for digit in reversed(digits[:-1]):
+					steps.append("double")
+					if digit:
+						steps.append("add" if digit == 1 else "sub")
+				plans.append(steps + ["neg"] if negate else steps)
+
+		return min(plans, key=Compiler.multiplication_cost)
+
+	@staticmethod
+	def multiplication_cost(steps: list[str]) -> int:
+		"""Counts the instructions a multiplication plan compiles to."""
+		cost = sum(1 if step in ("neg", "zero") else 2 for step in steps)
+		return cost + 2 if "add" in steps or "sub" in steps else cost
+
+	@staticmethod
+	def multiplication_code(steps: list[str], address: str | int | None, save: bool) -> list[str]:
+		"""Turns a multiplication plan into XAssembly. The multiplicand is in D, and at `address` in RAM
+		if the plan adds or subtracts it. If `save` is set, it's stored there first."""
+		instructions: list[str] = []
+		if save:
+			instructions += [f"LDIA {address}", "COMP D M"]
+
+		for step in steps:
+			match step:
+				case "zero":
+					instructions.append("COMP 0 D")
+				case "neg":
+					instructions.append("COMP -D D")
+				case "double":
+					instructions += ["COMP D A", "COMP D+A D"]
+				case "add":
+					instructions += [f"LDIA {address}", "COMP D+M D"]
+				case "sub":
+					instructions += [f"LDIA {address}", "COMP D-M D"]
+
+		return instructions
+
+	def constant(self, node, env: Environment) -> int | None:
+		"""Evaluates a constant expression without emitting any code, or returns None if it isn't one."""
+		constants = {symbol: env.symbols[symbol] for symbol in env.constants + list(env.arrays)}
+		return constant_value(node, constants)
+
+	def leaf_operand(self, node, env: Environment) -> tuple[str, int] | None:
+		"""Returns how to read a leaf operand without touching the D register:
+		("A", value) for constants that fit in LDIA, ("M", address) for variables, or None otherwise."""
+		value = self.constant(node, env)
+		if value is not None:
+			return ("A", value) if self.MIN_IMMEDIATE <= value <= self.MAX_IMMEDIATE else None
+
+		if isinstance(node, Identifier) and node.symbol in env.symbols:
+			if node.symbol not in env.subroutines and node.symbol not in env.native_subs:
+				return "M", env.symbols[node.symbol]
+
+		return None
+
+	def operate(
+		self, operation: str, location: str, value: int, node, reversed: bool = False
+	) -> None:
+		"""Applies a binary operation to the D register and a leaf operand held in A or M.
+		If `reversed` is set, the leaf operand is the left-hand side."""
+		if operation in ("ADD", "SUB") and location == "A" and value in (1, -1) and not reversed:
+			self.write("COMP D++ D" if (value == 1) == (operation == "ADD") else "COMP D-- D")
+			return
+
+		self.load_immediate(value)
+		if isinstance(node, Identifier):
+			self.comment(node.symbol)
+		match operation:
+			case "ADD":
+				self.write(f"COMP D+{location} D")
+			case "SUB":
+				self.write(f"COMP {location}-D D" if reversed else f"COMP D-{location} D")
+			case "AND":
+				self.write(f"COMP D&{location} D")
+			case "OR":
+				self.write(f"COMP D|{location} D")
+			case "XOR":
+				self.write(f"COMP D^{location} D")
+
+	def difference(self, node: BinaryOperation, env: Environment) -> CompileResult:
+		"""Leaves the left operand of a comparison minus its right operand in D, which compares to 0 like they do."""
+		res = CompileResult()
 
+		right_operand = self.leaf_operand(node.right, env)
+		left_operand = self.leaf_operand(node.left, env)
+		if right_operand is not None or left_operand is not None:
+			reversed = right_operand is None
+			location, value = left_operand if reversed else right_operand
+			res.register(self.visit(node.right if reversed else node.left, env))
+			if res.error:
+				return res
+
+			if location == "A" and value == 0 and not reversed:
+				return res.success(None)
+			self.load_immediate(value)
+			if isinstance(node.left if reversed else node.right, Identifier):
+				self.comment((node.left if reversed else node.right).symbol)
+			self.write(f"COMP {location}-D D" if reversed else f"COMP D-{location} D")
+			return res.success(None)
+
+		res.register(self.visit(node.left, env))
+		if res.error:
+			return res
+		reg_left: str | int = res.register(self.allocate(node.left))
+		if res.error:
+			return res
+		self.load_immediate(reg_left)
+		self.write("COMP D M")
+
+		res.register(self.visit(node.right, env))
+		if res.error:
+			return res
+		self.load_immediate(reg_left)
+		self.write("COMP M-D D")
 		self.free_register(reg_left)
-		self.free_register(reg_right)
 		return res.success(None)
 
+	def boolean(self, node) -> bool:
+		"""Whether an expression always evaluates to -1 or 0."""
+		if isinstance(node, UnaryOperation):
+			return str(node.op.token_type) == "NOT" and self.boolean(node.value)
+		return isinstance(node, BinaryOperation) and str(node.op.token_type) in self.COMPARISONS + self.LOGICAL
+
+	def branch(self, condition, label: str, when: bool, env: Environment, jump: str | None = None) -> CompileResult:
+		"""Jumps to `label` if a condition's truth is `when`. Comparisons jump straight off the
+		difference of their operands, && and || only evaluate their right operand when the left
+		one doesn't decide the result, and ~ of a boolean swaps the outcomes. Anything else is
+		computed and tested with `jump`, or against 0 if there is none."""
+		res = CompileResult()
+		operation = str(condition.op.token_type) if isinstance(condition, (UnaryOperation, BinaryOperation)) else None
+		value = self.constant(condition, env)
+
+		if value is not None and self.boolean(condition):
+			# Holds when it's true, like any other comparison, whatever `jump` tests other values with
+			if (value != 0) == when:
+				self.load_immediate(label)
+				self.write("COMP 0 JMP")
+			return res.success(None)
+
+		if value is None:
+			if operation == "NOT" and self.boolean(condition.value):
+				return self.branch(condition.value, label, not when, env)
+
+			if operation in self.COMPARISONS:
+				res.register(self.difference(condition, env))
+				if res.error:
+					return res
+				self.load_immediate(label)
+				self.write(f"COMP D J{operation if when else self.INVERSE_RELATIONS[operation]}")
+				return res.success(None)
+
+			if operation in self.LOGICAL:
+				# The left operand decides the result when it's false for && or true for ||
+				if (operation == "LOR") == when:
+					res.register(self.branch(condition.left, label, when, env))
+					if res.error:
+						return res
+					return self.branch(condition.right, label, when, env)
+
+				skip = f".skip{self.make_jump()}"
+				res.register(self.branch(condition.left, skip, not when, env))
+				if res.error:
+					return res
+				res.register(self.branch(condition.right, label, when, env))
+				if res.error:
+					return res
+				self.write(skip)
+				return res.success(None)
+
+		res.register(self.visit(condition, env))
+		if res.error:
+			return res
+		self.load_immediate(label)
+		self.write(f"COMP D {jump or ('JNE' if when else 'JEQ')}")
+		return res.success(None)
+
+	def materialize_comparison(self, op: Literal["LT", "LE", "GT", "GE", "EQ", "NE"]) -> None:
+		"""Turns the difference of two values held in D into a boolean (-1 or 0)."""
+		jmp = self.make_jump()
+
+		self.load_immediate(f".true{jmp}")
+		self.write(f"COMP D J{op}")
+		self.load_immediate(f".end{jmp}")
+		self.write("COMP 0 D JMP")
+
+		self.write(f".true{jmp}")
+		self.write("COMP -1 D")
+		self.write(f".end{jmp}")
+
 	def visitUnaryOperation(
 		self, node: UnaryOperation, env: Environment
 	) -> CompileResult:
 		res = CompileResult()
 		operation: str = str(node.op.token_type)
 
-		start_pos: int = len(self.instructions)
-		value = res.register(self.visit(node.value, env))
+		value = self.constant(node, env)
+		if value is not None:
+			return self.visitIntLiteral(IntLiteral(value, node.start_pos, node.end_pos), env)
+
+		res.register(self.visit(node.value, env))
 		if res.error:
 			return res
 
-		if isinstance(value, int):
-			self.truncate(start_pos)
-			folded_value: int = value
-			match operation:
-				case "SUB":
-					folded_value = -value
-				case "ADD":
-					...
-				case "NOT":
-					folded_value = ~value
-				case "INC":
-					folded_value = value + 1
-				case "DEC":
-					folded_value = value - 1
-				case "ABS":
-					folded_value = abs(value)
-				case "SIGN":
-					folded_value = -1 if value < 0 else 0 if value == 0 else 1
-				case _:
-					return res.fail(
-						CompilationError(
-							node.op.start_pos,
-							node.op.end_pos,
-							f"Unsupported unary operator: {operation}",
-							2,
-						)
-					)
-
-			return self.visitIntLiteral(IntLiteral(folded_value, None, None), env)
-		else:
-			match operation:
-				case "SUB":
-					self.write("COMP -D D")
-				case "ADD":
-					...
-				case "NOT":
-					self.write("COMP !D D")
-				case "INC":
-					self.write("COMP D++ D")
-				case "DEC":
-					self.write("COMP D-- D")
-				case "ABS":
-					abs_jmp = self.make_jump()
-					self.load_immediate(f".abs{abs_jmp}")
-					self.write("COMP D JGE")
-					self.write("COMP -D D")
-					self.write(f".abs{abs_jmp}")
-				case "SIGN":
-					neg = self.make_jump()
-					pos = self.make_jump()
-					end = self.make_jump()
-
-					self.load_immediate(f".neg{neg}")
-					self.write("COMP D JLT")
-					self.load_immediate(f".pos{pos}")
-					self.write("COMP D JGT")
-					self.load_immediate(f".end{end}")
-					self.write("COMP D JMP")
-
-					self.write(f".neg{neg}")
-					self.write("COMP -1 D")
-					self.load_immediate(f".end{end}")
-					self.write("COMP D JMP")
-					self.write(f".pos{pos}")
-					self.write("COMP 1 D")
-					self.write(f".end{end}")
-				case _:
-					return res.fail(
-						CompilationError(
-							node.op.start_pos,
-							node.op.end_pos,
-							f"Unsupported unary operator: {operation}",
-							2,
-						)
+		match operation:
+			case "SUB":
+				self.write("COMP -D D")
+			case "ADD":
+				...
+			case "NOT":
+				self.write("COMP !D D")
+			case "INC":
+				self.write("COMP D++ D")
+			case "DEC":
+				self.write("COMP D-- D")
+			case "ABS":
+				abs_jmp = self.make_jump()
+				self.load_immediate(f".abs{abs_jmp}")
+				self.write("COMP D JGE")
+				self.write("COMP -D D")
+				self.write(f".abs{abs_jmp}")
+			case "SIGN":
+				neg = self.make_jump()
+				pos = self.make_jump()
+				end = self.make_jump()
+
+				self.load_immediate(f".neg{neg}")
+				self.write("COMP D JLT")
+				self.load_immediate(f".pos{pos}")
+				self.write("COMP D JGT")
+				self.load_immediate(f".end{end}")
+				self.write("COMP D JMP")
+
+				self.write(f".neg{neg}")
+				self.write("COMP -1 D")
+				self.load_immediate(f".end{end}")
+				self.write("COMP D JMP")
+				self.write(f".pos{pos}")
+				self.write("COMP 1 D")
+				self.write(f".end{end}")
+			case _:
+				return res.fail(
+					CompilationError(
+						node.op.start_pos,
+						node.op.end_pos,
+						f"Unsupported unary operator: {operation}",
+						2,
 					)
-			return res.success(None)
+				)
+		return res.success(None)
 
 	def visitIdentifier(self, node: Identifier, env: Environment) -> CompileResult:
 		res = CompileResult()
@@ -477,13 +1148,18 @@ class Compiler:
 		self, node: ConstDefinition, env: Environment
 	) -> CompileResult:
 		res = CompileResult()
-		start_pos = len(self.instructions)
 
-		value = res.register(self.visit(node.value, env))
-		if res.error:
-			return res
+		value = self.constant(node.value, env)
+		if value is None:
+			return res.fail(
+				CompilationError(
+					node.value.start_pos,
+					node.value.end_pos,
+					f"Expected a constant value for {node.symbol.symbol}.",
+					12,
+				)
+			)
 
-		self.truncate(start_pos)
 		result = env.define_symbol(node.symbol.symbol, value, "const")
 		return result
 
@@ -493,10 +1169,11 @@ class Compiler:
 		res = CompileResult()
 		location = env.assign_address
 
-		value_pos = len(self.instructions)
-		value = res.register(self.visit(node.value, env)) if node.value else None
-		if res.error:
-			return res
+		value = self.constant(node.value, env) if node.value is not None and node.length is None else None
+		if node.value is not None and value not in self.KNOWN_VALUES:
+			res.register(self.visit(node.value, env))
+			if res.error:
+				return res
 
 		if node.length is not None:
 			length = node.length
@@ -540,7 +1217,7 @@ class Compiler:
 
 		else:
 			if node.data_type == "bool":
-				if value not in (-1, 0):
+				if value is not None and value not in (-1, 0):
 					return res.fail(
 						CompilationError(
 							node.value.start_pos,
@@ -553,9 +1230,7 @@ class Compiler:
 			if res.error:
 				return res
 
-		if value or node.length is not None:
-			if value in self.KNOWN_VALUES:
-				self.truncate(value_pos)
+		if node.value is not None or node.length is not None:
 			self.load_immediate(location)
 			self.comment(node.identifier)
 			self.write(
@@ -586,17 +1261,39 @@ class Compiler:
 				)
 			)
 
-		start_pos = len(self.instructions)
-		value = res.register(self.visit(node.expr, env))
-		if res.error:
-			return res
-
 		address = res.register(env.get_symbol(node.identifier))
 		if res.error:
 			return res
 
-		if value in self.KNOWN_VALUES:
-			self.truncate(start_pos)
+		# x = x + y and x = x - y update x in place
+		expr = node.expr
+		if isinstance(expr, BinaryOperation) and str(expr.op.token_type) in ("ADD", "SUB"):
+			operand = None
+			if isinstance(expr.left, Identifier) and expr.left.symbol == node.identifier.symbol:
+				operand = self.leaf_operand(expr.right, env)
+			elif str(expr.op.token_type) == "ADD" and isinstance(expr.right, Identifier) and expr.right.symbol == node.identifier.symbol:
+				operand = self.leaf_operand(expr.left, env)
+
+			if operand is not None:
+				location, value = operand
+				subtract = str(expr.op.token_type) == "SUB"
+				if location == "A" and value in (1, -1):
+					self.load_immediate(address)
+					self.comment(node.identifier.symbol)
+					self.write("COMP M++ DM" if (value == 1) != subtract else "COMP M-- DM")
+				else:
+					self.load_immediate(value)
+					self.write(f"COMP {location} D")
+					self.load_immediate(address)
+					self.comment(node.identifier.symbol)
+					self.write("COMP M-D DM" if subtract else "COMP D+M DM")
+				return res.success(None)
+
+		value = self.constant(node.expr, env)
+		if value not in self.KNOWN_VALUES:
+			res.register(self.visit(node.expr, env))
+			if res.error:
+				return res
 
 		self.load_immediate(address)
 		self.comment(node.identifier.symbol)
@@ -611,16 +1308,40 @@ class Compiler:
 		if res.error:
 			return res
 
-		start_pos = len(self.instructions)
-		start = res.register(self.visit(node.start, env))
-		if res.error:
-			return res
-		if start in self.KNOWN_VALUES:
-			self.truncate(start_pos)
-		self.load_immediate(address, forced=True)
+		start = self.constant(node.start, env)
+		if start not in self.KNOWN_VALUES:
+			res.register(self.visit(node.start, env))
+			if res.error:
+				return res
+		self.load_immediate(address)
 		self.comment(node.identifier)
 		self.write("COMP D M" if start not in self.KNOWN_VALUES else f"COMP {start} M")
 
+		step = self.constant(node.step, env)
+		if node.step_op.token_type == TT.SUB and step is not None:
+			step = wrap(-step)
+
+		# Arrays indexed by the counter get a pointer that steps along with it
+		pointers: dict[str, int | str] = {}
+		for array in self.pointer_arrays(node, step, env):
+			pointer = res.register(self.allocate(node))
+			base_pointer = env.symbols[array]
+			if start is not None and self.MIN_IMMEDIATE <= base_pointer + start <= self.MAX_IMMEDIATE:
+				self.load_immediate(base_pointer + start)
+				self.write("COMP A D")
+			else:
+				self.load_immediate(address)
+				self.comment(node.identifier)
+				self.write("COMP M D")
+				self.load_immediate(base_pointer)
+				self.comment("Base pointer")
+				self.write("COMP D+A D")
+			self.load_immediate(pointer)
+			self.comment(f"Pointer into {array}")
+			self.write("COMP D M")
+			pointers[array] = pointer
+			self.pointers[(array, node.identifier)] = pointer
+
 		for_jmp = self.make_jump()
 		self.write(f".for{for_jmp}")
 		self.tabs += 1
@@ -629,104 +1350,130 @@ class Compiler:
 		if res.error:
 			return res
 
-		step_pos = len(self.instructions)
-		step = res.register(self.visit(node.step, env))
-		if res.error:
-			return res
-		self.comment(f"Step value (.for{for_jmp})")
-
-		# Optimizing step
-		if node.step_op.token_type == TT.ADD:
-			if step == 1:
-				self.truncate(step_pos)
-				self.load_immediate(address)
-				self.comment(node.identifier)
-				self.write("COMP M++ DM")
-			elif step == -1:
-				self.truncate(step_pos)
-				self.load_immediate(address)
-				self.comment(node.identifier)
-				self.write("COMP M-- DM")
+		for array, pointer in pointers.items():
+			if step in (1, -1):
+				self.load_immediate(pointer)
+				self.comment(f"Pointer into {array}")
+				self.write("COMP M++ M" if step == 1 else "COMP M-- M")
 			else:
-				self.write("COMP D+M DM")
-		if node.step_op.token_type == TT.SUB:
-			if step == 1:
-				self.truncate(step_pos)
-				self.load_immediate(address)
-				self.comment(node.identifier)
-				self.write("COMP M-- DM")
-			elif step == -1:
-				self.truncate(step_pos)
-				self.load_immediate(address)
-				self.comment(node.identifier)
-				self.write("COMP M++ DM")
+				self.load_immediate(step)
+				self.write("COMP A D")
+				self.load_immediate(pointer)
+				self.comment(f"Pointer into {array}")
+				self.write("COMP D+M M")
+			del self.pointers[(array, node.identifier)]
+			self.free_register(pointer)
+
+		if step in (1, -1):
+			self.load_immediate(address)
+			self.comment(node.identifier)
+			self.write("COMP M++ DM" if step == 1 else "COMP M-- DM")
+		else:
+			res.register(self.visit(node.step, env))
+			if res.error:
+				return res
+			self.load_immediate(address)
+			self.comment(f"Step value (.for{for_jmp})")
+			self.write("COMP D+M DM" if node.step_op.token_type == TT.ADD else "COMP M-D DM")
+
+		# The stepped counter is still in D
+		relation = str(node.end_op.token_type)
+		end = self.constant(node.end, env)
+		operand = self.leaf_operand(node.end, env)
+		if end == 0:
+			jump_type = f"J{relation}" # Counting down to 0, test the counter itself
+		else:
+			if operand is not None:
+				location, value = operand
+				self.load_immediate(value)
+				self.comment(f"End value (.for{for_jmp})")
+				self.write(f"COMP {location}-D D")
 			else:
-				self.write("COMP D+M DM")
-
-		end = res.register(self.visit(node.end, env))
-		if res.error:
-			return res
-		self.comment(f"End value (.for{for_jmp})")
+				res.register(self.visit(node.end, env))
+				if res.error:
+					return res
+				self.comment(f"End value (.for{for_jmp})")
 
-		self.load_immediate(address)
-		self.comment(node.identifier)
-		self.write("COMP D-M D")
+				self.load_immediate(address)
+				self.comment(node.identifier)
+				self.write("COMP D-M D")
+			jump_type = {"LT": "JGT", "LE": "JGE", "GT": "JLT", "GE": "JLE"}[relation]
 
 		self.load_immediate(f".for{for_jmp}")
-		jump_type = ""
-		match node.end_op.token_type:
-			case TT.LT:
-				jump_type = "JGT"
-			case TT.LE:
-				jump_type = "JGE"
-			case TT.GT:
-				jump_type = "JLT"
-			case TT.GE:
-				jump_type = "JLE"
-
 		self.write(f"COMP D {jump_type}")
 		self.tabs -= 1
 
 		return res.success(None)
 
+	def pointer_arrays(self, node: CForLoop, step: int | None, env: Environment) -> list[str]:
+		"""Picks the arrays a loop indexes with its counter often enough to be worth a pointer.
+		A pointer costs a step per iteration, and saves computing the address on every access."""
+		if step is None or not self.MIN_IMMEDIATE <= step <= self.MAX_IMMEDIATE:
+			return []
+
+		nodes = walk(node.body)
+		calls = any(isinstance(child, CallExpression) and child.sub_name.symbol not in env.native_subs for child in nodes)
+		if calls or node.identifier in assigned_names(node.body):
+			return [] # Only the loop may move the counter
+
+		savings: dict[str, int] = {}
+		for child in nodes:
+			if (
+				isinstance(child, (ArrayAccess, ArraySet)) and isinstance(child.array, Identifier)
+				and child.array.symbol in env.arrays
+				and isinstance(child.index, Identifier) and child.index.symbol == node.identifier
+			):
+				savings[child.array.symbol] = savings.get(child.array.symbol, 0) + (6 if isinstance(child, ArraySet) else 2)
+
+		cost = 2 if step in (1, -1) else 4
+		return [array for array, saved in savings.items() if saved > cost]
+
 	def visitWhileLoop(self, node: WhileLoop, env: Environment) -> CompileResult:
 		res = CompileResult()
 
+		# The condition sits after the body, so each iteration takes a single jump back
 		while_jmp = self.make_jump()
+		self.load_immediate(f".whilecond{while_jmp}")
+		self.write("COMP 0 JMP")
 		self.write(f".while{while_jmp}")
 		self.tabs += 1
 
-		res.register(self.visit(node.condition, env))
-		if res.error:
-			return res
-		self.load_immediate(f".endwhile{while_jmp}")
-		self.write("COMP D JLE")
-
 		res.register(self.visit(node.body, env))
 		if res.error:
 			return res
 
-		self.load_immediate(f".while{while_jmp}")
-		self.write("COMP 0 JMP")
 		self.tabs -= 1
-		self.write(f".endwhile{while_jmp}")
+		self.write(f".whilecond{while_jmp}")
+		# Other conditions keep looping while they're positive
+		res.register(self.branch(node.condition, f".while{while_jmp}", True, env, "JGT"))
+		if res.error:
+			return res
 		return res.success(None)
 
 	def visitIfStatement(self, node: IfStatement, env: Environment) -> CompileResult:
 		res = CompileResult()
 
+		selected = self.select(node, env)
+		if selected is not None:
+			return selected
+		dispatched = self.jump_table(node, env)
+		if dispatched is not None:
+			return dispatched
+
 		end_jmp = self.make_jump()
 
-		for condition, body in node.cases:
-			res.register(self.visit(condition, env))
+		# The last arm doesn't jump over the others, so the hot one goes there
+		cases, else_case, swapped = node.cases, node.else_case, False
+		if len(cases) == 1 and else_case is not None and self.colder(else_case, cases[0][1]):
+			cases, else_case, swapped = [(cases[0][0], else_case)], cases[0][1], True
+
+		for condition, body in cases:
+			if_jmp = self.make_jump()
+			res.register(self.branch(condition, f".if{if_jmp}", swapped, env))
 			if res.error:
 				return res
 
-			if_jmp = self.make_jump()
-			self.load_immediate(f".if{if_jmp}")
 			self.tabs += 1
-
-			self.write("COMP D JEQ")
 			res.register(self.visit(body, env))
 			if res.error:
 				return res
@@ -736,9 +1483,9 @@ class Compiler:
 			self.tabs -= 1
 			self.write(f".if{if_jmp}")
 
-		if node.else_case:
+		if else_case:
 			self.tabs += 1
-			res.register(self.visit(node.else_case, env))
+			res.register(self.visit(else_case, env))
 			if res.error:
 				return res
 			self.tabs -= 1
@@ -746,15 +1493,197 @@ class Compiler:
 		self.write(f".endif{end_jmp}")
 		return res.success(None)
 
-	def visitArrayAccess(self, node: ArrayAccess, env: Environment):
+	def colder(self, first: Statements, second: Statements) -> bool:
+		"""Whether one arm of an if statement is expected to run less often than the other:
+		the one that ran less often in the profile, or else an arm that halts, which runs at most once."""
+		counts = self.arm_counts([first, second])
+		if counts is not None:
+			# Being last saves an arm its jump to the end, and one starting with a while loop its jump to
+			# the condition too, since the branch to the arm can then go straight there
+			saved = [count * (2 if isinstance(arm.body[0], WhileLoop) else 1) for arm, count in zip([first, second], counts)]
+			return saved[0] < saved[1]
+		return halts(first) and not halts(second)
+
+	def arm_counts(self, arms: list[Statements]) -> list[int] | None:
+		"""Returns how many times each arm ran according to the profile, or None if it doesn't know."""
+		if self.profile is None or not all(arm.body for arm in arms):
+			return None
+		counts = [self.profile.count(arm.body[0]) for arm in arms]
+		return None if None in counts else counts
+
+	def select(self, node: IfStatement, env: Environment) -> CompileResult | None:
+		"""If-converts an if statement picking one of the two values it compares, such as
+		`if x > y { r = y } else { r = x }`. With d = x - y left in D by the comparison, the
+		result is x - d or y + d when the condition holds and x or y otherwise, so a single
+		conditional jump over `COMP 0 D` replaces the branches. Returns None if the statement
+		doesn't have that shape or the branches would be cheaper."""
+		if len(node.cases) != 1:
+			return None
+		condition, body = node.cases[0]
+		if (
+			not isinstance(condition, BinaryOperation) or str(condition.op.token_type) not in self.COMPARISONS
+			or self.constant(condition, env) is not None
+		):
+			return None
+		operands = [self.leaf_operand(condition.left, env), self.leaf_operand(condition.right, env)]
+		if None in operands:
+			return None
+
+		# Both arms assign to the same variable, or both are the value of the statement
+		arms = [body.body] + ([node.else_case.body] if node.else_case else [])
+		if any(len(arm) != 1 for arm in arms):
+			return None
+		statements = [arm[0] for arm in arms]
+		if all(isinstance(statement, Assignment) for statement in statements):
+			target = statements[0].identifier
+			if any(statement.identifier.symbol != target.symbol for statement in statements):
+				return None
+			values = [statement.expr for statement in statements]
+			if node.else_case is None:
+				values.append(target) # Without an else, the variable keeps its value
+		elif node.else_case is not None and not any(isinstance(statement, Assignment) for statement in statements):
+			target = None
+			values = statements
+		else:
+			return None
+
+		destination = None if target is None else self.leaf_operand(target, env)
+		if target is not None and (destination is None or destination[0] != "M"):
+			return None
+		picked = [self.leaf_operand(value, env) for value in values]
+		if picked not in ([operands[1], operands[0]], [operands[0], operands[1]]):
+			return None
+
+		# Words of each arm and of the jumps around them, against the select
+		def cost(statement) -> int:
+			if isinstance(statement, Assignment):
+				return 2 if self.constant(statement.expr, env) in self.KNOWN_VALUES else 4
+			return 2
+		selecting = 5 + (0 if target is None else 2)
+		taken = 2 + cost(statements[0]) + (2 if node.else_case else 0)
+		skipped = 2 + (cost(statements[1]) if node.else_case else 0)
+
+		# With a profile, weigh the cycles each side takes by how often it ran instead
+		counts = self.arm_counts([body] + ([node.else_case] if node.else_case else []))
+		if counts is not None and node.else_case is None:
+			total = self.profile.count(node)
+			counts = None if total is None else [counts[0], total - counts[0]]
+		if counts is not None and sum(counts) > 0:
+			if selecting * sum(counts) >= taken * counts[0] + skipped * counts[1]:
+				return None
+		elif selecting >= taken + skipped - 2:
+			return None
+
 		res = CompileResult()
+		res.register(self.difference(condition, env))
+		if res.error:
+			return res
+
+		jmp = self.make_jump()
+		self.load_immediate(f".select{jmp}")
+		self.write(f"COMP D J{condition.op.token_type}")
+		self.write("COMP 0 D")
+		self.write(f".select{jmp}")
+		if picked[0] == operands[1]:
+			self.operate("SUB", *operands[0], condition.left, reversed=True)
+		else:
+			self.operate("ADD", *operands[1], condition.right)
+
+		if target is not None:
+			self.load_immediate(destination[1])
+			self.comment(target.symbol)
+			self.write("COMP D M")
+		return res.success(None)
+
+	def jump_table(self, node: IfStatement, env: Environment) -> CompileResult | None:
+		"""Compiles an if/elseif chain testing one variable for equality with dense constants into a
+		bounds check and a jump through a table of jumps, one per value between the smallest and the
+		largest case. Entries take two words, so the offset is added to A twice. Returns None if the
+		chain doesn't have that shape or is too short or sparse for the table to pay off."""
+		if len(node.cases) < self.MIN_TABLE_CASES:
+			return None
+
+		subject = None
+		values: list[int] = []
+		for condition, _ in node.cases:
+			if not isinstance(condition, BinaryOperation) or str(condition.op.token_type) != "EQ":
+				return None
+			value = self.constant(condition.right, env)
+			variable = condition.left
+			if value is None:
+				value, variable = self.constant(condition.left, env), condition.right
+			if value is None or not isinstance(variable, Identifier) or subject not in (None, variable.symbol):
+				return None
+			subject = variable.symbol
+			values.append(value)
+
+		operand = self.leaf_operand(variable, env)
+		low, high = min(values), max(values)
+		if (
+			operand is None or operand[0] != "M" or 2 * len(set(values)) < high - low + 1
+			or not self.MIN_IMMEDIATE <= high - low <= self.MAX_IMMEDIATE
+			or not self.MIN_IMMEDIATE <= low <= self.MAX_IMMEDIATE
+		):
+			return None
+
+		res = CompileResult()
+		jmp = self.make_jump()
+		default = f".default{jmp}" if node.else_case else f".endif{jmp}"
+		targets: dict[int, str] = {}
+		for i, value in enumerate(values):
+			targets.setdefault(value, f".case{jmp}_{i}") # The first matching case wins
 
-		base_pos = len(self.instructions)
-		base_pointer = res.register(self.visit(node.array, env))
+		res.register(self.visit(variable, env))
 		if res.error:
 			return res
+		if low != 0:
+			self.load_immediate(low)
+			self.write("COMP D-A D")
+		self.load_immediate(default)
+		self.write("COMP D JLT")
+		self.load_immediate(high - low)
+		self.write("COMP D-A D")
+		self.load_immediate(default)
+		self.write("COMP D JGT")
+
+		# D is now the value minus the largest case, so index back from the last entry
+		self.load_immediate(f".table{jmp}_{high - low}")
+		self.write("COMP D+A A")
+		self.write("COMP D+A A")
+		self.write("COMP 0 JMP")
+		for offset in range(high - low + 1):
+			self.write(f".table{jmp}_{offset}")
+			self.load_immediate(targets.get(low + offset, default))
+			self.write("COMP 0 JMP")
+
+		# The default goes first so that no entry jumps to the line right after the table
+		bodies = ([(default, node.else_case)] if node.else_case else []) + [
+			(f".case{jmp}_{i}", body) for i, (_, body) in enumerate(node.cases)
+		]
+		for i, (label, body) in enumerate(bodies):
+			self.write(label)
+			self.tabs += 1
+			res.register(self.visit(body, env))
+			if res.error:
+				return res
+			if i < len(bodies) - 1:
+				self.load_immediate(f".endif{jmp}")
+				self.write("COMP 0 JMP")
+			self.tabs -= 1
+
+		self.write(f".endif{jmp}")
+		return res.success(None)
+
+	def array_location(self, node: ArrayAccess | ArraySet, env: Environment) -> CompileResult:
+		"""Finds the base pointer of an indexed array and checks a constant index against its bounds.
+		The index is None when it isn't constant."""
+		res = CompileResult()
 
 		if isinstance(node.array, Identifier):
+			base_pointer = res.register(env.get_symbol(node.array))
+			if res.error:
+				return res
+
 			if node.array.symbol not in env.arrays:
 				return res.fail(
 					CompilationError(
@@ -764,15 +1693,14 @@ class Compiler:
 						7,
 					)
 				)
+			length = env.arrays[node.array.symbol] - base_pointer
+		else:
+			base_pointer = res.register(self.visit(node.array, env))
+			if res.error:
+				return res
+			length = len(node.array.elements)
 
-			self.truncate(base_pos)
-
-		index_pos = len(self.instructions)
-		index = res.register(self.visit(node.index, env))
-		if res.error:
-			return res
-
-		# Error-checking
+		index = self.constant(node.index, env)
 		if index is not None:
 			if index < 0:
 				return res.fail(
@@ -783,34 +1711,47 @@ class Compiler:
 						9,
 					)
 				)
-			if isinstance(node.array, ArrayLiteral):
-				if index >= len(node.array.elements):
-					return res.fail(
-						CompilationError(
-							node.index.start_pos,
-							node.index.end_pos,
-							f"Out of bounds: index must be less than {len(node.array.elements)}.",
-							9,
-						)
-					)
-			else:
-				address: int = env.arrays[node.array.symbol]
-				if index >= address - base_pointer:
-					return res.fail(
-						CompilationError(
-							node.index.start_pos,
-							node.index.end_pos,
-							f"Out of bounds: index must be less than {address - base_pointer}.",
-							9,
-						)
+			if index >= length:
+				return res.fail(
+					CompilationError(
+						node.index.start_pos,
+						node.index.end_pos,
+						f"Out of bounds: index must be less than {length}.",
+						9,
 					)
+				)
 
-		if index == 0:
-			self.truncate(index_pos)
+		return res.success((base_pointer, index))
 
-		self.load_immediate(base_pointer, forced=True)
-		self.comment("Base pointer")
-		if index != 0:
+	def pointer(self, node: ArrayAccess | ArraySet) -> int | str | None:
+		"""Returns the slot pointing at an element, if a loop keeps one for it."""
+		if isinstance(node.array, Identifier) and isinstance(node.index, Identifier):
+			return self.pointers.get((node.array.symbol, node.index.symbol))
+		return None
+
+	def visitArrayAccess(self, node: ArrayAccess, env: Environment):
+		res = CompileResult()
+
+		location = res.register(self.array_location(node, env))
+		if res.error:
+			return res
+		base_pointer, index = location
+
+		pointer = self.pointer(node)
+		if pointer is not None:
+			self.load_immediate(pointer)
+			self.comment(f"Pointer into {node.array.symbol}")
+			self.write("COMP M A")
+		elif index is not None:
+			self.load_immediate(base_pointer + index)
+			self.comment(f"Element {index}")
+		else:
+			res.register(self.visit(node.index, env))
+			if res.error:
+				return res
+
+			self.load_immediate(base_pointer)
+			self.comment("Base pointer")
 			self.write("COMP D+A A")
 		self.write("COMP M D")
 
@@ -819,69 +1760,42 @@ class Compiler:
 	def visitArraySet(self, node: ArraySet, env: Environment):
 		res = CompileResult()
 
-		base_pos = len(self.instructions)
-		base_pointer = res.register(self.visit(node.array, env))
+		location = res.register(self.array_location(node, env))
 		if res.error:
 			return res
+		base_pointer, index = location
 
-		if isinstance(node.array, Identifier):
-			if node.array.symbol not in env.arrays:
-				return res.fail(
-					CompilationError(
-						node.array.start_pos,
-						node.array.end_pos,
-						f"Undefined array: {node.array.symbol}",
-						7,
-					)
-				)
+		if index is not None:
+			value = self.constant(node.value, env)
+			if value not in self.KNOWN_VALUES:
+				res.register(self.visit(node.value, env))
+				if res.error:
+					return res
+
+			self.load_immediate(base_pointer + index)
+			self.comment(f"Element {index}")
+			self.write("COMP D M" if value not in self.KNOWN_VALUES else f"COMP {value} M")
+			return res.success(None)
+
+		pointer = self.pointer(node)
+		if pointer is not None:
+			res.register(self.visit(node.value, env))
+			if res.error:
+				return res
 
-			self.truncate(base_pos)
+			self.load_immediate(pointer)
+			self.comment(f"Pointer into {node.array.symbol}")
+			self.write("COMP M A")
+			self.write("COMP D M")
+			return res.success(None)
 
-		index_pos = len(self.instructions)
-		index = res.register(self.visit(node.index, env))
+		res.register(self.visit(node.index, env))
 		if res.error:
 			return res
 
-		# Error-checking... again
-		if index is not None:
-			if index < 0:
-				return res.fail(
-					CompilationError(
-						node.index.start_pos,
-						node.index.end_pos,
-						"Out of bounds: index must be at least 0.",
-						9,
-					)
-				)
-			if isinstance(node.array, ArrayLiteral):
-				if index >= len(node.array.elements):
-					return res.fail(
-						CompilationError(
-							node.index.start_pos,
-							node.index.end_pos,
-							f"Out of bounds: index must be less than {len(node.array.elements)}.",
-							9,
-						)
-					)
-			else:
-				address: int = env.arrays[node.array.symbol]
-				if index >= address - base_pointer:
-					return res.fail(
-						CompilationError(
-							node.index.start_pos,
-							node.index.end_pos,
-							f"Out of bounds: index must be less than {address - base_pointer}.",
-							9,
-						)
-					)
-
-		if index == 0:
-			self.truncate(index_pos)
-
-		self.load_immediate(base_pointer, forced=True)
+		self.load_immediate(base_pointer)
 		self.comment("Base pointer")
-		if index != 0:
-			self.write("COMP D+A D")
+		self.write("COMP D+A D")
 		pointer_reg = res.register(self.allocate(node.index))
 		if res.error:
 			return res
@@ -893,35 +1807,40 @@ class Compiler:
 		if res.error:
 			return res
 
-		self.load_immediate(pointer_reg, forced=True)
+		self.load_immediate(pointer_reg)
 		self.write("COMP M A")
 		self.write("COMP D M")
+		self.free_register(pointer_reg)
 		return res.success(None)
 
 	def visitSubroutineDef(self, node: SubroutineDef, env: Environment):
 		res = CompileResult()
 
-		for param in node.parameters:
-			location = env.assign_address
-			res.register(env.define_symbol(param, location, "var"))
-			if res.error:
-				return res
-
-		self.visitIntLiteral(IntLiteral(len(node.parameters), None, None), env)
-		self.comment(f"{len(node.parameters)} params")
+		res.register(env.define_parameters(node))
+		if res.error:
+			return res
 
-		location = env.assign_address
 		res.register(
-			env.define_symbol(node.name, (location, len(node.parameters)), "sub")
+			env.define_symbol(node.name, (env.assign_address, len(node.parameters)), "sub")
 		)
 		if res.error:
 			return res
 
-		self.load_immediate(location, forced=True)
-		self.write("COMP D M")
-
 		return res.success(None)
 
+	@staticmethod
+	def tail_position(body: Statements) -> list[CallExpression]:
+		"""Finds the calls a body ends with, including the ones ending the arms of a final if statement."""
+		if not body.body:
+			return []
+		last = body.body[-1]
+		if isinstance(last, CallExpression):
+			return [last]
+		if isinstance(last, IfStatement):
+			arms = [case for _, case in last.cases] + ([last.else_case] if last.else_case else [])
+			return [call for arm in arms for call in Compiler.tail_position(arm)]
+		return []
+
 	def visitCallExpression(self, node: CallExpression, env: Environment):
 		res = CompileResult()
 		symb = node.sub_name.symbol
@@ -954,17 +1873,43 @@ class Compiler:
 			)
 
 		if symb in env.subroutines:
-			# Populate arguments
+			tail = id(node) in self.tail_calls
+			parameters = set(env.parameters[symb])
+			staged = tail and symb == self.subroutine and len(node.arguments) > 1 and any(
+				isinstance(child, Identifier) and child.symbol in parameters
+				for arg in node.arguments for child in walk(arg)
+			)
+
+			# Populate arguments. A call to the subroutine itself from its tail overwrites the
+			# parameters its arguments read, so those are worked out before storing any
+			staging: list[int | str] = []
 			for i, arg in enumerate(node.arguments):
 				res.register(self.visit(arg, env))
 				if res.error:
 					return res
 
+				if staged:
+					staging.append(res.register(self.allocate(arg)))
+					self.load_immediate(staging[-1])
+				else:
+					self.load_immediate(address - args + i)
+					self.comment(f"arg_{i}")
+				self.write("COMP D M")
+
+			for i, register in enumerate(staging):
+				self.load_immediate(register)
+				self.write("COMP M D")
 				self.load_immediate(address - args + i)
 				self.comment(f"arg_{i}")
 				self.write("COMP D M")
+				self.free_register(register)
 
-			self.write(f"CALL .sub_{symb}")
+			if tail:
+				# The callee returns straight to our caller, and a call to ourselves becomes a loop
+				self.load_immediate(f".sub_{symb}")
+				self.write("COMP 0 JMP")
+			else:
+				self.write(f"CALL .sub_{symb}")
 		else:
 			match symb:
 				case "update":
@@ -974,32 +1919,20 @@ class Compiler:
 				case "halt":
 					self.write("HALT")
 				case "plot":
-					pos = len(self.instructions)
-					x = res.register(self.visit(node.arguments[0], env))
-					if res.error:
-						return res
-					self.load_immediate(self.X_ADDR)
-					self.comment("X Port")
-					if x in self.KNOWN_VALUES:
-						self.truncate(pos)
-						self.write(f"COMP {x} M")
-					else:
-						self.write("COMP D M")
-
-					y = res.register(self.visit(node.arguments[1], env))
-					if res.error:
-						return res
-					self.load_immediate(self.Y_ADDR)
-					self.comment("Y Port")
-					if y in self.KNOWN_VALUES:
-						self.truncate(pos)
-						self.write(f"COMP {y} M")
-					else:
-						self.write("COMP D M")
-
-					val = res.register(self.visit(node.arguments[2], env))
-					if res.error:
-						return res
+					for argument, port, name in (
+						(node.arguments[0], self.X_ADDR, "X Port"), (node.arguments[1], self.Y_ADDR, "Y Port")
+					):
+						value = self.constant(argument, env)
+						if value not in self.KNOWN_VALUES:
+							res.register(self.visit(argument, env))
+							if res.error:
+								return res
+
+						self.load_immediate(port)
+						self.comment(name)
+						self.write(f"COMP {value if value in self.KNOWN_VALUES else 'D'} M")
+
+					val = self.constant(node.arguments[2], env)
 					if val not in (0, 1):
 						return res.fail(
 							CompilationError(
@@ -57,7 +57,7 @@ class Environment(QMainWindow):
 			
 			if "include operations" in result:
 				self.xsharp_text_highlighter.highlighting_rules[4] = (QRegularExpression(
-					r"(\+|-|\*|/|&|\||~|\^|=|:|#|\$)"
+					r"(\+|-|\*|/|%|&|\||~|\^|=|:|#|\$)"
 				), getattr(self.xsharp_text_highlighter, "operation_format"))
 			else:
 				self.xsharp_text_highlighter.highlighting_rules[4] = (QRegularExpression(
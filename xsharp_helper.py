@@ -51,8 +51,9 @@ class InvalidSyntax(Error):
 
 # Occurs when an error occurs during the compilation process.
 class CompilationError(Error):
-	def __init__(self, start_pos: Position, end_pos: Position, details: str):
+	def __init__(self, start_pos: Position, end_pos: Position, details: str, code: int = 0):
 		super().__init__(start_pos, end_pos, "Compilation Error", details)
+		self.code = code
 
 # A general-purpose syntax highlighter.
 class SyntaxHighlighter(QSyntaxHighlighter):
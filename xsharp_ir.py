@@ -0,0 +1,1561 @@
+from xsharp_parser import *
+from xsharp_compiler import CompileResult, Environment, Compiler
+from xsharp_helper import CompilationError
+from xsharp_optimizer import constant_value, halts
+
+# A three-address intermediate representation sitting between the X# AST and XAssembly.
+# Programs are made of functions, functions of basic blocks, and basic blocks of
+# instructions operating on virtual temporaries, integer constants and RAM slots.
+
+BINARY_OPS = {
+	"ADD": "add", "SUB": "sub",
+	"AND": "and", "OR": "or", "XOR": "xor",
+	"MUL": "mul", "DIV": "div", "MOD": "mod", "LSHIFT": "lshift", "RSHIFT": "rshift",
+	"LT": "lt", "LE": "le", "EQ": "eq", "NE": "ne", "GT": "gt", "GE": "ge",
+}
+UNARY_OPS = {
+	"SUB": "neg", "NOT": "not", "INC": "inc", "DEC": "dec", "ABS": "abs", "SIGN": "sign",
+}
+COMPARISONS = ("lt", "le", "eq", "ne", "gt", "ge")
+LOGICAL = ("LAND", "LOR")
+RELATIONS = ("LT", "LE", "EQ", "NE", "GT", "GE")
+INVERSE_RELATIONS = {
+	"LT": "GE", "LE": "GT", "EQ": "NE", "NE": "EQ", "GT": "LE", "GE": "LT",
+}
+
+## OPERANDS
+class Temp:
+	def __init__(self, index: int):
+		self.index = index
+
+	def __repr__(self):
+		return f"%t{self.index}"
+
+def format_operand(operand: "Temp | int | None") -> str:
+	return "_" if operand is None else f"{operand}"
+
+def format_address(address: "Temp | int") -> str:
+	return f"[{address}]"
+
+## INSTRUCTIONS
+class Instruction:
+	is_terminator: bool = False
+
+	def defs(self) -> list[Temp]:
+		return [self.dest] if getattr(self, "dest", None) is not None else []
+
+	def uses(self) -> list[Temp]:
+		return [operand for operand in self.operands() if isinstance(operand, Temp)]
+
+	def operands(self) -> list:
+		return []
+
+	def targets(self) -> list[str]:
+		return []
+
+class Move(Instruction):
+	def __init__(self, dest: Temp, value: Temp | int):
+		self.dest = dest
+		self.value = value
+
+	def operands(self):
+		return [self.value]
+
+	def __repr__(self):
+		return f"{self.dest} = {self.value}"
+
+class BinOp(Instruction):
+	def __init__(self, dest: Temp, op: str, left: Temp | int, right: Temp | int):
+		self.dest = dest
+		self.op = op
+		self.left = left
+		self.right = right
+
+	def operands(self):
+		return [self.left, self.right]
+
+	def __repr__(self):
+		return f"{self.dest} = {self.op} {self.left}, {self.right}"
+
+class UnOp(Instruction):
+	def __init__(self, dest: Temp, op: str, value: Temp | int):
+		self.dest = dest
+		self.op = op
+		self.value = value
+
+	def operands(self):
+		return [self.value]
+
+	def __repr__(self):
+		return f"{self.dest} = {self.op} {self.value}"
+
+class Load(Instruction):
+	def __init__(self, dest: Temp, address: Temp | int, comment: str = ""):
+		self.dest = dest
+		self.address = address
+		self.comment = comment
+
+	def operands(self):
+		return [self.address]
+
+	def __repr__(self):
+		comment = f" // {self.comment}" if self.comment else ""
+		return f"{self.dest} = load {format_address(self.address)}{comment}"
+
+class Store(Instruction):
+	def __init__(self, address: Temp | int, value: Temp | int, comment: str = ""):
+		self.address = address
+		self.value = value
+		self.comment = comment
+
+	def operands(self):
+		return [self.address, self.value]
+
+	def __repr__(self):
+		comment = f" // {self.comment}" if self.comment else ""
+		return f"store {format_address(self.address)}, {self.value}{comment}"
+
+class Call(Instruction):
+	def __init__(self, dest: Temp | None, sub: str):
+		self.dest = dest
+		self.sub = sub
+
+	def __repr__(self):
+		if self.dest is None:
+			return f"call {self.sub}"
+		return f"{self.dest} = call {self.sub}"
+
+class Plot(Instruction):
+	def __init__(self, x: Temp | int, y: Temp | int, value: int):
+		self.x = x
+		self.y = y
+		self.value = value
+
+	def operands(self):
+		return [self.x, self.y]
+
+	def __repr__(self):
+		return f"plot {self.x}, {self.y}, {self.value}"
+
+class Buffer(Instruction):
+	def __init__(self, mode: str):
+		self.mode = mode
+
+	def __repr__(self):
+		return f"bufr {self.mode}"
+
+## TERMINATORS
+class Jump(Instruction):
+	is_terminator = True
+
+	def __init__(self, target: str):
+		self.target = target
+
+	def targets(self):
+		return [self.target]
+
+	def __repr__(self):
+		return f"jump {self.target}"
+
+class Branch(Instruction):
+	"""Branches to `true_target` if `value` compared to 0 satisfies `relation`."""
+	is_terminator = True
+
+	def __init__(self, value: Temp | int, relation: str, true_target: str, false_target: str):
+		self.value = value
+		self.relation = relation
+		self.true_target = true_target
+		self.false_target = false_target
+
+	def operands(self):
+		return [self.value]
+
+	def targets(self):
+		return [self.true_target, self.false_target]
+
+	def __repr__(self):
+		return f"branch {self.relation.lower()} {self.value}, {self.true_target}, {self.false_target}"
+
+class Return(Instruction):
+	is_terminator = True
+
+	def __init__(self, value: Temp | int | None):
+		self.value = value
+
+	def operands(self):
+		return [self.value] if self.value is not None else []
+
+	def __repr__(self):
+		return f"return {format_operand(self.value)}"
+
+class Halt(Instruction):
+	is_terminator = True
+
+	def __init__(self, value: Temp | int | None):
+		self.value = value
+
+	def operands(self):
+		return [self.value] if self.value is not None else []
+
+	def __repr__(self):
+		return f"halt {format_operand(self.value)}"
+
+## CONTAINERS
+class BasicBlock:
+	def __init__(self, label: str):
+		self.label = label
+		self.instructions: list[Instruction] = []
+
+	@property
+	def terminator(self) -> Instruction | None:
+		if self.instructions and self.instructions[-1].is_terminator:
+			return self.instructions[-1]
+		return None
+
+	def successors(self) -> list[str]:
+		return self.terminator.targets() if self.terminator else []
+
+	def __repr__(self):
+		return f"BasicBlock[{self.label}]"
+
+class Function:
+	def __init__(self, name: str, parameters: list[int]):
+		self.name = name
+		self.parameters = parameters # RAM slots of the parameters
+		self.blocks: list[BasicBlock] = []
+
+	@property
+	def is_main(self) -> bool:
+		return self.name == "main"
+
+	def block(self, label: str) -> BasicBlock:
+		for block in self.blocks:
+			if block.label == label:
+				return block
+		raise KeyError(label)
+
+class Program:
+	def __init__(self):
+		self.functions: list[Function] = []
+		self.temps: int = 0
+		self.ram_base: int = 16 # First RAM slot after all variables
+
+	def new_temp(self) -> Temp:
+		self.temps += 1
+		return Temp(self.temps - 1)
+
+## TEXTUAL DUMP
+def dump(program: Program, costs: dict[str, int] | None = None) -> str:
+	"""Returns a human-readable listing of the program.
+	If `costs` maps block labels to emitted instruction counts, each block is annotated with its count."""
+	lines: list[str] = []
+
+	for function in program.functions:
+		lines.append(f"sub {function.name}({', '.join(f'[{p}]' for p in function.parameters)}):")
+		for block in function.blocks:
+			cost = f" // {costs[block.label]} words" if costs and block.label in costs else ""
+			lines.append(f"  {block.label}:{cost}")
+			for instruction in block.instructions:
+				lines.append(f"    {instruction}")
+		lines.append("")
+
+	return "\n".join(lines)
+
+## VERIFIER
+def verify(program: Program) -> list[str]:
+	"""Checks the structural invariants of the IR, returning a list of problems (empty if valid)."""
+	problems: list[str] = []
+	sub_names = {function.name for function in program.functions}
+
+	for function in program.functions:
+		labels: set[str] = set()
+		defined: set[int] = set()
+
+		if not function.blocks:
+			problems.append(f"{function.name}: function has no blocks.")
+			continue
+
+		for block in function.blocks:
+			if block.label in labels:
+				problems.append(f"{function.name}: duplicate block label {block.label}.")
+			labels.add(block.label)
+
+			for instruction in block.instructions:
+				for temp in instruction.defs():
+					defined.add(temp.index)
+
+		# Temps defined on every path into each block, starting from the entry block
+		entering: dict[str, set[int]] = {block.label: set(defined) for block in function.blocks}
+		entering[function.blocks[0].label] = set()
+		reached: set[str] = {function.blocks[0].label}
+		changed = True
+		while changed:
+			changed = False
+			for block in function.blocks:
+				if block.label not in reached:
+					continue
+				leaving = entering[block.label] | {
+					temp.index for instruction in block.instructions for temp in instruction.defs()
+				}
+				for target in block.successors():
+					if target not in entering:
+						continue
+					narrowed = entering[target] & leaving
+					if target not in reached or narrowed != entering[target]:
+						entering[target] = narrowed
+						reached.add(target)
+						changed = True
+
+		for block in function.blocks:
+			where = f"{function.name}.{block.label}"
+			available = entering[block.label]
+
+			if block.terminator is None:
+				problems.append(f"{where}: block does not end with a terminator.")
+
+			for i, instruction in enumerate(block.instructions):
+				if instruction.is_terminator and i != len(block.instructions) - 1:
+					problems.append(f"{where}: terminator '{instruction}' is not the last instruction.")
+
+				for operand in instruction.operands():
+					if not isinstance(operand, (Temp, int)):
+						problems.append(f"{where}: invalid operand {operand!r} in '{instruction}'.")
+				for temp in instruction.uses():
+					if temp.index not in defined:
+						problems.append(f"{where}: {temp} is used but never defined.")
+					elif block.label in reached and temp.index not in available:
+						problems.append(f"{where}: {temp} is used on a path that doesn't define it.")
+				available = available | {temp.index for temp in instruction.defs()}
+
+				for target in instruction.targets():
+					if target not in labels:
+						problems.append(f"{where}: jump to unknown block {target}.")
+
+				match instruction:
+					case BinOp() if instruction.op not in BINARY_OPS.values():
+						problems.append(f"{where}: unknown binary operation {instruction.op}.")
+					case UnOp() if instruction.op not in UNARY_OPS.values():
+						problems.append(f"{where}: unknown unary operation {instruction.op}.")
+					case Branch() if instruction.relation not in RELATIONS:
+						problems.append(f"{where}: unknown relation {instruction.relation}.")
+					case Plot() if instruction.value not in (0, 1):
+						problems.append(f"{where}: plot value must be 0 or 1.")
+					case Call() if instruction.sub not in sub_names:
+						problems.append(f"{where}: call to unknown subroutine {instruction.sub}.")
+					case Return() if function.is_main:
+						problems.append(f"{where}: return outside of a subroutine.")
+					case Halt() if not function.is_main and instruction.value is not None:
+						problems.append(f"{where}: halt inside a subroutine cannot carry a value.")
+
+	return problems
+
+## BUILDER
+class IRBuilder:
+	"""Translates an X# AST into IR. Every intermediate value gets a fresh temporary."""
+
+	def build(self, ast: Statements) -> CompileResult:
+		res = CompileResult()
+		env = Environment()
+
+		self.program = Program()
+		self.labels: int = 0
+
+		for sub in ast.subroutine_defs:
+			res.register(self.define_subroutine(sub, env))
+			if res.error:
+				return res
+
+		main = self.new_function("main", [])
+		value = res.register(self.visit(ast, env))
+		if res.error:
+			return res
+		self.emit(Halt(value))
+
+		for sub in ast.subroutine_defs:
+			address = env.symbols[sub.name]
+			parameters = [address - len(sub.parameters) + i for i in range(len(sub.parameters))]
+
+			self.new_function(sub.name, parameters)
+			env.enter_subroutine(sub.name)
+			value = res.register(self.visit(sub.body, env))
+			env.exit_subroutine()
+			if res.error:
+				return res
+			self.emit(Return(value))
+
+		self.program.functions.sort(key=lambda function: not function.is_main)
+		self.program.ram_base = env.assign_address
+		return res.success(self.program)
+
+	def new_function(self, name: str, parameters: list[int]) -> Function:
+		self.function = Function(name, parameters)
+		self.program.functions.append(self.function)
+		self.start_block("entry")
+		return self.function
+
+	def new_label(self, hint: str) -> str:
+		self.labels += 1
+		return f"{hint}{self.labels - 1}"
+
+	def start_block(self, hint: str, label: str | None = None) -> BasicBlock:
+		self.block = BasicBlock(label or self.new_label(hint))
+		self.function.blocks.append(self.block)
+		return self.block
+
+	def emit(self, instruction: Instruction) -> None:
+		if self.block.terminator is not None:
+			self.start_block("dead") # Code after a terminator is unreachable
+		self.block.instructions.append(instruction)
+
+	def temp(self) -> Temp:
+		return self.program.new_temp()
+
+	def visit(self, node, env: Environment):
+		method_name = f"visit{type(node).__name__}"
+		method = getattr(self, method_name, self.no_visit_method)
+		return method(node, env)
+
+	def no_visit_method(self, node, env: Environment):
+		return CompileResult().fail(
+			CompilationError(
+				node.start_pos,
+				node.end_pos,
+				f"Undefined visit{type(node).__name__} method.",
+				0,
+			)
+		)
+
+	def constant(self, node, env: Environment) -> int | None:
+		"""Evaluates a constant expression, or returns None if it isn't one."""
+		constants = {symbol: env.symbols[symbol] for symbol in env.constants + list(env.arrays)}
+		return constant_value(node, constants)
+
+	def visitStatements(self, node: Statements, env: Environment) -> CompileResult:
+		res = CompileResult()
+		value = None
+
+		for stmt in node.body:
+			value = res.register(self.visit(stmt, env))
+			if res.error:
+				return res
+
+		return res.success(value)
+
+	def visitIntLiteral(self, node: IntLiteral, env: Environment) -> CompileResult:
+		return CompileResult().success(node.value)
+
+	def visitArrayLiteral(self, node: ArrayLiteral, env: Environment) -> CompileResult:
+		res = CompileResult()
+		base_pointer = env.assign_address
+		env.assign_address += len(node.elements)
+
+		for i, element in enumerate(node.elements):
+			value = res.register(self.visit(element, env))
+			if res.error:
+				return res
+			self.emit(Store(base_pointer + i, value, f"array[{i}]"))
+
+		return res.success(base_pointer)
+
+	def visitIdentifier(self, node: Identifier, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		value: int = res.register(env.get_symbol(node))
+		if res.error:
+			return res
+
+		if node.symbol in env.constants or node.symbol in env.arrays:
+			return res.success(value)
+
+		dest = self.temp()
+		self.emit(Load(dest, value, node.symbol))
+		return res.success(dest)
+
+	def visitBinaryOperation(self, node: BinaryOperation, env: Environment) -> CompileResult:
+		res = CompileResult()
+		operation: str = str(node.op.token_type)
+
+		if operation in LOGICAL:
+			value = self.constant(node, env)
+			if value is not None:
+				return res.success(value)
+
+			# Branch on the operands like a condition would, then set the result on each side
+			result = self.temp()
+			true_label, false_label, end_label = self.new_label("true"), self.new_label("false"), self.new_label("end")
+			res.register(self.branch(node, "NE", true_label, false_label, env))
+			if res.error:
+				return res
+			self.start_block("true", true_label)
+			self.emit(Move(result, -1))
+			self.emit(Jump(end_label))
+			self.start_block("false", false_label)
+			self.emit(Move(result, 0))
+			self.emit(Jump(end_label))
+			self.start_block("end", end_label)
+			return res.success(result)
+
+		if operation not in BINARY_OPS:
+			return res.fail(
+				CompilationError(
+					node.op.start_pos,
+					node.op.end_pos,
+					f"Unsupported binary operator: {operation}",
+					2,
+				)
+			)
+
+		left = res.register(self.visit(node.left, env))
+		if res.error:
+			return res
+		right = res.register(self.visit(node.right, env))
+		if res.error:
+			return res
+
+		dest = self.temp()
+		self.emit(BinOp(dest, BINARY_OPS[operation], left, right))
+		return res.success(dest)
+
+	def visitUnaryOperation(self, node: UnaryOperation, env: Environment) -> CompileResult:
+		res = CompileResult()
+		operation: str = str(node.op.token_type)
+
+		if operation == "AT":
+			return env.get_symbol(node.value)
+
+		value = res.register(self.visit(node.value, env))
+		if res.error:
+			return res
+
+		if operation == "ADD":
+			return res.success(value)
+
+		if operation not in UNARY_OPS:
+			return res.fail(
+				CompilationError(
+					node.op.start_pos,
+					node.op.end_pos,
+					f"Unsupported unary operator: {operation}",
+					2,
+				)
+			)
+
+		dest = self.temp()
+		self.emit(UnOp(dest, UNARY_OPS[operation], value))
+		return res.success(dest)
+
+	def visitConstDefinition(self, node: ConstDefinition, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		value = self.constant(node.value, env)
+		if value is None:
+			return res.fail(
+				CompilationError(
+					node.value.start_pos,
+					node.value.end_pos,
+					"Expected a constant expression.",
+					5,
+				)
+			)
+
+		res.register(env.define_symbol(node.symbol.symbol, value, "const"))
+		if res.error:
+			return res
+		return res.success(None)
+
+	def visitVarDeclaration(self, node: VarDeclaration, env: Environment) -> CompileResult:
+		res = CompileResult()
+		location = env.assign_address
+
+		if node.length is None:
+			value = None
+			if node.value is not None:
+				if node.data_type == "bool" and self.constant(node.value, env) not in (-1, 0):
+					return res.fail(
+						CompilationError(
+							node.value.start_pos,
+							node.value.end_pos,
+							"Expected a boolean, found an integer instead.",
+							5,
+						)
+					)
+				value = res.register(self.visit(node.value, env))
+				if res.error:
+					return res
+
+			res.register(env.define_symbol(node.identifier, location, "var"))
+			if res.error:
+				return res
+
+			if value is not None:
+				self.emit(Store(location, value, node.identifier))
+			return res.success(None)
+
+		length = node.length
+		if isinstance(node.length, str):
+			if node.length not in env.constants:
+				return res.fail(
+					CompilationError(
+						node.start_pos,
+						node.end_pos,
+						f"Undefined constant: {node.length}",
+						7,
+					)
+				)
+			length = res.register(env.get_symbol(node.length))
+
+		if node.value is None:
+			env.assign_address += length
+		else:
+			if not isinstance(node.value, ArrayLiteral) or length != len(node.value.elements):
+				count = len(node.value.elements) if isinstance(node.value, ArrayLiteral) else 1
+				return res.fail(
+					CompilationError(
+						node.start_pos,
+						node.end_pos,
+						f"Expected {length} elements, got {count} elements instead.",
+						8,
+					)
+				)
+			res.register(self.visit(node.value, env))
+			if res.error:
+				return res
+
+		res.register(env.define_symbol(node.identifier, (location, env.assign_address), "array"))
+		if res.error:
+			return res
+		return res.success(None)
+
+	def visitAssignment(self, node: Assignment, env: Environment) -> CompileResult:
+		res = CompileResult()
+		symbol = node.identifier.symbol
+
+		if symbol in env.constants or symbol in env.subroutines:
+			kind = "constant" if symbol in env.constants else "subroutine"
+			return res.fail(
+				CompilationError(
+					node.identifier.start_pos,
+					node.identifier.end_pos,
+					f"Cannot assign to {kind} {symbol}.",
+					6,
+				)
+			)
+
+		value = res.register(self.visit(node.expr, env))
+		if res.error:
+			return res
+
+		address = res.register(env.get_symbol(node.identifier))
+		if res.error:
+			return res
+
+		self.emit(Store(address, value, symbol))
+		return res.success(value)
+
+	def element_address(self, node: ArrayAccess | ArraySet, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		if isinstance(node.array, Identifier) and node.array.symbol not in env.arrays:
+			return res.fail(
+				CompilationError(
+					node.array.start_pos,
+					node.array.end_pos,
+					f"Undefined array: {node.array.symbol}",
+					7,
+				)
+			)
+
+		base_pointer = res.register(self.visit(node.array, env))
+		if res.error:
+			return res
+
+		length = (
+			len(node.array.elements) if isinstance(node.array, ArrayLiteral)
+			else env.arrays[node.array.symbol] - base_pointer
+		)
+
+		index = res.register(self.visit(node.index, env))
+		if res.error:
+			return res
+
+		if isinstance(index, int):
+			if index < 0:
+				return res.fail(
+					CompilationError(
+						node.index.start_pos,
+						node.index.end_pos,
+						"Out of bounds: index must be at least 0.",
+						9,
+					)
+				)
+			if index >= length:
+				return res.fail(
+					CompilationError(
+						node.index.start_pos,
+						node.index.end_pos,
+						f"Out of bounds: index must be less than {length}.",
+						9,
+					)
+				)
+			return res.success(base_pointer + index)
+
+		address = self.temp()
+		self.emit(BinOp(address, "add", index, base_pointer))
+		return res.success(address)
+
+	def visitArrayAccess(self, node: ArrayAccess, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		address = res.register(self.element_address(node, env))
+		if res.error:
+			return res
+
+		dest = self.temp()
+		self.emit(Load(dest, address))
+		return res.success(dest)
+
+	def visitArraySet(self, node: ArraySet, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		address = res.register(self.element_address(node, env))
+		if res.error:
+			return res
+
+		value = res.register(self.visit(node.value, env))
+		if res.error:
+			return res
+
+		self.emit(Store(address, value))
+		return res.success(value)
+
+	def visitCForLoop(self, node: CForLoop, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		address = res.register(env.get_symbol(node.identifier))
+		if res.error:
+			return res
+
+		start = res.register(self.visit(node.start, env))
+		if res.error:
+			return res
+		self.emit(Store(address, start, node.identifier))
+
+		body = self.new_label("for")
+		self.emit(Jump(body))
+		self.start_block("for", body)
+
+		res.register(self.visit(node.body, env))
+		if res.error:
+			return res
+
+		# Step, then loop while the end condition holds
+		step = res.register(self.visit(node.step, env))
+		if res.error:
+			return res
+		counter = self.temp()
+		self.emit(Load(counter, address, node.identifier))
+		stepped = self.temp()
+		self.emit(BinOp(stepped, "add" if node.step_op.token_type == TT.ADD else "sub", counter, step))
+		self.emit(Store(address, stepped, node.identifier))
+
+		exit_label = self.new_label("endfor")
+		if constant_value(node.end, {}) == 0:
+			# Counting down to 0, test the counter itself
+			self.emit(Branch(stepped, str(node.end_op.token_type), body, exit_label))
+		else:
+			end = res.register(self.visit(node.end, env))
+			if res.error:
+				return res
+			remaining = self.temp()
+			self.emit(BinOp(remaining, "sub", end, stepped))
+
+			relation = {TT.LT: "GT", TT.LE: "GE", TT.GT: "LT", TT.GE: "LE"}[node.end_op.token_type]
+			self.emit(Branch(remaining, relation, body, exit_label))
+		self.start_block("endfor", exit_label)
+
+		return res.success(None)
+
+	def visitWhileLoop(self, node: WhileLoop, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		header = self.new_label("while")
+		body = self.new_label("whilebody")
+		exit_label = self.new_label("endwhile")
+
+		# The header follows the body, so each iteration takes a single branch back
+		self.emit(Jump(header))
+		self.start_block("whilebody", body)
+		res.register(self.visit(node.body, env))
+		if res.error:
+			return res
+		self.emit(Jump(header))
+
+		self.start_block("while", header)
+		# Other conditions keep looping while they're positive
+		res.register(self.branch(node.condition, "GT", body, exit_label, env))
+		if res.error:
+			return res
+
+		self.start_block("endwhile", exit_label)
+		return res.success(None)
+
+	def visitIfStatement(self, node: IfStatement, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		# The statement has a value only if every path through it does, so it needs an else
+		result = self.temp()
+		has_result = node.else_case is not None
+		end_label = self.new_label("endif")
+
+		# The last arm falls through to the end, so an arm that halts goes first
+		cases, else_case, swapped = node.cases, node.else_case, False
+		if len(cases) == 1 and else_case is not None and halts(else_case) and not halts(cases[0][1]):
+			cases, else_case, swapped = [(cases[0][0], else_case)], cases[0][1], True
+
+		for condition, body in cases:
+			then_label = self.new_label("then")
+			next_label = self.new_label("if")
+			targets = (next_label, then_label) if swapped else (then_label, next_label)
+			res.register(self.branch(condition, "NE", *targets, env))
+			if res.error:
+				return res
+
+			self.start_block("then", then_label)
+			value = res.register(self.visit(body, env))
+			if res.error:
+				return res
+			if value is None:
+				has_result = False
+			else:
+				self.emit(Move(result, value))
+			self.emit(Jump(end_label))
+
+			self.start_block("if", next_label)
+
+		if else_case:
+			value = res.register(self.visit(else_case, env))
+			if res.error:
+				return res
+			if value is None:
+				has_result = False
+			else:
+				self.emit(Move(result, value))
+		self.emit(Jump(end_label))
+
+		self.start_block("endif", end_label)
+		return res.success(result if has_result else None)
+
+	def boolean(self, node) -> bool:
+		"""Whether an expression always evaluates to -1 or 0."""
+		if isinstance(node, UnaryOperation):
+			return str(node.op.token_type) == "NOT" and self.boolean(node.value)
+		return isinstance(node, BinaryOperation) and str(node.op.token_type) in RELATIONS + LOGICAL
+
+	def branch(self, node, relation: str, true_target: str, false_target: str, env: Environment) -> CompileResult:
+		"""Ends the block with branches to `true_target` if a condition holds and `false_target`
+		otherwise. && and || only evaluate their right operand in a block of its own, reached when
+		the left one doesn't decide the result, and ~ of a boolean swaps the targets."""
+		res = CompileResult()
+		operation = str(node.op.token_type) if isinstance(node, (UnaryOperation, BinaryOperation)) else None
+
+		if self.constant(node, env) is None:
+			if operation == "NOT" and self.boolean(node.value):
+				return self.branch(node.value, "NE", false_target, true_target, env)
+
+			if operation in LOGICAL:
+				middle = self.new_label("and" if operation == "LAND" else "or")
+				targets = (middle, false_target) if operation == "LAND" else (true_target, middle)
+				res.register(self.branch(node.left, "NE", *targets, env))
+				if res.error:
+					return res
+				self.start_block("and" if operation == "LAND" else "or", middle)
+				return self.branch(node.right, "NE", true_target, false_target, env)
+
+		value = self.constant(node, env)
+		if value is not None and self.boolean(node):
+			# Holds when it's true, like any other comparison, whatever `relation` tests other values with
+			self.emit(Jump(true_target if value != 0 else false_target))
+			return res.success(None)
+
+		test = res.register(self.condition(node, relation, env))
+		if res.error:
+			return res
+		self.emit(Branch(*test, true_target, false_target))
+		return res.success(None)
+
+	def condition(self, node, relation: str, env: Environment) -> CompileResult:
+		"""Evaluates a branch condition to a value and the relation to 0 it holds with. Comparisons
+		and their negations branch on the difference of their operands instead of a boolean;
+		anything else holds with `relation`."""
+		res = CompileResult()
+
+		negated = isinstance(node, UnaryOperation) and str(node.op.token_type) == "NOT"
+		comparison = node.value if negated else node
+		if (
+			isinstance(comparison, BinaryOperation) and str(comparison.op.token_type) in BINARY_OPS
+			and BINARY_OPS[str(comparison.op.token_type)] in COMPARISONS and self.constant(comparison, env) is None
+		):
+			left = res.register(self.visit(comparison.left, env))
+			if res.error:
+				return res
+			right = res.register(self.visit(comparison.right, env))
+			if res.error:
+				return res
+
+			relation = str(comparison.op.token_type)
+			if negated:
+				relation = INVERSE_RELATIONS[relation]
+			if right == 0:
+				return res.success((left, relation))
+			difference = self.temp()
+			self.emit(BinOp(difference, "sub", left, right))
+			return res.success((difference, relation))
+
+		value = res.register(self.visit(node, env))
+		if res.error:
+			return res
+		return res.success((value, relation))
+
+	def define_subroutine(self, node: SubroutineDef, env: Environment) -> CompileResult:
+		res = CompileResult()
+
+		res.register(env.define_parameters(node))
+		if res.error:
+			return res
+
+		res.register(env.define_symbol(node.name, (env.assign_address, len(node.parameters)), "sub"))
+		if res.error:
+			return res
+		return res.success(None)
+
+	def visitCallExpression(self, node: CallExpression, env: Environment) -> CompileResult:
+		res = CompileResult()
+		symb = node.sub_name.symbol
+
+		address = res.register(env.get_symbol(node.sub_name))
+		if res.error:
+			return res
+
+		if (symb not in env.subroutines) and (symb not in env.native_subs):
+			return res.fail(
+				CompilationError(
+					node.start_pos,
+					node.end_pos,
+					f"Symbol {symb} is not a subroutine.",
+					10,
+				)
+			)
+
+		args = env.subroutines[symb] if symb in env.subroutines else env.native_subs[symb]
+		if args != len(node.arguments):
+			return res.fail(
+				CompilationError(
+					node.start_pos,
+					node.end_pos,
+					f"Expected {args} arguments, got {len(node.arguments)} arguments instead.",
+					11,
+				)
+			)
+
+		values = []
+		for arg in node.arguments:
+			values.append(res.register(self.visit(arg, env)))
+			if res.error:
+				return res
+
+		match symb:
+			case "update":
+				self.emit(Buffer("update"))
+			case "flip":
+				self.emit(Buffer("move"))
+			case "halt":
+				self.emit(Halt(None))
+			case "plot":
+				if values[2] not in (0, 1):
+					return res.fail(
+						CompilationError(
+							node.arguments[2].start_pos,
+							node.arguments[2].end_pos,
+							"Expected 0 or 1.",
+							5,
+						)
+					)
+				self.emit(Plot(values[0], values[1], values[2]))
+			case _:
+				for i, value in enumerate(values):
+					self.emit(Store(address - args + i, value, f"arg_{i}"))
+				dest = self.temp()
+				self.emit(Call(dest, symb))
+				return res.success(dest)
+
+		return res.success(None)
+
+## REGISTER ALLOCATION
+class Allocation:
+	"""Where every temporary lives: in the D register, straight in a variable's slot, or in a RAM slot of its own."""
+
+	def __init__(self):
+		self.in_d: set[int] = set()
+		self.memory: dict[int, int] = {} # Loads folded into their uses
+		self.slots: dict[int, int] = {}
+
+	def home(self, temp: Temp) -> int:
+		return self.memory[temp.index] if temp.index in self.memory else self.slots[temp.index]
+
+class LinearScanAllocator:
+	"""Allocates temporaries with a linear scan over their live intervals.
+
+	A temporary used only by the next instruction stays in D, and a load whose
+	variable is not written before its uses is read straight from the variable.
+	Everything else gets a slot, reused once its interval ends. Slots come from
+	r4 - r15 first and spill into the RAM after the variables. Functions never
+	share slots, since a caller's temporaries must survive its callees."""
+	REGISTERS = tuple(range(4, 16)) # r0 - r3 are scratch slots for the lowering
+
+	def allocate(self, program: Program) -> Allocation:
+		self.allocation = Allocation()
+		self.pool: list[int] = list(self.REGISTERS)
+		self.next_spill: int = program.ram_base
+
+		for function in program.functions:
+			self.allocate_function(function)
+
+		return self.allocation
+
+	def new_slot(self) -> int:
+		if self.pool:
+			return self.pool.pop(0)
+		self.next_spill += 1
+		return self.next_spill - 1
+
+	def allocate_function(self, function: Function) -> None:
+		positions: list[tuple[BasicBlock, int, Instruction]] = []
+		bounds: dict[str, tuple[int, int]] = {}
+		defs: dict[int, list[int]] = {}
+		uses: dict[int, list[int]] = {}
+
+		for block in function.blocks:
+			start = len(positions)
+			for instruction in block.instructions:
+				for temp in instruction.defs():
+					defs.setdefault(temp.index, []).append(len(positions))
+				for temp in instruction.uses():
+					uses.setdefault(temp.index, []).append(len(positions))
+				positions.append((block, len(positions), instruction))
+			bounds[block.label] = (start, len(positions) - 1)
+
+		block_of = lambda position: positions[position][0]
+		handled: set[int] = set()
+
+		for temp, def_positions in defs.items():
+			use_positions = uses.get(temp, [])
+			if len(def_positions) != 1 or not use_positions:
+				continue
+			definition = def_positions[0]
+			instruction = positions[definition][2]
+
+			# Fold loads from a fixed address into their uses
+			if isinstance(instruction, Load) and isinstance(instruction.address, int):
+				if all(block_of(use) is block_of(definition) and use > definition for use in use_positions):
+					clobbered = any(
+						self.clobbers(positions[i][2], instruction.address)
+						for i in range(definition + 1, max(use_positions))
+					)
+					if not clobbered:
+						self.allocation.memory[temp] = instruction.address
+						handled.add(temp)
+						continue
+
+			# Keep values consumed by the very next instruction in D
+			if (
+				len(use_positions) == 1 and use_positions[0] == definition + 1
+				and block_of(definition) is block_of(definition + 1)
+			):
+				self.allocation.in_d.add(temp)
+				handled.add(temp)
+
+		intervals = self.intervals(function, positions, bounds, defs, uses, handled)
+
+		# Linear scan
+		free: list[int] = []
+		active: list[tuple[int, int]] = [] # (end, slot)
+		for start, end, temp in sorted(intervals):
+			for interval in [interval for interval in active if interval[0] <= start]:
+				active.remove(interval)
+				free.append(interval[1])
+
+			slot = free.pop(0) if free else self.new_slot()
+			self.allocation.slots[temp] = slot
+			active.append((end, slot))
+
+	def clobbers(self, instruction: Instruction, address: int) -> bool:
+		"""Whether an instruction may write to a fixed RAM address."""
+		if isinstance(instruction, Store):
+			return not isinstance(instruction.address, int) or instruction.address == address
+		return isinstance(instruction, Call)
+
+	def intervals(self, function, positions, bounds, defs, uses, handled) -> list[tuple[int, int, int]]:
+		"""Computes a conservative live interval for every temporary that needs a slot."""
+		gen: dict[str, set[int]] = {}
+		kill: dict[str, set[int]] = {}
+		for block in function.blocks:
+			gen[block.label], kill[block.label] = set(), set()
+			for instruction in block.instructions:
+				gen[block.label] |= {temp.index for temp in instruction.uses()} - kill[block.label]
+				kill[block.label] |= {temp.index for temp in instruction.defs()}
+
+		live_in: dict[str, set[int]] = {block.label: set() for block in function.blocks}
+		live_out: dict[str, set[int]] = {block.label: set() for block in function.blocks}
+		changed = True
+		while changed:
+			changed = False
+			for block in reversed(function.blocks):
+				out: set[int] = set()
+				for successor in block.successors():
+					out |= live_in[successor]
+				new_in = gen[block.label] | (out - kill[block.label])
+				if out != live_out[block.label] or new_in != live_in[block.label]:
+					live_out[block.label], live_in[block.label] = out, new_in
+					changed = True
+
+		ranges: dict[int, list[int]] = {}
+		for temp in set(defs) | set(uses):
+			if temp not in handled:
+				points = defs.get(temp, []) + uses.get(temp, [])
+				ranges[temp] = [min(points), max(points)]
+
+		for label, (start, end) in bounds.items():
+			for temp in live_in[label]:
+				if temp in ranges:
+					ranges[temp][0] = min(ranges[temp][0], start)
+			for temp in live_out[label]:
+				if temp in ranges:
+					ranges[temp][1] = max(ranges[temp][1], end)
+
+		return [(start, end, temp) for temp, (start, end) in ranges.items()]
+
+## LOWERING
+# `operate` expressions with the operands swapped, once the operand is in D and the D register in M
+SWAPPED = {"D+X": "D+M", "D-X": "M-D", "X-D": "D-M", "D&X": "D&M", "D|X": "D|M", "D^X": "D^M"}
+
+class IRLowering:
+	"""Turns IR into XAssembly, placing temporaries with a LinearScanAllocator."""
+	SCRATCH = ("r0", "r1", "r2", "r3") # RAM slots used by multi-instruction sequences
+	RUNTIME = tuple(range(Compiler.MAX_RAM_ADDR, Compiler.MAX_RAM_ADDR - 5, -1)) # RAM slots used by the runtime routines
+
+	def __init__(self, runtime_library: bool = False):
+		# Calls the shared runtime routines instead of inlining them, trading cycles for PROM
+		self.runtime_library: bool = runtime_library
+
+	def lower(self, program: Program) -> list[str]:
+		self.instructions: list[str] = []
+		self.runtime: set[str] = set()
+		self.allocation = LinearScanAllocator().allocate(program)
+		self.jumps: int = 0
+		self.block_costs: dict[str, int] = {}
+
+		for function in program.functions:
+			if not function.is_main:
+				self.write(f".sub_{function.name}")
+				self.comment(f"{len(function.parameters)} params")
+
+			for i, block in enumerate(function.blocks):
+				following = function.blocks[i + 1].label if i + 1 < len(function.blocks) else None
+				start = len(self.instructions)
+
+				if i > 0:
+					self.write(f".{block.label}")
+				for j, instruction in enumerate(block.instructions):
+					following_instruction = block.instructions[j + 1] if j + 1 < len(block.instructions) else None
+					if (
+						isinstance(instruction, Call) and isinstance(following_instruction, Return)
+						and following_instruction.value is not None and following_instruction.value == instruction.dest
+					):
+						# A tail call, the callee returns straight to our caller
+						self.write(f"LDIA .sub_{instruction.sub}")
+						self.write("COMP 0 JMP")
+						break
+					self.lower_instruction(instruction, following)
+
+				self.block_costs[block.label] = sum(
+					not line.startswith(".") for line in self.instructions[start:]
+				)
+
+		if "mul" in self.runtime:
+			self.instructions += Compiler.multiply_routine(*self.RUNTIME[:3])
+		if "div" in self.runtime:
+			self.instructions += Compiler.divide_routine(*self.RUNTIME)
+
+		return self.instructions
+
+	def write(self, instruction: str) -> None:
+		self.instructions.append(instruction)
+
+	def comment(self, comment: str) -> None:
+		self.instructions[-1] += f" // {comment}"
+
+	def make_jump(self) -> int:
+		self.jumps += 1
+		return self.jumps - 1
+
+	def in_d(self, operand: Temp | int) -> bool:
+		return isinstance(operand, Temp) and operand.index in self.allocation.in_d
+
+	def load(self, operand: Temp | int) -> None:
+		"""Loads an operand into the D register."""
+		if self.in_d(operand):
+			return
+		if isinstance(operand, Temp):
+			self.write(f"LDIA {self.allocation.home(operand)}")
+			self.write("COMP M D")
+		elif operand in Compiler.KNOWN_VALUES:
+			self.write(f"COMP {operand} D")
+		elif Compiler.MIN_IMMEDIATE <= operand <= Compiler.MAX_IMMEDIATE:
+			self.write(f"LDIA {operand}")
+			self.write("COMP A D")
+		else:
+			# Too wide for LDIA: load the top bits, then double them back into place and add the rest
+			shift = 1 if Compiler.MIN_IMMEDIATE * 2 <= operand <= Compiler.MAX_IMMEDIATE * 2 else 2
+			self.write(f"LDIA {operand >> shift}")
+			self.write("COMP A D")
+			for _ in range(shift):
+				self.write("COMP D A")
+				self.write("COMP D+A D")
+			if operand & ((1 << shift) - 1):
+				self.write(f"LDIA {operand & ((1 << shift) - 1)}")
+				self.write("COMP D+A D")
+
+	def store(self, temp: Temp) -> None:
+		"""Stores the D register into a temporary."""
+		if self.in_d(temp):
+			return
+		self.write(f"LDIA {self.allocation.home(temp)}")
+		self.write("COMP D M")
+
+	def operate(self, expr: str, operand: Temp | int) -> None:
+		"""Computes `expr` on the D register and an operand, where X stands for the operand."""
+		if isinstance(operand, Temp):
+			self.write(f"LDIA {self.allocation.home(operand)}")
+			self.write(f"COMP {expr.replace('X', 'M')} D")
+		elif Compiler.MIN_IMMEDIATE <= operand <= Compiler.MAX_IMMEDIATE:
+			self.write(f"LDIA {operand}")
+			self.write(f"COMP {expr.replace('X', 'A')} D")
+		else:
+			# Build the wide constant in D, with the other operand set aside
+			self.write(f"LDIA {self.SCRATCH[0]}")
+			self.write("COMP D M")
+			self.load(operand)
+			self.write(f"LDIA {self.SCRATCH[0]}")
+			self.write(f"COMP {SWAPPED[expr]} D")
+
+	def point(self, address: Temp | int) -> None:
+		"""Points the A register at a RAM address without touching D."""
+		if isinstance(address, Temp):
+			self.write(f"LDIA {self.allocation.home(address)}")
+			self.write("COMP M A")
+		else:
+			self.write(f"LDIA {address}")
+
+	def lower_instruction(self, instruction: Instruction, following: str | None) -> None:
+		match instruction:
+			case Move():
+				self.load(instruction.value)
+				self.store(instruction.dest)
+
+			case Load():
+				if instruction.dest.index in self.allocation.memory:
+					return # Read straight from the variable by its uses
+				if self.in_d(instruction.address):
+					self.write("COMP D A")
+				else:
+					self.point(instruction.address)
+				if instruction.comment:
+					self.comment(instruction.comment)
+				self.write("COMP M D")
+				self.store(instruction.dest)
+
+			case Store():
+				if self.in_d(instruction.address):
+					if instruction.value in Compiler.KNOWN_VALUES:
+						self.write("COMP D A")
+						self.write(f"COMP {instruction.value} M")
+						return
+					self.write(f"LDIA {self.SCRATCH[0]}")
+					self.write("COMP D M")
+					self.load(instruction.value)
+					self.write(f"LDIA {self.SCRATCH[0]}")
+					self.write("COMP M A")
+				elif instruction.value in Compiler.KNOWN_VALUES:
+					self.point(instruction.address)
+					if instruction.comment:
+						self.comment(instruction.comment)
+					self.write(f"COMP {instruction.value} M")
+					return
+				else:
+					self.load(instruction.value)
+					self.point(instruction.address)
+				if instruction.comment:
+					self.comment(instruction.comment)
+				self.write("COMP D M")
+
+			case BinOp():
+				self.lower_binop(instruction)
+
+			case UnOp():
+				self.load(instruction.value)
+				self.lower_unop(instruction.op)
+				self.store(instruction.dest)
+
+			case Call():
+				self.write(f"CALL .sub_{instruction.sub}")
+				if instruction.dest is not None:
+					self.store(instruction.dest)
+
+			case Plot():
+				ports = [(instruction.x, Compiler.X_ADDR, "X Port"), (instruction.y, Compiler.Y_ADDR, "Y Port")]
+				if self.in_d(instruction.y):
+					ports.reverse()
+				for value, port, name in ports:
+					self.load(value)
+					self.write(f"LDIA {port}")
+					self.comment(name)
+					self.write("COMP D M")
+				self.write(f"PLOT {instruction.value}")
+
+			case Buffer():
+				self.write(f"BUFR {instruction.mode}")
+
+			case Jump():
+				if instruction.target != following:
+					self.write(f"LDIA .{instruction.target}")
+					self.write("COMP 0 JMP")
+
+			case Branch():
+				self.load(instruction.value)
+				if instruction.true_target == following:
+					self.write(f"LDIA .{instruction.false_target}")
+					self.write(f"COMP D J{INVERSE_RELATIONS[instruction.relation]}")
+				else:
+					self.write(f"LDIA .{instruction.true_target}")
+					self.write(f"COMP D J{instruction.relation}")
+					if instruction.false_target != following:
+						self.write(f"LDIA .{instruction.false_target}")
+						self.write("COMP 0 JMP")
+
+			case Return():
+				if instruction.value is not None:
+					self.load(instruction.value)
+				self.write("RETN")
+
+			case Halt():
+				if instruction.value is not None:
+					self.load(instruction.value)
+				self.write("HALT")
+
+	def lower_binop(self, instruction: BinOp) -> None:
+		op, left, right = instruction.op, instruction.left, instruction.right
+		reversed = False
+
+		if self.in_d(right) and op in ("add", "sub", "and", "or", "xor", *COMPARISONS):
+			# Work on the operand already in D, swapping commutative operations
+			left, right = right, left
+			reversed = op not in ("add", "and", "or", "xor", "eq", "ne")
+
+		match op:
+			case "add" | "sub" | "and" | "or" | "xor":
+				self.load(left)
+				self.operate({
+					"add": "D+X", "sub": "X-D" if reversed else "D-X",
+					"and": "D&X", "or": "D|X", "xor": "D^X",
+				}[op], right)
+
+			case "lt" | "le" | "eq" | "ne" | "gt" | "ge":
+				jmp = self.make_jump()
+				self.load(left)
+				if right != 0 or reversed:
+					self.operate("X-D" if reversed else "D-X", right)
+				self.write(f"LDIA .cmp_true{jmp}")
+				self.write(f"COMP D J{op.upper()}")
+				self.write("COMP 0 D")
+				self.write(f"LDIA .cmp_end{jmp}")
+				self.write("COMP 0 JMP")
+				self.write(f".cmp_true{jmp}")
+				self.write("COMP -1 D")
+				self.write(f".cmp_end{jmp}")
+
+			case "lshift" | "rshift":
+				self.lower_shift(op, left, right)
+
+			case "div" | "mod":
+				self.lower_divide(op, left, right)
+
+			case "mul":
+				if isinstance(left, int):
+					left, right = right, left
+				if isinstance(right, int):
+					self.lower_constant_multiply(left, right)
+				else:
+					self.lower_multiply(left, right)
+
+		self.store(instruction.dest)
+
+	def spill(self, values: list[tuple[Temp | int, str]]) -> None:
+		"""Stores operands into scratch slots, starting with whichever one is already in D."""
+		values.sort(key=lambda value: not self.in_d(value[0]))
+		for value, slot in values:
+			self.load(value)
+			self.write(f"LDIA {slot}")
+			self.write("COMP D M")
+
+	def lower_shift(self, op: str, value: Temp | int, amount: Temp | int) -> None:
+		operation = "LSHIFT" if op == "lshift" else "RSHIFT"
+		if isinstance(amount, int):
+			self.load(value)
+			for line in Compiler.shift_constant(f"shift{self.make_jump()}", operation, amount):
+				self.write(line)
+			return
+
+		shift, count = self.SCRATCH[:2]
+		if self.in_d(amount):
+			self.spill([(amount, count), (value, shift)])
+			self.write(f"LDIA {count}")
+			self.write("COMP M D")
+		else:
+			self.spill([(value, shift)])
+			self.load(amount)
+		for line in Compiler.shift_loop(f"shift{self.make_jump()}", operation, shift, count):
+			self.write(line)
+
+	def lower_constant_multiply(self, value: Temp | int, factor: int) -> None:
+		"""Multiplies by a constant with doublings, additions and subtractions."""
+		steps = Compiler.multiplication_steps(factor)
+		address, save = None, False
+		if "add" in steps or "sub" in steps:
+			if isinstance(value, Temp) and not self.in_d(value):
+				address = self.allocation.home(value)
+			else:
+				address, save = self.SCRATCH[0], True
+
+		self.load(value)
+		for line in Compiler.multiplication_code(steps, address, save):
+			self.write(line)
+
+	def lower_multiply(self, left: Temp | int, right: Temp | int) -> None:
+		if self.runtime_library:
+			# The routine takes one operand in D, and reads the other from RAM
+			if self.in_d(right):
+				left, right = right, left
+			self.spill([(left, self.RUNTIME[0])])
+			self.load(right)
+			self.write("CALL .__mul")
+			self.runtime.add("mul")
+			return
+
+		multiplicand, multiplier, product = self.SCRATCH[:3]
+		self.spill([(left, multiplicand), (right, multiplier)])
+		for line in Compiler.multiply_loop(f"mul{self.make_jump()}", multiplicand, multiplier, product):
+			self.write(line)
+
+	def lower_divide(self, op: str, left: Temp | int, right: Temp | int) -> None:
+		if isinstance(right, int) and Compiler.power_of_two(right) is not None:
+			self.load(left)
+			for line in Compiler.divide_power_of_two(f"div{self.make_jump()}", right, op == "mod"):
+				self.write(line)
+			return
+
+		dividend, divisor = self.RUNTIME[:2]
+		self.spill([(left, dividend), (right, divisor)])
+		self.write("CALL .__div")
+		self.runtime.add("div")
+		if op == "mod":
+			self.write(f"LDIA {dividend}")
+			self.write("COMP M D")
+
+	def lower_unop(self, op: str) -> None:
+		match op:
+			case "neg":
+				self.write("COMP -D D")
+			case "not":
+				self.write("COMP !D D")
+			case "inc":
+				self.write("COMP D++ D")
+			case "dec":
+				self.write("COMP D-- D")
+			case "abs":
+				jmp = self.make_jump()
+				self.write(f"LDIA .abs{jmp}")
+				self.write("COMP D JGE")
+				self.write("COMP -D D")
+				self.write(f".abs{jmp}")
+			case "sign":
+				jmp = self.make_jump()
+				self.write(f"LDIA .sign_neg{jmp}")
+				self.write("COMP D JLT")
+				self.write(f"LDIA .sign_end{jmp}")
+				self.write("COMP D JEQ")
+				self.write("COMP 1 D")
+				self.write("COMP 0 JMP")
+				self.write(f".sign_neg{jmp}")
+				self.write("COMP -1 D")
+				self.write(f".sign_end{jmp}")
+
+def fold_returns(program: Program) -> None:
+	"""
+	Returns straight from blocks that jump to a block doing nothing but return,
+	like the arms of an if statement ending a subroutine. A call whose value is
+	returned right away can then jump to the callee instead.
+	"""
+	for function in program.functions:
+		if function.is_main:
+			continue
+
+		returns = {
+			block.label: block.instructions[0] for block in function.blocks
+			if len(block.instructions) == 1 and isinstance(block.instructions[0], Return)
+		}
+
+		# The move into the returned temp can only go if every way into the return block makes it
+		def moves_value(block: BasicBlock, value) -> bool:
+			return (
+				isinstance(block.terminator, Jump) and len(block.instructions) >= 2
+				and isinstance(block.instructions[-2], Move) and block.instructions[-2].dest is value
+			)
+		folded = {
+			label for label, ret in returns.items()
+			if ret.value is not None and all(
+				moves_value(block, ret.value) for block in function.blocks if label in block.successors()
+			)
+		}
+
+		for block in function.blocks:
+			jump = block.terminator
+			if not isinstance(jump, Jump) or jump.target not in returns:
+				continue
+
+			value = returns[jump.target].value
+			body = block.instructions[:-1]
+			if jump.target in folded:
+				value = body.pop().value
+			block.instructions = body + [Return(value)]
+
+		# Drop the return blocks nothing reaches anymore
+		targets = {target for block in function.blocks for target in block.successors()}
+		function.blocks = [
+			block for i, block in enumerate(function.blocks)
+			if i == 0 or block.label in targets or block.label not in returns
+		]
+
+def compile_ir(ast: Statements, runtime_library: bool = False) -> CompileResult:
+	"""Compiles an AST to XAssembly through the IR."""
+	res = CompileResult()
+
+	program = res.register(IRBuilder().build(ast))
+	if res.error:
+		return res
+	fold_returns(program)
+
+	problems = verify(program)
+	if problems:
+		return res.fail(CompilationError(ast.start_pos, ast.end_pos, "Invalid IR:\n" + "\n".join(problems), 0))
+
+	return res.success(IRLowering(runtime_library).lower(program))
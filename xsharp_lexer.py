@@ -19,13 +19,13 @@ DATA_TYPES = [
 class TT(Enum):
 	LT, LE, EQ, NE, GT, GE,\
 	ADD, SUB, INC, DEC,\
-	AND, OR, NOT, XOR,\
+	AND, OR, NOT, XOR, LAND, LOR,\
 	LPR, RPR, LBR, RBR, LSQ, RSQ,\
 	COL, ASSIGN, COMMA,\
-	MUL, DIV, RSHIFT, LSHIFT,\
+	MUL, DIV, MOD, RSHIFT, LSHIFT,\
 	ABS, SIGN, AT,\
 	NUM, IDENTIFIER, KEYWORD, NEWLINE, EOF\
-	= range(35)
+	= range(38)
 
 	def __str__(self):
 		return super().__str__().removeprefix("TT.")
@@ -151,15 +151,21 @@ class Lexer:
 				self.advance()
 				tokens.append(Token(start_pos, self.pos, TT.NEWLINE, char))
 			
-			elif self.current_char == "&": # Bitwise AND
+			elif self.current_char == "&":
 				start_pos = self.pos.copy()
 				self.advance()
-				tokens.append(Token(start_pos, self.pos, TT.AND))
+				if self.current_char == "&": # Logical AND
+					self.advance()
+					tokens.append(Token(start_pos, self.pos, TT.LAND))
+				else: tokens.append(Token(start_pos, self.pos, TT.AND)) # Bitwise AND
 			
-			elif self.current_char == "|": # Bitwise OR
+			elif self.current_char == "|":
 				start_pos = self.pos.copy()
 				self.advance()
-				tokens.append(Token(start_pos, self.pos, TT.OR))
+				if self.current_char == "|": # Logical OR
+					self.advance()
+					tokens.append(Token(start_pos, self.pos, TT.LOR))
+				else: tokens.append(Token(start_pos, self.pos, TT.OR)) # Bitwise OR
 			
 			elif self.current_char == "~": # Bitwise NOT
 				start_pos = self.pos.copy()
@@ -311,6 +317,11 @@ class Lexer:
 				self.advance()
 				tokens.append(Token(start_pos, self.pos, TT.MUL))
 
+			elif self.current_char == "%" and "operations" in self.libraries:
+				start_pos = self.pos.copy()
+				self.advance()
+				tokens.append(Token(start_pos, self.pos, TT.MOD))
+
 			elif self.current_char == "/":
 				# Try to make a comment
 				start_pos = self.pos.copy()
@@ -330,8 +341,6 @@ class Lexer:
 					self.advance()
 				
 				elif "operations" in self.libraries:
-					start_pos = self.pos.copy()
-					self.advance()
 					tokens.append(Token(start_pos, self.pos, TT.DIV))
 
 				else:
@@ -0,0 +1,1340 @@
+import copy
+import sys
+
+from xsharp_parser import *
+from xsharp_profile import Profile
+
+# Optimizations working on the X# AST, run between parsing and compiling.
+
+BUILTIN_CONSTANTS = {"true": -1, "false": 0, "N_BITS": 16}
+
+def wrap(value: int) -> int:
+	"""Wraps a value to a signed 16-bit integer, like Xenon's ALU does."""
+	return (value + 32768) % 65536 - 32768
+
+def evaluate_unary(operation: str, value: int) -> int | None:
+	"""Evaluates a unary operation with 16-bit wraparound, or returns None if it can't be folded."""
+	match operation:
+		case "SUB": return wrap(-value)
+		case "ADD": return value
+		case "NOT": return ~value
+		case "INC": return wrap(value + 1)
+		case "DEC": return wrap(value - 1)
+		case "ABS": return wrap(abs(value))
+		case "SIGN": return -1 if value < 0 else 0 if value == 0 else 1
+	return None
+
+def evaluate_binary(operation: str, left: int, right: int) -> int | None:
+	"""Evaluates a binary operation with 16-bit wraparound, or returns None if it can't be folded."""
+	match operation:
+		case "ADD": return wrap(left + right)
+		case "SUB": return wrap(left - right)
+		case "AND": return left & right
+		case "OR": return left | right
+		case "XOR": return left ^ right
+		case "MUL": return wrap(left * right)
+		case "DIV": return wrap(abs(left) // abs(right) * (-1 if (left < 0) != (right < 0) else 1)) if right else None
+		case "MOD": return (abs(left) % abs(right)) * (-1 if left < 0 else 1) if right else None
+		case "LSHIFT": return wrap(left << min(right, 16)) if right >= 0 else left
+		case "RSHIFT": return left >> min(right, 15) if right >= 0 else left
+		case "LT": return -int(left < right)
+		case "LE": return -int(left <= right)
+		case "EQ": return -int(left == right)
+		case "NE": return -int(left != right)
+		case "GT": return -int(left > right)
+		case "GE": return -int(left >= right)
+		case "LAND": return -int(bool(left) and bool(right))
+		case "LOR": return -int(bool(left) or bool(right))
+	return None
+
+def short_circuit(operation: str, left: int) -> bool:
+	"""Whether a logical operation's result is decided by its left operand alone."""
+	return operation == "LAND" and not left or operation == "LOR" and bool(left)
+
+def constant_value(node, constants: dict[str, int]) -> int | None:
+	"""Evaluates a constant expression, or returns None if it isn't one."""
+	match node:
+		case IntLiteral():
+			return wrap(node.value)
+		case Identifier():
+			return constants.get(node.symbol)
+		case UnaryOperation():
+			value = constant_value(node.value, constants)
+			return None if value is None else evaluate_unary(str(node.op.token_type), value)
+		case BinaryOperation():
+			left = constant_value(node.left, constants)
+			if left is not None and short_circuit(str(node.op.token_type), left):
+				return -int(bool(left))
+			right = constant_value(node.right, constants)
+			if left is None or right is None:
+				return None
+			return evaluate_binary(str(node.op.token_type), left, right)
+	return None
+
+CONDITIONS = ("LT", "LE", "EQ", "NE", "GT", "GE", "LAND", "LOR")
+
+def boolean(node) -> bool:
+	"""Whether an expression always evaluates to -1 or 0."""
+	if isinstance(node, UnaryOperation):
+		return str(node.op.token_type) == "NOT" and boolean(node.value)
+	return isinstance(node, BinaryOperation) and str(node.op.token_type) in CONDITIONS
+
+def children(node) -> list:
+	"""Returns the AST nodes directly inside a node."""
+	found: list = []
+	values: list = [
+		value for name, value in vars(node).items()
+		if name not in ("start_pos", "end_pos", "subroutine_defs") # Subroutines are walked on their own
+	]
+
+	while values:
+		value = values.pop(0)
+		if isinstance(value, (list, tuple)):
+			values = list(value) + values
+		elif hasattr(value, "__dict__") and not isinstance(value, Token):
+			found.append(value)
+
+	return found
+
+def walk(node) -> list:
+	"""Returns a node and every node inside it."""
+	nodes = [node]
+	for child in children(node):
+		nodes += walk(child)
+	return nodes
+
+IDENTITIES = {
+	"ADD": (0,), "SUB": (0,), "MUL": (1,), "DIV": (1,), "AND": (-1,), "OR": (0,), "XOR": (0,), "LSHIFT": (0,), "RSHIFT": (0,),
+}
+ABSORBING = {"MUL": 0, "AND": 0, "OR": -1}
+COMMUTATIVE = ("ADD", "MUL", "AND", "OR", "XOR")
+
+def walk_calls(node) -> bool:
+	"""Whether a node calls any subroutine, which could have side effects."""
+	return any(isinstance(child, CallExpression) for child in walk(node))
+
+def halts(body: Statements) -> bool:
+	"""Whether a statement list always ends the program, so it runs at most once."""
+	return any(isinstance(stmt, CallExpression) and stmt.sub_name.symbol == "halt" for stmt in body.body)
+
+class DeadCodeEliminator:
+	"""
+	Removes code that can never run or whose results are never used:
+	subroutines unreachable from the main program through the call graph,
+	statements following a halt() call, and variables that are never read
+	along with every store to them. The compiler never sees removed code, so
+	neither its instructions nor its RAM slots end up in the output.
+	"""
+
+	def eliminate(self, ast: Statements) -> Statements:
+		ast.subroutine_defs = self.reachable_subroutines(ast)
+		self.remove_after_halt(ast)
+
+		while self.remove_dead_stores(ast):
+			pass
+
+		return ast
+
+	def calls(self, node) -> set[str]:
+		return {child.sub_name.symbol for child in walk(node) if isinstance(child, CallExpression)}
+
+	def reachable_subroutines(self, ast: Statements) -> list[SubroutineDef]:
+		subroutines = {sub.name: sub for sub in ast.subroutine_defs}
+		reachable: set[str] = set()
+		pending = list(self.calls(ast))
+
+		while pending:
+			name = pending.pop()
+			if name in reachable or name not in subroutines:
+				continue
+			reachable.add(name)
+			pending += self.calls(subroutines[name].body)
+
+		return [sub for sub in ast.subroutine_defs if sub.name in reachable]
+
+	def bodies(self, ast: Statements) -> list[Statements]:
+		"""Returns every statement list in the program."""
+		nodes = walk(ast) + [node for sub in ast.subroutine_defs for node in walk(sub.body)]
+		return [node for node in nodes if isinstance(node, Statements)]
+
+	def remove_after_halt(self, ast: Statements) -> None:
+		for body in self.bodies(ast):
+			for i, stmt in enumerate(body.body):
+				if isinstance(stmt, CallExpression) and stmt.sub_name.symbol == "halt":
+					body.body = body.body[:i + 1]
+					break
+
+	def remove_dead_stores(self, ast: Statements) -> bool:
+		"""Removes variables nobody reads. Returns whether anything was removed."""
+		nodes = walk(ast) + [node for sub in ast.subroutine_defs for node in walk(sub.body)]
+		targets = {id(node.identifier) for node in nodes if isinstance(node, Assignment)}
+
+		read = {node.symbol for node in nodes if isinstance(node, Identifier) and id(node) not in targets}
+		read |= {node.identifier for node in nodes if isinstance(node, CForLoop)}
+		for sub in ast.subroutine_defs:
+			read |= set(sub.parameters) # Arguments are stored by the caller
+
+		# A variable can only go if every store to it can
+		stores: dict[str, list] = {}
+		for node in nodes:
+			if isinstance(node, VarDeclaration):
+				stores.setdefault(node.identifier, []).append(node)
+			elif isinstance(node, Assignment):
+				stores.setdefault(node.identifier.symbol, []).append(node)
+
+		kept = self.value_statements(ast)
+		dead: set[int] = set()
+		for name, statements in stores.items():
+			if name in read:
+				continue
+			if any(id(stmt) in kept or self.calls(stmt) for stmt in statements):
+				continue
+			dead |= {id(stmt) for stmt in statements}
+
+		if not dead:
+			return False
+
+		for body in self.bodies(ast):
+			body.body = [stmt for stmt in body.body if id(stmt) not in dead]
+		return True
+
+	def value_statements(self, ast: Statements) -> set[int]:
+		"""
+		Finds the statements whose value ends up in D when a subroutine returns or
+		the program halts. Those stay even if they store to a dead variable.
+		"""
+		found: set[int] = set()
+		pending: list[Statements] = [ast] + [sub.body for sub in ast.subroutine_defs]
+
+		while pending:
+			body = pending.pop()
+			if not body.body:
+				continue
+
+			last = body.body[-1]
+			found.add(id(last))
+			if isinstance(last, IfStatement):
+				pending += [case[1] for case in last.cases]
+				if last.else_case:
+					pending.append(last.else_case)
+
+		return found
+
+def eliminate_dead_code(ast: Statements) -> Statements:
+	return DeadCodeEliminator().eliminate(ast)
+
+class ConstantFolder:
+	"""
+	Folds constant expressions into literals, with the same 16-bit wraparound
+	as the hardware. Constants are propagated from const definitions, and from
+	variables that are initialized with a constant and never assigned again.
+	A variable's value is only propagated to the statements following its
+	declaration in the main program, since a subroutine may run before it.
+	Operations with an identity operand, like x + 0 or x * 1, are simplified.
+	"""
+
+	def fold(self, ast: Statements) -> Statements:
+		nodes = walk(ast) + [node for sub in ast.subroutine_defs for node in walk(sub.body)]
+
+		declarations: dict[str, int] = {}
+		for node in nodes:
+			if isinstance(node, VarDeclaration):
+				declarations[node.identifier] = declarations.get(node.identifier, 0) + 1
+
+		# Variables that keep their initial value forever
+		self.fixed: set[str] = {name for name, count in declarations.items() if count == 1}
+		self.fixed -= {node.identifier.symbol for node in nodes if isinstance(node, Assignment)}
+		self.fixed -= {node.identifier for node in nodes if isinstance(node, CForLoop)}
+		self.fixed -= {param for sub in ast.subroutine_defs for param in sub.parameters}
+
+		self.constants: dict[str, int] = dict(BUILTIN_CONSTANTS)
+		self.fold_body(ast, {}, True)
+
+		for sub in ast.subroutine_defs:
+			shadowed = {param: self.constants.pop(param) for param in sub.parameters if param in self.constants}
+			self.fold_body(sub.body, {}, False)
+			self.constants.update(shadowed)
+
+		return ast
+
+	def fold_body(self, body: Statements, values: dict[str, int], propagate: bool) -> None:
+		values = dict(values) # Variables declared in here don't leak out
+
+		for i, stmt in enumerate(body.body):
+			body.body[i] = self.fold_node(stmt, values, propagate)
+
+			if isinstance(stmt, ConstDefinition) and isinstance(stmt.value, IntLiteral):
+				self.constants[stmt.symbol.symbol] = stmt.value.value
+			elif (
+				propagate and isinstance(stmt, VarDeclaration) and stmt.length is None
+				and stmt.identifier in self.fixed and isinstance(stmt.value, IntLiteral)
+			):
+				values[stmt.identifier] = stmt.value.value
+
+	def fold_node(self, node, values: dict[str, int], propagate: bool):
+		"""Folds the expressions inside a node, returning the node to use in its place."""
+		match node:
+			case Statements():
+				self.fold_body(node, values, propagate)
+			case Identifier():
+				value = self.constants.get(node.symbol, values.get(node.symbol))
+				if value is not None:
+					return IntLiteral(value, node.start_pos, node.end_pos)
+			case UnaryOperation():
+				node.value = self.fold_node(node.value, values, propagate)
+				if isinstance(node.value, IntLiteral):
+					value = evaluate_unary(str(node.op.token_type), wrap(node.value.value))
+					if value is not None:
+						return IntLiteral(value, node.start_pos, node.end_pos)
+			case BinaryOperation():
+				node.left = self.fold_node(node.left, values, propagate)
+				node.right = self.fold_node(node.right, values, propagate)
+				return self.fold_binary(node)
+			case IfStatement():
+				node.cases = [
+					(self.fold_node(condition, values, propagate), self.fold_node(body, values, propagate))
+					for condition, body in node.cases
+				]
+				if node.else_case:
+					self.fold_node(node.else_case, values, propagate)
+			case CallExpression():
+				node.arguments = [self.fold_node(argument, values, propagate) for argument in node.arguments]
+			case ArrayLiteral():
+				node.elements = [self.fold_node(element, values, propagate) for element in node.elements]
+			case ArrayAccess() | ArraySet():
+				node.index = self.fold_node(node.index, values, propagate)
+				if isinstance(node, ArraySet):
+					node.value = self.fold_node(node.value, values, propagate)
+			case CForLoop():
+				node.start = self.fold_node(node.start, values, propagate)
+				node.end = self.fold_node(node.end, values, propagate)
+				node.step = self.fold_node(node.step, values, propagate)
+				self.fold_node(node.body, values, propagate)
+			case WhileLoop():
+				condition = boolean(node.condition)
+				node.condition = self.fold_node(node.condition, values, propagate)
+				if condition and isinstance(node.condition, IntLiteral):
+					# The loop tests other values for being positive, so a true comparison becomes 1
+					node.condition.value = int(node.condition.value != 0)
+				self.fold_node(node.body, values, propagate)
+			case VarDeclaration() | ConstDefinition():
+				if node.value is not None:
+					node.value = self.fold_node(node.value, values, propagate)
+			case Assignment():
+				node.expr = self.fold_node(node.expr, values, propagate)
+
+		return node
+
+	def fold_binary(self, node: BinaryOperation):
+		operation = str(node.op.token_type)
+		left = wrap(node.left.value) if isinstance(node.left, IntLiteral) else None
+		right = wrap(node.right.value) if isinstance(node.right, IntLiteral) else None
+
+		if left is not None and right is not None:
+			value = evaluate_binary(operation, left, right)
+			if value is not None:
+				return IntLiteral(value, node.start_pos, node.end_pos)
+			return node
+
+		# The right operand of && and || isn't evaluated at all
+		if left is not None and short_circuit(operation, left):
+			return IntLiteral(-int(bool(left)), node.start_pos, node.end_pos)
+
+		# Identities
+		if right is not None and right in IDENTITIES.get(operation, ()):
+			return node.left
+		if left is not None and left in IDENTITIES.get(operation, ()) and operation in COMMUTATIVE:
+			return node.right
+
+		# Operations with a result that doesn't depend on the other operand
+		for constant, other in ((right, node.left), (left, node.right)):
+			if constant is not None and ABSORBING.get(operation) == constant and not walk_calls(other):
+				return IntLiteral(constant, node.start_pos, node.end_pos)
+
+		return node
+
+def fold_constants(ast: Statements) -> Statements:
+	return ConstantFolder().fold(ast)
+
+def transform(node, visit) -> None:
+	"""Replaces every AST node directly inside a node with what `visit` returns for it."""
+	def replace(value):
+		if isinstance(value, list):
+			return [replace(item) for item in value]
+		if isinstance(value, tuple):
+			return tuple(replace(item) for item in value)
+		if hasattr(value, "__dict__") and not isinstance(value, Token):
+			return visit(value)
+		return value
+
+	for name, value in vars(node).items():
+		if name not in ("start_pos", "end_pos", "subroutine_defs"):
+			setattr(node, name, replace(value))
+
+def assigned_names(node) -> set[str]:
+	"""Returns the variables and arrays a node writes to directly."""
+	names: set[str] = set()
+	for child in walk(node):
+		match child:
+			case Assignment():
+				names.add(child.identifier.symbol)
+			case ArraySet() if isinstance(child.array, Identifier):
+				names.add(child.array.symbol)
+			case VarDeclaration() | CForLoop():
+				names.add(child.identifier)
+	return names
+
+# How much evaluating an operation costs, roughly, on top of its operands
+OPERATION_WEIGHTS = {
+	"MUL": 8, "DIV": 8, "MOD": 8, "LSHIFT": 8, "RSHIFT": 8,
+	"LT": 3, "LE": 3, "EQ": 3, "NE": 3, "GT": 3, "GE": 3, "LAND": 3, "LOR": 3, "ABS": 3, "SIGN": 3, "AT": 0,
+}
+
+def weight(node) -> int:
+	"""Estimates how expensive an expression is to evaluate."""
+	match node:
+		case UnaryOperation():
+			return OPERATION_WEIGHTS.get(str(node.op.token_type), 1) + weight(node.value)
+		case BinaryOperation():
+			return OPERATION_WEIGHTS.get(str(node.op.token_type), 1) + weight(node.left) + weight(node.right)
+		case ArrayAccess():
+			return 2 + weight(node.index)
+		case CallExpression():
+			return 8 + sum(weight(argument) for argument in node.arguments)
+	return 0
+
+MAX_INSTRUCTIONS = 2 ** 12 # Size of Xenon's PROM, as in xenon_vm
+
+STATEMENT_TYPES = (VarDeclaration, ConstDefinition, Assignment, ArraySet, CForLoop, WhileLoop, IfStatement, SubroutineDef)
+
+class Inliner:
+	"""
+	Inlines calls to small leaf subroutines, ones that call no other
+	subroutine, which saves the CALL, the RETN and a call stack entry.
+	Parameters become their arguments when those are constants or variables
+	the body doesn't assign, and fresh temporaries otherwise. For a call inside
+	an expression, the body runs right before the statement and stores its
+	value in a temporary the expression reads instead. A call is inlined if the
+	cycles it saves, counting calls in loops as running more often or as often
+	as a profile says, outweigh the PROM words it adds; when optimizing for
+	size, only if it adds none.
+	"""
+	MAX_SIZE = 24 # Largest inlined body, in AST nodes
+	LOOP_WEIGHT = 8 # How many times more often a call in a loop is assumed to run than one outside it
+
+	def __init__(self, speed: bool = True, profile: Profile | None = None):
+		self.speed: bool = speed
+		self.profile: Profile | None = profile
+
+	def inline(self, ast: Statements) -> Statements:
+		self.subroutines = {sub.name: sub for sub in ast.subroutine_defs}
+		self.leaves: set[str] = {
+			sub.name for sub in ast.subroutine_defs
+			if len(walk(sub.body)) - 1 <= self.MAX_SIZE and not any(
+				isinstance(node, (VarDeclaration, ConstDefinition))
+				or isinstance(node, CallExpression) and node.sub_name.symbol in self.subroutines
+				for node in walk(sub.body)
+			)
+		}
+
+		nodes = len(walk(ast)) + sum(len(walk(sub.body)) for sub in ast.subroutine_defs)
+		self.budget: int = MAX_INSTRUCTIONS // 4 - 2 * nodes
+		self.temporaries: int = 0
+
+		inlined = self.inline_body(ast, None, 0)
+		for sub in ast.subroutine_defs:
+			inlined = self.inline_body(sub.body, sub, 0) or inlined
+
+		if inlined:
+			fold_constants(ast) # Fold constant arguments into the bodies
+		return ast
+
+	def inline_body(self, body: Statements, caller: SubroutineDef | None, depth: int) -> bool:
+		"""Inlines the calls in a body and the bodies inside it. Returns whether anything was inlined."""
+		inlined = False
+		statements: list = []
+		for stmt in body.body:
+			if isinstance(stmt, (CForLoop, WhileLoop)):
+				inlined = self.inline_body(stmt.body, caller, depth + 1) or inlined
+			elif isinstance(stmt, IfStatement):
+				for _, case in stmt.cases:
+					inlined = self.inline_body(case, caller, depth) or inlined
+				if stmt.else_case:
+					inlined = self.inline_body(stmt.else_case, caller, depth) or inlined
+
+			expanded = self.inline_statement(stmt, caller, depth)
+			if expanded is None:
+				statements.append(stmt)
+			else:
+				statements += expanded
+				inlined = True
+		body.body = statements
+		return inlined
+
+	def runs(self, stmt, depth: int) -> int:
+		"""How many times a statement is expected to run."""
+		count = self.profile.count(stmt) if self.profile is not None else None
+		return self.LOOP_WEIGHT ** depth if count is None else count
+
+	def inline_statement(self, stmt, caller: SubroutineDef | None, depth: int) -> list | None:
+		"""Returns the statements replacing a statement with its calls inlined, or None to keep it."""
+		runs = self.runs(stmt, depth)
+		if isinstance(stmt, CallExpression):
+			added = self.cost(stmt, caller, runs)
+			if added is None:
+				return None
+			self.budget -= added
+			return self.expand(stmt, None)
+
+		# The expressions evaluated before anything else in the statement
+		match stmt:
+			case Assignment():
+				fields = ["expr"]
+			case VarDeclaration() if stmt.length is None and stmt.value is not None:
+				fields = ["value"]
+			case ArraySet():
+				fields = ["index", "value"]
+			case CForLoop():
+				fields = ["start"]
+			case IfStatement() | WhileLoop() | ConstDefinition() | SubroutineDef() | VarDeclaration():
+				return None
+			case _:
+				fields = [] # An expression statement
+
+		expressions = [getattr(stmt, name) for name in fields] if fields else [stmt]
+		calls = [node for expression in expressions for node in walk(expression) if isinstance(node, CallExpression)]
+		calls = [call for call in calls if call.sub_name.symbol in self.subroutines]
+		if not calls:
+			return None
+
+		# Running the bodies first is only safe if nothing else in the statement can notice
+		conditional = [
+			node for expression in expressions for operation in walk(expression)
+			if isinstance(operation, BinaryOperation) and str(operation.op.token_type) in ("LAND", "LOR")
+			for node in walk(operation.right)
+		]
+		if any(call is node for call in calls for node in conditional):
+			return None # The right operand of && and || might never run
+		for call in calls:
+			sub = self.subroutines[call.sub_name.symbol]
+			if (
+				sub.name not in self.leaves or assigned_names(sub.body) - set(sub.parameters)
+				or any(walk_calls(argument) for argument in call.arguments) or not self.has_value(sub.body)
+			):
+				return None
+		costs = [self.cost(call, caller, runs) for call in calls]
+		if None in costs or sum(costs) > self.budget:
+			return None
+		self.budget -= sum(costs)
+
+		self.hoisted: list = []
+		if fields:
+			for name in fields:
+				setattr(stmt, name, self.inline_expression(getattr(stmt, name)))
+		else:
+			stmt = self.inline_expression(stmt)
+		return self.hoisted + [stmt]
+
+	def inline_expression(self, node):
+		if isinstance(node, CallExpression) and node.sub_name.symbol in self.subroutines:
+			result = f"__ret{self.temporaries}"
+			self.temporaries += 1
+			self.hoisted.append(VarDeclaration(result, None, "int", node.start_pos, node.end_pos, None))
+			self.hoisted += self.expand(node, result)
+			return Identifier(result, node.start_pos, node.end_pos)
+
+		transform(node, self.inline_expression)
+		return node
+
+	def cost(self, call: CallExpression, caller: SubroutineDef | None, runs: int) -> int | None:
+		"""Returns how many PROM words inlining a call adds, or None if it isn't worth it."""
+		name = call.sub_name.symbol
+		if name not in self.leaves:
+			return None
+
+		sub = self.subroutines[name]
+		globals_read = {node.symbol for node in walk(sub.body) if isinstance(node, Identifier)} - set(sub.parameters)
+		if caller is not None and globals_read & set(caller.parameters):
+			return None # The caller's parameters would shadow them
+
+		# The CALL, the RETN and the argument stores that go away, against the body copied in
+		substituted = len(self.substitutions(sub, call))
+		saved = (2 + 2 * substituted) * runs
+		added = 2 * (len(walk(sub.body)) - 1) - 1 - 2 * substituted
+		if added > self.budget or added > (2 * saved if self.speed else 0):
+			return None
+		return added
+
+	def substitutions(self, sub: SubroutineDef, call: CallExpression) -> dict[str, int]:
+		"""Finds the parameters that can be replaced by their argument, by position."""
+		assigned = assigned_names(sub.body)
+		return {
+			param: i for i, (param, argument) in enumerate(zip(sub.parameters, call.arguments))
+			if param not in assigned and (
+				isinstance(argument, IntLiteral) or isinstance(argument, Identifier) and argument.symbol not in assigned
+			)
+		}
+
+	def has_value(self, body: Statements) -> bool:
+		"""Whether a body always leaves a value in D that store_value can capture."""
+		if not body.body:
+			return False
+		last = body.body[-1]
+		if isinstance(last, IfStatement):
+			return last.else_case is not None and all(self.has_value(case) for _, case in last.cases) and self.has_value(last.else_case)
+		return isinstance(last, Assignment) or not isinstance(last, STATEMENT_TYPES)
+
+	def store_value(self, body: Statements, result: str) -> None:
+		"""Makes a body store the value it leaves in D into `result`."""
+		last = body.body[-1]
+		target = Identifier(result, last.start_pos, last.end_pos)
+		match last:
+			case IfStatement():
+				for _, case in last.cases:
+					self.store_value(case, result)
+				self.store_value(last.else_case, result)
+			case Assignment():
+				value = Identifier(last.identifier.symbol, last.start_pos, last.end_pos)
+				body.body.append(Assignment(target, value, last.start_pos, last.end_pos))
+			case _:
+				body.body[-1] = Assignment(target, last, last.start_pos, last.end_pos)
+
+	def expand(self, call: CallExpression, result: str | None) -> list:
+		"""Returns the statements running a call's body in place, storing its value into `result` if given."""
+		sub = self.subroutines[call.sub_name.symbol]
+		substitutions = self.substitutions(sub, call)
+
+		statements: list = []
+		self.arguments: dict[str, Identifier | IntLiteral] = {}
+		for i, (param, argument) in enumerate(zip(sub.parameters, call.arguments)):
+			if param in substitutions:
+				self.arguments[param] = argument
+			else:
+				name = f"__arg{self.temporaries}"
+				self.temporaries += 1
+				statements.append(VarDeclaration(name, argument, "int", argument.start_pos, argument.end_pos, None))
+				self.arguments[param] = Identifier(name, argument.start_pos, argument.end_pos)
+
+		body = copy.deepcopy(sub.body)
+		transform(body, self.rename)
+		if result is not None:
+			self.store_value(body, result)
+		return statements + body.body
+
+	def rename(self, node):
+		if isinstance(node, Identifier) and node.symbol in self.arguments:
+			return copy.deepcopy(self.arguments[node.symbol])
+		if isinstance(node, CForLoop) and node.identifier in self.arguments:
+			node.identifier = self.arguments[node.identifier].symbol
+		transform(node, self.rename)
+		return node
+
+def inline_subroutines(ast: Statements, speed: bool = True, profile: Profile | None = None) -> Statements:
+	return Inliner(speed, profile).inline(ast)
+
+class LoopUnroller:
+	"""
+	Unrolls for loops with a constant trip count whose counter only the loop
+	itself assigns and no subroutine it calls reads. Small loops are unrolled fully, with the counter replaced by
+	its value in each copy so the copies fold down further. Larger ones repeat
+	their body a few times per iteration, with the iterations left over
+	unrolled after the loop, if they don't contain other loops. The extra
+	code is estimated from the size of the bodies and kept within a budget,
+	so the program still fits in the PROM. Loops a profile says never ran
+	aren't worth any of it.
+	"""
+	FULL_SIZE = 64 # Largest fully unrolled loop, in AST nodes
+	COPY_SIZE = 48 # Largest body of a partially unrolled loop, in AST nodes, times its copies
+	MAX_FACTOR = 8
+	MAX_TRIPS = 4096
+
+	def __init__(self, profile: Profile | None = None):
+		self.profile: Profile | None = profile
+
+	def unroll(self, ast: Statements) -> Statements:
+		self.ast = ast
+		self.effects = SubroutineEffects(ast)
+
+		# Roughly two words per node, leave at least half the PROM to what's there
+		nodes = len(walk(ast)) + sum(len(walk(sub.body)) for sub in ast.subroutine_defs)
+		self.budget: int = MAX_INSTRUCTIONS // 2 - 2 * nodes
+
+		unrolled = self.unroll_body(ast)
+		for sub in ast.subroutine_defs:
+			unrolled = self.unroll_body(sub.body) or unrolled
+
+		if unrolled:
+			fold_constants(ast) # Fold the copies with their counter values in
+		return ast
+
+	def unroll_body(self, body: Statements) -> bool:
+		"""Unrolls the loops in a body, inner loops first. Returns whether anything was unrolled."""
+		unrolled = False
+		statements: list = []
+		for stmt in body.body:
+			if isinstance(stmt, (CForLoop, WhileLoop)):
+				unrolled = self.unroll_body(stmt.body) or unrolled
+			elif isinstance(stmt, IfStatement):
+				for _, case in stmt.cases:
+					unrolled = self.unroll_body(case) or unrolled
+				if stmt.else_case:
+					unrolled = self.unroll_body(stmt.else_case) or unrolled
+
+			replacement = self.unroll_loop(stmt) if isinstance(stmt, CForLoop) else None
+			if replacement is None:
+				statements.append(stmt)
+			else:
+				statements += replacement
+				unrolled = True
+		body.body = statements
+		return unrolled
+
+	def unroll_loop(self, loop: CForLoop) -> list | None:
+		"""Returns the statements replacing a loop, or None to keep it."""
+		start, end, step = (constant_value(node, {}) for node in (loop.start, loop.end, loop.step))
+		if start is None or end is None or step is None:
+			return None
+		if loop.step_op.token_type == TT.SUB:
+			step = wrap(-step)
+		if loop.identifier in self.effects.assigned(loop.body):
+			return None
+		calls = {node.sub_name.symbol for node in walk(loop.body) if isinstance(node, CallExpression)}
+		if any(loop.identifier in self.effects.reads.get(call, ()) for call in calls):
+			return None # The copies don't step the counter itself, which the subroutine reads
+		if any(isinstance(node, (VarDeclaration, ConstDefinition)) for node in walk(loop.body)):
+			return None # Each copy would declare it again
+		if self.profile is not None and self.profile.count(loop) == 0:
+			return None
+
+		trips = self.trip_count(start, str(loop.end_op.token_type), end, step)
+		if trips is None:
+			return None
+
+		size = len(walk(loop.body)) - 1
+		statements: list = []
+
+		# Copies with a constant counter usually fold down, so measure them after folding
+		unrolled = None
+		if trips * size <= 2 * self.FULL_SIZE:
+			unrolled = Statements(loop.body.start_pos, loop.body.end_pos, self.copies(loop, start, step, trips), [])
+			ConstantFolder().fold(unrolled)
+			if len(walk(unrolled)) - 1 > min(self.FULL_SIZE, self.budget):
+				unrolled = None
+
+		if unrolled is not None:
+			statements += unrolled.body
+			self.budget -= len(walk(unrolled)) - 1
+		else:
+			# Strength reduction does better on loops indexing arrays with the counter or multiplying it
+			counter = [
+				node for node in walk(loop.body)
+				if isinstance(node, (ArrayAccess, ArraySet, BinaryOperation)) and any(
+					isinstance(operand, Identifier) and operand.symbol == loop.identifier
+					for operand in ((node.index,) if isinstance(node, (ArrayAccess, ArraySet)) else (node.left, node.right))
+				) and (not isinstance(node, BinaryOperation) or str(node.op.token_type) in ("MUL", "LSHIFT"))
+			]
+			inner = any(isinstance(node, (CForLoop, WhileLoop)) for node in walk(loop.body))
+			factor = None if inner or counter else self.factor(size, trips)
+			if factor is None or start + trips * step != wrap(start + trips * step):
+				return None # The shorter loop's end test relies on the counter never wrapping
+
+			# The loop covers whole groups of iterations, what's left runs after it
+			groups = trips // factor
+			last = start + groups * factor * step
+			body = Statements(loop.body.start_pos, loop.body.end_pos, self.copies(loop, None, step, factor), [])
+			relation = TT.LT if step > 0 else TT.GT
+			statements.append(CForLoop(
+				loop.start_pos, loop.end_pos, loop.identifier, loop.start,
+				Token(loop.end_op.start_pos, loop.end_op.end_pos, relation),
+				IntLiteral(last, loop.end.start_pos, loop.end.end_pos),
+				Token(loop.step_op.start_pos, loop.step_op.end_pos, TT.ADD),
+				IntLiteral(wrap(factor * step), loop.step.start_pos, loop.step.end_pos),
+				body,
+			))
+			statements += self.copies(loop, last, step, trips - groups * factor)
+			self.budget -= (factor - 1 + trips % factor) * size
+
+		# Leave the counter where the loop would have if anything reads it later
+		inside = {id(node) for node in walk(loop.body)}
+		nodes = walk(self.ast) + [node for sub in self.ast.subroutine_defs for node in walk(sub.body)]
+		if any(isinstance(node, Identifier) and node.symbol == loop.identifier and id(node) not in inside for node in nodes):
+			counter = Identifier(loop.identifier, loop.end_pos, loop.end_pos)
+			final = IntLiteral(wrap(start + trips * step), loop.end_pos, loop.end_pos)
+			statements.append(Assignment(counter, final, loop.end_pos, loop.end_pos))
+
+		return statements
+
+	def factor(self, size: int, trips: int) -> int | None:
+		"""Picks how many copies of a body a partially unrolled loop runs per iteration."""
+		factor = self.MAX_FACTOR
+		while factor > 1 and (factor * size > self.COPY_SIZE or 2 * factor > trips or 2 * (factor - 1) * size > self.budget):
+			factor //= 2
+		return factor if factor > 1 else None
+
+	def copies(self, loop: CForLoop, first: int | None, step: int, count: int) -> list:
+		"""Copies the body of a loop `count` times, for the counter values from `first` on.
+		If `first` is None, the copies step from wherever the counter is instead."""
+		self.counter: str = loop.identifier
+		statements: list = []
+		for i in range(count):
+			if first is None:
+				self.value = lambda node: BinaryOperation(
+					Identifier(loop.identifier, node.start_pos, node.end_pos),
+					Token(node.start_pos, node.end_pos, TT.ADD), IntLiteral(wrap(i * step), node.start_pos, node.end_pos),
+				)
+			else:
+				self.value = lambda node: IntLiteral(wrap(first + i * step), node.start_pos, node.end_pos)
+
+			body = copy.deepcopy(loop.body)
+			transform(body, self.substitute)
+			statements += body.body
+		return statements
+
+	def substitute(self, node):
+		if isinstance(node, Identifier) and node.symbol == self.counter:
+			return self.value(node)
+		transform(node, self.substitute)
+		return node
+
+	def trip_count(self, start: int, relation: str, end: int, step: int) -> int | None:
+		"""Counts how many times a loop runs its body, testing the end value the way the compiler does."""
+		mirrored = {"LT": "GT", "LE": "GE", "GT": "LT", "GE": "LE"}[relation]
+		counter = start
+		for trips in range(1, self.MAX_TRIPS + 1):
+			counter = wrap(counter + step)
+			if end == 0:
+				again = evaluate_binary(relation, counter, 0)
+			else:
+				again = evaluate_binary(mirrored, wrap(end - counter), 0)
+			if not again:
+				return trips
+		return None
+
+def unroll_loops(ast: Statements, profile: Profile | None = None) -> Statements:
+	return LoopUnroller(profile).unroll(ast)
+
+class SubroutineEffects:
+	"""
+	Works out what every subroutine may write and read, along with everything
+	it calls, so that loop optimizations can tell what a call may change.
+	Pure subroutines assign nothing, not even their parameters, and never call
+	a native subroutine.
+	"""
+
+	def __init__(self, ast: Statements):
+		self.subroutines = {sub.name: sub for sub in ast.subroutine_defs}
+		self.callees = {
+			sub.name: {node.sub_name.symbol for node in walk(sub.body) if isinstance(node, CallExpression)}
+			for sub in ast.subroutine_defs
+		}
+		self.reaches = {name: self.reachable(name) for name in self.subroutines}
+
+		self.writes: dict[str, set[str]] = {}
+		self.reads: dict[str, set[str]] = {}
+		for name in self.subroutines:
+			subs = [self.subroutines[other] for other in self.reaches[name] | {name} if other in self.subroutines]
+			self.writes[name] = set().union(*(assigned_names(sub.body) - set(sub.parameters) for sub in subs))
+			self.reads[name] = set().union(*(
+				{node.symbol for node in walk(sub.body) if isinstance(node, Identifier)} - set(sub.parameters)
+				for sub in subs
+			))
+
+		self.pure: set[str] = {
+			name for name in self.subroutines
+			if all(other in self.subroutines for other in self.reaches[name])
+			and not any(assigned_names(self.subroutines[other].body) for other in self.reaches[name] | {name})
+		}
+
+	def reachable(self, name: str) -> set[str]:
+		"""Returns every subroutine a subroutine may end up calling."""
+		found: set[str] = set()
+		pending = list(self.callees.get(name, ()))
+		while pending:
+			other = pending.pop()
+			if other not in found:
+				found.add(other)
+				pending += self.callees.get(other, ())
+		return found
+
+	def recursive(self, node, sub: str | None) -> bool:
+		"""Whether a node inside a subroutine may call that subroutine again."""
+		calls = {child.sub_name.symbol for child in walk(node) if isinstance(child, CallExpression)}
+		return sub is not None and any(call == sub or sub in self.reaches.get(call, ()) for call in calls)
+
+	def assigned(self, node) -> set[str]:
+		"""Returns the variables and arrays a node may write, including through the subroutines it calls."""
+		calls = {child.sub_name.symbol for child in walk(node) if isinstance(child, CallExpression)}
+		return assigned_names(node).union(*(self.writes[call] for call in calls if call in self.writes))
+
+	def invariant(self, node, assigned: set[str]) -> bool:
+		"""Whether an expression gives the same value while none of `assigned` changes."""
+		match node:
+			case IntLiteral():
+				return True
+			case Identifier():
+				return node.symbol not in assigned
+			case UnaryOperation():
+				return self.invariant(node.value, assigned)
+			case BinaryOperation():
+				return self.invariant(node.left, assigned) and self.invariant(node.right, assigned)
+			case ArrayAccess():
+				return (
+					isinstance(node.array, Identifier) and self.invariant(node.array, assigned)
+					and self.invariant(node.index, assigned)
+				)
+			case CallExpression():
+				name = node.sub_name.symbol
+				return (
+					name in self.pure and not self.reads[name] & assigned
+					and all(self.invariant(argument, assigned) for argument in node.arguments)
+				)
+		return False
+
+class LoopInvariantMotion:
+	"""
+	Hoists expressions that give the same value on every iteration of a loop
+	into a variable declared right before it. An expression is invariant if
+	nothing in the loop writes the variables and arrays it reads, including
+	the subroutines the loop calls, and any call in it is to a subroutine
+	without side effects. Outer loops go first, so an expression that is
+	invariant in several nested loops ends up outside all of them. Only
+	expressions more expensive than reading a variable are hoisted.
+	"""
+	THRESHOLD = 2 # Minimum weight of a hoisted expression
+
+	def hoist(self, ast: Statements) -> Statements:
+		self.effects = SubroutineEffects(ast)
+
+		self.hoisted: int = 0
+		self.hoist_body(ast, None)
+		for sub in ast.subroutine_defs:
+			self.hoist_body(sub.body, sub.name)
+
+		return ast
+
+	def hoist_body(self, body: Statements, sub: str | None) -> None:
+		statements: list = []
+		for stmt in body.body:
+			if isinstance(stmt, (CForLoop, WhileLoop)):
+				statements += self.hoist_loop(stmt, sub)
+				self.hoist_body(stmt.body, sub)
+			elif isinstance(stmt, IfStatement):
+				for _, case in stmt.cases:
+					self.hoist_body(case, sub)
+				if stmt.else_case:
+					self.hoist_body(stmt.else_case, sub)
+			statements.append(stmt)
+		body.body = statements
+
+	def hoist_loop(self, loop: CForLoop | WhileLoop, sub: str | None) -> list[VarDeclaration]:
+		"""Replaces the invariant expressions in a loop, returning the declarations that compute them."""
+		if self.effects.recursive(loop, sub):
+			return [] # A recursive call would overwrite the hoisted values
+
+		self.assigned = self.effects.assigned(loop)
+		self.declarations: dict[str, VarDeclaration] = {}
+
+		if isinstance(loop, CForLoop):
+			loop.end = self.hoist_expression(loop.end)
+			loop.step = self.hoist_expression(loop.step)
+		else:
+			loop.condition = self.hoist_condition(loop.condition)
+		transform(loop.body, self.hoist_expression)
+
+		return list(self.declarations.values())
+
+	def hoist_condition(self, node):
+		"""Hoists the invariant operands of a while loop's condition, keeping its comparisons in the loop
+		to branch on, since the loop tests a hoisted value for being positive rather than true."""
+		if boolean(node):
+			transform(node, self.hoist_condition)
+			return node
+		return self.hoist_expression(node)
+
+	def hoist_expression(self, node):
+		if isinstance(node, WhileLoop):
+			node.condition = self.hoist_condition(node.condition)
+			transform(node.body, self.hoist_expression)
+			return node
+
+		if isinstance(node, (BinaryOperation, UnaryOperation, ArrayAccess, CallExpression)):
+			if self.effects.invariant(node, self.assigned) and weight(node) >= self.THRESHOLD:
+				key = repr(expression_key(node))
+				if key not in self.declarations:
+					name = f"__inv{self.hoisted}"
+					self.hoisted += 1
+					self.declarations[key] = VarDeclaration(name, node, "int", node.start_pos, node.end_pos, None)
+				return Identifier(self.declarations[key].identifier, node.start_pos, node.end_pos)
+
+		transform(node, self.hoist_expression)
+		return node
+
+def expression_key(node):
+	"""Returns a value that is equal for structurally equal expressions, up to the order of commutative operands."""
+	match node:
+		case IntLiteral():
+			return wrap(node.value)
+		case Identifier():
+			return node.symbol
+		case UnaryOperation():
+			return (str(node.op.token_type), expression_key(node.value))
+		case BinaryOperation() if str(node.op.token_type) in COMMUTATIVE:
+			return (str(node.op.token_type), *sorted((expression_key(node.left), expression_key(node.right)), key=repr))
+		case BinaryOperation():
+			return (str(node.op.token_type), expression_key(node.left), expression_key(node.right))
+		case ArrayAccess():
+			return ("[]", expression_key(node.array), expression_key(node.index))
+		case CallExpression():
+			return ("()", node.sub_name.symbol, *(expression_key(argument) for argument in node.arguments))
+	return id(node)
+
+def hoist_loop_invariants(ast: Statements) -> Statements:
+	return LoopInvariantMotion().hoist(ast)
+
+class InductionVariables:
+	"""
+	Strength-reduces for loops with a constant step whose counter only the loop
+	itself assigns. A multiple of the counter, like `i * 48`, becomes a variable
+	initialized before the loop and stepped at the end of every iteration, so
+	the body adds instead of multiplying. A counter that nothing reads is
+	replaced by one holding the distance left to the end value, counting down
+	to 0, which the compiler tests straight off the step instead of comparing
+	against the end value on every iteration.
+	"""
+
+	def reduce(self, ast: Statements) -> Statements:
+		self.effects = SubroutineEffects(ast)
+
+		self.reduced: int = 0
+		self.loops(ast, None, self.reduce_loop)
+		for sub in ast.subroutine_defs:
+			self.loops(sub.body, sub.name, self.reduce_loop)
+
+		# Only look for unread counters once their multiples are gone
+		nodes = walk(ast) + [node for sub in ast.subroutine_defs for node in walk(sub.body)]
+		targets = {id(node.identifier) for node in nodes if isinstance(node, Assignment)}
+		self.read = {node.symbol for node in nodes if isinstance(node, Identifier) and id(node) not in targets}
+
+		self.counted: int = 0
+		self.loops(ast, None, self.count_down)
+		for sub in ast.subroutine_defs:
+			self.loops(sub.body, sub.name, self.count_down)
+
+		return ast
+
+	def loops(self, body: Statements, sub: str | None, rewrite) -> None:
+		"""Rewrites every for loop in a body, outer loops first, inserting the declarations they need before them."""
+		statements: list = []
+		for stmt in body.body:
+			if isinstance(stmt, CForLoop):
+				statements += rewrite(stmt, sub)
+			if isinstance(stmt, (CForLoop, WhileLoop)):
+				self.loops(stmt.body, sub, rewrite)
+			elif isinstance(stmt, IfStatement):
+				for _, case in stmt.cases:
+					self.loops(case, sub, rewrite)
+				if stmt.else_case:
+					self.loops(stmt.else_case, sub, rewrite)
+			statements.append(stmt)
+		body.body = statements
+
+	def step(self, loop: CForLoop, sub: str | None) -> int | None:
+		"""Returns how much the counter of a loop moves per iteration, or None if something else may move it too."""
+		step = constant_value(loop.step, {})
+		if step is None or self.effects.recursive(loop, sub) or loop.identifier in self.effects.assigned(loop.body):
+			return None
+		return wrap(-step) if loop.step_op.token_type == TT.SUB else step
+
+	def reduce_loop(self, loop: CForLoop, sub: str | None) -> list[VarDeclaration]:
+		step = self.step(loop, sub)
+		if step is None or walk_calls(loop.start):
+			return [] # The start value gets evaluated twice
+
+		self.counter: str = loop.identifier
+		self.multiples: dict[int, str] = {}
+		transform(loop.body, self.replace_multiple)
+
+		declarations: list[VarDeclaration] = []
+		start = constant_value(loop.start, {})
+		for factor, name in self.multiples.items():
+			if start is not None:
+				value = IntLiteral(wrap(start * factor), loop.start.start_pos, loop.start.end_pos)
+			else:
+				value = BinaryOperation(
+					copy.deepcopy(loop.start), Token(loop.start.start_pos, loop.start.end_pos, TT.MUL),
+					IntLiteral(factor, loop.start.start_pos, loop.start.end_pos)
+				)
+			declarations.append(VarDeclaration(name, value, "int", loop.start_pos, loop.end_pos, None))
+
+			variable = Identifier(name, loop.end_pos, loop.end_pos)
+			stepped = BinaryOperation(
+				Identifier(name, loop.end_pos, loop.end_pos), Token(loop.end_pos, loop.end_pos, TT.ADD),
+				IntLiteral(wrap(step * factor), loop.end_pos, loop.end_pos)
+			)
+			loop.body.body.append(Assignment(variable, stepped, loop.end_pos, loop.end_pos))
+
+		return declarations
+
+	def replace_multiple(self, node):
+		factor = self.multiple(node)
+		if factor is not None and not (abs(factor) <= 8 and abs(factor) & (abs(factor) - 1) == 0):
+			if factor not in self.multiples:
+				self.multiples[factor] = f"__iv{self.reduced}"
+				self.reduced += 1
+			return Identifier(self.multiples[factor], node.start_pos, node.end_pos)
+
+		transform(node, self.replace_multiple)
+		return node
+
+	def multiple(self, node) -> int | None:
+		"""Returns k if a node computes the counter times a constant k."""
+		if not isinstance(node, BinaryOperation):
+			return None
+
+		def counter(side) -> bool:
+			return isinstance(side, Identifier) and side.symbol == self.counter
+
+		match str(node.op.token_type):
+			case "MUL" if counter(node.left):
+				return constant_value(node.right, {})
+			case "MUL" if counter(node.right):
+				return constant_value(node.left, {})
+			case "LSHIFT" if counter(node.left):
+				amount = constant_value(node.right, {})
+				return wrap(1 << amount) if amount is not None and 0 <= amount < 16 else None
+		return None
+
+	def count_down(self, loop: CForLoop, sub: str | None) -> list[VarDeclaration]:
+		if loop.identifier in self.read or self.step(loop, sub) is None:
+			return []
+		if not self.effects.invariant(loop.end, self.effects.assigned(loop)) or not self.effects.invariant(loop.start, set()):
+			return [] # The end value would be evaluated once, before the start value
+
+		# The loop runs while end - counter compares to 0 the way the counter compares to end
+		start, end = constant_value(loop.start, {}), constant_value(loop.end, {})
+		if start is not None and end is not None:
+			loop.start = IntLiteral(wrap(end - start), loop.start.start_pos, loop.start.end_pos)
+		elif start != 0:
+			loop.start = BinaryOperation(loop.end, Token(loop.end_op.start_pos, loop.end_op.end_pos, TT.SUB), loop.start)
+		else:
+			loop.start = loop.end
+		loop.end = IntLiteral(0, loop.end.start_pos, loop.end.end_pos)
+
+		relation = {TT.LT: TT.GT, TT.LE: TT.GE, TT.GT: TT.LT, TT.GE: TT.LE}[loop.end_op.token_type]
+		loop.end_op = Token(loop.end_op.start_pos, loop.end_op.end_pos, relation)
+		direction = TT.SUB if loop.step_op.token_type == TT.ADD else TT.ADD
+		loop.step_op = Token(loop.step_op.start_pos, loop.step_op.end_pos, direction)
+
+		loop.identifier = f"__cnt{self.counted}"
+		self.counted += 1
+		return [VarDeclaration(loop.identifier, None, "int", loop.start_pos, loop.end_pos, None)]
+
+def reduce_induction_variables(ast: Statements) -> Statements:
+	return InductionVariables().reduce(ast)
+
+class Value:
+	"""An expression whose value is available, and the later occurrences of it that can read it back."""
+
+	def __init__(self, node, reads: set[str], stmt, order: int, holder: str | None = None):
+		self.node = node
+		self.reads = reads # Variables and arrays that change the value when written
+		self.stmt = stmt # Statement a temporary holding the value is declared before
+		self.order = order # Evaluation order, so that a value is declared after those it's made of
+		self.holder = holder # Variable the value is in, if it was assigned to one
+		self.uses: list = []
+
+class CommonSubexpressions:
+	"""
+	Reuses the value of an expression computed earlier instead of computing it
+	again. Values are numbered along every statement list, and carried into the
+	if arms and loop bodies after them, which the code before them dominates. A
+	value stops being available when something writes a variable or array it
+	reads, including a subroutine a statement calls, and isn't carried into a
+	loop that writes one. A reuse reads the variable the value was assigned to,
+	or else a temporary declared before the statement that first computed it,
+	as long as the reuses save more than storing the value costs. Comparisons
+	are left alone, since the compiler branches on them directly.
+	"""
+	THRESHOLD = 2 # Minimum weight of a reused expression
+	STORE_COST = 4 # Instructions a temporary takes to store the value and load it back the first time
+
+	def eliminate(self, ast: Statements) -> Statements:
+		self.effects = SubroutineEffects(ast)
+
+		self.values: list[Value] = []
+		self.order: int = 0
+		self.number_body(ast, {})
+		for sub in ast.subroutine_defs:
+			if sub.name not in self.effects.reaches[sub.name]: # A recursive call would overwrite the temporaries
+				self.number_body(sub.body, {})
+
+		self.replaced: dict[int, str] = {}
+		declarations: dict[int, list[Value]] = {}
+		temporaries = 0
+		for value in self.values:
+			if not value.uses:
+				continue
+			if value.holder is None:
+				if len(value.uses) * (2 * weight(value.node) - 1) <= self.STORE_COST:
+					continue
+				value.holder = f"__cse{temporaries}"
+				temporaries += 1
+				self.replaced[id(value.node)] = value.holder
+				declarations.setdefault(id(value.stmt), []).append(value)
+			for use in value.uses:
+				self.replaced[id(use)] = value.holder
+
+		bodies = [ast] + [sub.body for sub in ast.subroutine_defs]
+		for body in bodies:
+			transform(body, self.replace)
+		for values in declarations.values():
+			for value in values:
+				transform(value.node, self.replace)
+
+		for body in bodies:
+			for node in walk(body):
+				if isinstance(node, Statements):
+					statements: list = []
+					for stmt in node.body:
+						for value in sorted(declarations.get(id(stmt), []), key=lambda value: value.order):
+							statements.append(VarDeclaration(value.holder, value.node, "int", stmt.start_pos, stmt.end_pos, None))
+						statements.append(stmt)
+					node.body = statements
+
+		return ast
+
+	def number_body(self, body: Statements, available: dict) -> None:
+		"""Numbers the values computed along a statement list, given the ones available before it."""
+		for stmt in body.body:
+			if isinstance(stmt, (ConstDefinition, SubroutineDef)):
+				continue
+
+			# What the statement's calls write may change before any part of it is evaluated
+			self.kill(available, self.clobbered(stmt))
+			assigned = self.effects.assigned(stmt)
+
+			match stmt:
+				case Assignment() | VarDeclaration():
+					expr = stmt.expr if isinstance(stmt, Assignment) else stmt.value
+					name = stmt.identifier.symbol if isinstance(stmt, Assignment) else stmt.identifier
+					if expr is not None:
+						self.number(expr, available, stmt, True)
+					self.kill(available, assigned)
+					if isinstance(stmt, VarDeclaration) and stmt.length is not None:
+						continue
+					if self.candidate(expr) and name not in self.reads(expr):
+						key = repr(expression_key(expr))
+						if key not in available or available[key].node is expr and not available[key].uses:
+							self.order += 1
+							available[key] = Value(expr, self.reads(expr) | {name}, stmt, self.order, name)
+							self.values.append(available[key])
+					continue
+				case IfStatement():
+					for i, (condition, case) in enumerate(stmt.cases):
+						# Only the first condition is always evaluated
+						self.number(condition, available, stmt, i == 0)
+						self.number_body(case, dict(available))
+					if stmt.else_case:
+						self.number_body(stmt.else_case, dict(available))
+				case CForLoop() | WhileLoop():
+					if isinstance(stmt, CForLoop):
+						self.number(stmt.start, available, stmt, True)
+					inside = dict(available)
+					self.kill(inside, assigned)
+					for expr in (stmt.end, stmt.step) if isinstance(stmt, CForLoop) else (stmt.condition,):
+						self.number(expr, inside, stmt, False)
+					self.number_body(stmt.body, inside)
+				case ArraySet():
+					self.number(stmt.index, available, stmt, True)
+					self.number(stmt.value, available, stmt, True)
+				case _:
+					self.number(stmt, available, stmt, True)
+			self.kill(available, assigned)
+
+	def number(self, node, available: dict, stmt, record: bool) -> None:
+		"""Finds the values an expression reuses, recording the ones it computes if it's always evaluated."""
+		candidate = self.candidate(node)
+		if candidate:
+			key = repr(expression_key(node))
+			if key in available:
+				available[key].uses.append(node)
+				return
+
+		if isinstance(node, BinaryOperation) and str(node.op.token_type) in ("LAND", "LOR"):
+			self.number(node.left, available, stmt, record)
+			self.number(node.right, available, stmt, False)
+		else:
+			for child in children(node):
+				self.number(child, available, stmt, record)
+
+		if candidate and record and not self.reads(node) & self.clobbered(stmt):
+			self.order += 1
+			available[key] = Value(node, self.reads(node), stmt, self.order)
+			self.values.append(available[key])
+
+	def candidate(self, node) -> bool:
+		"""Whether an expression is worth reusing and has the same value wherever what it reads doesn't change."""
+		if isinstance(node, (BinaryOperation, UnaryOperation)) and str(node.op.token_type) in CONDITIONS:
+			return False
+		return (
+			isinstance(node, (BinaryOperation, UnaryOperation, ArrayAccess, CallExpression))
+			and weight(node) >= self.THRESHOLD and self.effects.invariant(node, set())
+		)
+
+	def reads(self, node) -> set[str]:
+		"""Returns the variables and arrays an expression reads, including through the subroutines it calls."""
+		names = {child.symbol for child in walk(node) if isinstance(child, Identifier)}
+		calls = {child.sub_name.symbol for child in walk(node) if isinstance(child, CallExpression)}
+		return names.union(*(self.effects.reads[call] for call in calls if call in self.effects.reads))
+
+	def clobbered(self, stmt) -> set[str]:
+		"""Returns the variables and arrays the subroutines a statement calls may write."""
+		calls = {node.sub_name.symbol for node in walk(stmt) if isinstance(node, CallExpression)}
+		return set().union(*(self.effects.writes[call] for call in calls if call in self.effects.writes))
+
+	def kill(self, available: dict, written: set[str]) -> None:
+		for key in [key for key, value in available.items() if value.reads & written]:
+			del available[key]
+
+	def replace(self, node):
+		if id(node) in self.replaced:
+			return Identifier(self.replaced[id(node)], node.start_pos, node.end_pos)
+
+		transform(node, self.replace)
+		return node
+
+def eliminate_common_subexpressions(ast: Statements) -> Statements:
+	return CommonSubexpressions().eliminate(ast)
+
+if __name__ == "__main__":
+	# Usage: python xsharp_optimizer.py <file.xs>
+	# Reports the PROM and RAM used by a program before and after eliminating dead code.
+	from xsharp_lexer import Lexer
+	from xsharp_compiler import Compiler
+	from xasm_optimizer import optimize
+
+	with open(sys.argv[1], "r") as f:
+		ftxt = f.read()
+
+	for title, eliminate in (("Before", False), ("After", True)):
+		tokens, error = Lexer(sys.argv[1], ftxt).lex()
+		if error:
+			print(error)
+			break
+
+		ast = Parser(tokens).parse()
+		if ast.error:
+			print(ast.error)
+			break
+
+		if eliminate:
+			eliminate_dead_code(ast.node)
+
+		compiler = Compiler()
+		res = compiler.compile(ast.node)
+		if res.error:
+			print(res.error)
+			break
+
+		prom = sum(not line.strip().startswith(".") for line in optimize(res.value))
+		print(f"{title}: {prom} instructions, {compiler.ram_used} words of RAM")
@@ -361,7 +361,7 @@ class Parser:
 			))
 		self.advance()
 
-		start = res.register(self.comparison())
+		start = res.register(self.logical_or())
 		if res.error: return res
 
 		if self.current_token != Token(None, None, TT.NEWLINE, ";"):
@@ -386,7 +386,7 @@ class Parser:
 		end_op = self.current_token
 		self.advance()
 
-		end = res.register(self.comparison())
+		end = res.register(self.logical_or())
 		if res.error: return res
 
 		if self.current_token != Token(None, None, TT.NEWLINE, ";"):
@@ -417,7 +417,7 @@ class Parser:
 			))
 		self.advance()
 
-		step = res.register(self.comparison())
+		step = res.register(self.logical_or())
 		if res.error: return res
 
 		if self.current_token.token_type != TT.RPR:
@@ -621,7 +621,7 @@ class Parser:
 	def assignment(self):
 		res = ParseResult()
 		start_pos = self.current_token.start_pos
-		value = res.register(self.comparison())
+		value = res.register(self.logical_or())
 		if res.error: return res
 
 		if self.current_token.token_type == TT.ASSIGN: # Assignment -> var = value
@@ -656,6 +656,12 @@ class Parser:
 		
 		return res.success(left)
 
+	def logical_or(self):
+		return self.binary_op(self.logical_and, (TT.LOR,))
+
+	def logical_and(self):
+		return self.binary_op(self.comparison, (TT.LAND,))
+
 	def comparison(self):
 		return self.binary_op(self.bitwise, (TT.LT, TT.LE, TT.EQ, TT.NE, TT.GT, TT.GE))
 
@@ -666,7 +672,7 @@ class Parser:
 		return self.binary_op(self.multiplicative, (TT.ADD, TT.SUB))
 
 	def multiplicative(self):
-		return self.binary_op(self.unary, (TT.MUL, TT.DIV))
+		return self.binary_op(self.unary, (TT.MUL, TT.DIV, TT.MOD))
 
 	def unary(self):
 		res = ParseResult()
@@ -709,7 +715,7 @@ class Parser:
 				))
 
 			self.advance()
-			index = res.register(self.comparison())
+			index = res.register(self.logical_or())
 			if res.error: return res
 
 			if self.current_token.token_type != TT.RSQ:
@@ -722,7 +728,7 @@ class Parser:
 
 			if self.current_token.token_type == TT.ASSIGN:
 				self.advance()
-				expr = res.register(self.comparison())
+				expr = res.register(self.logical_or())
 				if res.error: return res
 
 				return res.success(ArraySet(literal, index, expr))
@@ -794,13 +800,13 @@ class Parser:
 			elements = []
 			
 			# First element
-			expr = res.register(self.comparison())
+			expr = res.register(self.logical_or())
 			if res.error: return res
 			elements.append(expr)
 
 			while self.current_token.token_type == TT.COMMA:
 				self.advance()
-				expr = res.register(self.comparison())
+				expr = res.register(self.logical_or())
 				if res.error: return res
 				elements.append(expr)
 			
@@ -0,0 +1,111 @@
+import hashlib
+import json
+
+# Profile-guided optimization. A build with profile_generate puts a probe label
+# before every statement, named after the statement's position in the source,
+# and a label holding the hash of the source. Labels take no PROM, so the
+# assembled program's label addresses are the label map: after a VM run,
+# record_profile() adds up how often the instruction at each probe ran. A build
+# with profile_use then reads those counts back, as long as the source hasn't
+# changed since.
+
+SOURCE_PREFIX = ".source_"
+PROBE_PREFIX = ".probe_"
+
+def source_hash(ftxt: str) -> str:
+	"""Hashes a program's text, included files and all."""
+	return hashlib.sha256(ftxt.encode()).hexdigest()[:16]
+
+def position_key(node) -> str | None:
+	"""Identifies a statement by where it starts in the source."""
+	position = getattr(node, "start_pos", None)
+	return None if position is None else f"{position.line}:{position.col}"
+
+class Profile:
+	"""How many times each statement of a program ran, by position_key()."""
+
+	def __init__(self, source: str, counts: dict[str, int]):
+		self.source = source
+		self.counts = counts
+
+	def count(self, node) -> int | None:
+		"""Returns how many times a statement ran, or None if the profile doesn't know."""
+		return self.counts.get(position_key(node))
+
+	def save(self, fn: str) -> None:
+		with open(fn, "w") as f:
+			json.dump({"source": self.source, "counts": self.counts}, f)
+
+	@staticmethod
+	def load(fn: str, ftxt: str) -> "Profile | None":
+		"""Reads a profile of a program, or returns None if it's missing, unreadable or was
+		recorded for a different version of the program."""
+		try:
+			with open(fn, "r") as f:
+				data = json.load(f)
+			source, counts = data["source"], {str(key): int(value) for key, value in data["counts"].items()}
+		except (OSError, ValueError, KeyError, TypeError, AttributeError):
+			return None
+
+		if source != source_hash(ftxt):
+			return None
+		return Profile(source, counts)
+
+def record_profile(assembly: str, executions: list[int]) -> Profile | None:
+	"""Turns how many times the VM ran each instruction of a profile_generate build into a profile.
+	Returns None if the assembly wasn't built with probes."""
+	# Imported here since the assembler imports the VM, which imports the compiler, which imports this
+	from xasm_assembler import IncrementalAssembler
+
+	labels = IncrementalAssembler(assembly).labels
+	sources = [label.removeprefix(SOURCE_PREFIX) for label in labels if label.startswith(SOURCE_PREFIX)]
+	if not sources:
+		return None
+
+	# Statements the optimizer adds, like the counter a loop is rewritten to count down with, take the
+	# position of the one they came from, so a position's count is the most its probes ran
+	counts: dict[str, int] = {}
+	for label, address in labels.items():
+		if not label.startswith(PROBE_PREFIX):
+			continue
+		line, col, _ = label.removeprefix(PROBE_PREFIX).split("_")
+		key = f"{line}:{col}"
+		counts[key] = max(counts.get(key, 0), executions[address] if address < len(executions) else 0)
+
+	return Profile(sources[0], counts)
+
+if __name__ == "__main__":
+	# Usage: python xsharp_profile.py <file.xs> [profile] [max steps]
+	# Builds a program with probes, runs it in the VM and saves how often each statement ran, by
+	# default next to the program with a .profile extension, where the shell looks for it.
+	import os, sys
+	os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # The VM only runs, it isn't shown
+	from PyQt6.QtWidgets import QApplication
+	from xsharp_shell import xs_compile
+	from xasm_assembler import assemble
+	from xenon_vm import VirtualMachine
+
+	with open(sys.argv[1], "r") as f:
+		ftxt = f.read().strip() # As the shell compiles it
+	fn = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(sys.argv[1])[0] + ".profile"
+	max_steps = int(sys.argv[3]) if len(sys.argv) > 3 else 1_000_000
+
+	result, error = xs_compile(sys.argv[1], ftxt, profile_generate=True)
+	if error:
+		print(error)
+		sys.exit(1)
+
+	assembly = "\n".join(result)
+	binary = assemble(assembly)
+	if isinstance(binary, Exception):
+		print(binary)
+		sys.exit(1)
+
+	app = QApplication([])
+	vm = VirtualMachine()
+	vm.clock_speed.setValue(0)
+	if vm.run("\n".join(binary), max_steps):
+		print(f"Stopped after {max_steps} steps, so later statements count as not running.")
+
+	record_profile(assembly, vm.executions).save(fn)
+	print(f"Saved the profile of {vm.steps} steps to {fn}")
@@ -6,10 +6,23 @@ from PyQt6 import uic
 from xsharp_lexer import Lexer, KEYWORDS, DATA_TYPES
 from xsharp_parser import Parser
 from xsharp_compiler import Compiler
+from xsharp_ir import compile_ir
+from xsharp_optimizer import fold_constants, eliminate_dead_code, hoist_loop_invariants, reduce_induction_variables, unroll_loops, inline_subroutines, eliminate_common_subexpressions
 from xasm_assembler import ASMSyntaxHighlighter
+from xasm_optimizer import optimize
+from xsharp_profile import Profile, source_hash
 from xsharp_helper import SyntaxHighlighter
 
-def xs_compile(fn: str, ftxt: str, remove_that_one_line: bool = False):
+# Optimization levels: 0 compiles the program as written, 1 runs every optimization pass,
+# 2 also calls shared runtime routines instead of inlining them, doesn't unroll loops and only inlines
+# subroutines where that saves PROM, for smaller but slower code
+# profile_generate labels every statement so that record_profile() can count them after a VM run,
+# without inlining or unrolling that would copy them; profile_use is the file such a profile was
+# saved to, which is ignored if it's missing or the program changed since
+def xs_compile(
+	fn: str, ftxt: str, remove_that_one_line: bool = False, use_ir: bool = False, opt_level: int = 1,
+	profile_generate: bool = False, profile_use: str | None = None
+):
 	lexer = Lexer(fn, ftxt)
 	tokens, error = lexer.lex()
 	if error: return None, error
@@ -18,9 +31,27 @@ def xs_compile(fn: str, ftxt: str, remove_that_one_line: bool = False):
 	ast = parser.parse()
 	if ast.error: return None, ast.error
 
-	compiler = Compiler()
-	res = compiler.compile(ast.node, remove_that_one_line)
-	return res.value, res.error
+	profile = Profile.load(profile_use, lexer.ftxt) if profile_use else None
+
+	if opt_level >= 1:
+		fold_constants(ast.node)
+		if not profile_generate:
+			inline_subroutines(ast.node, opt_level == 1, profile)
+		eliminate_dead_code(ast.node)
+		if opt_level == 1 and not profile_generate:
+			unroll_loops(ast.node, profile)
+		hoist_loop_invariants(ast.node)
+		reduce_induction_variables(ast.node)
+		eliminate_common_subexpressions(ast.node)
+
+	if use_ir and not profile_generate:
+		res = compile_ir(ast.node, opt_level >= 2)
+	else:
+		compiler = Compiler(opt_level >= 2, source_hash(lexer.ftxt) if profile_generate else None, profile)
+		res = compiler.compile(ast.node, remove_that_one_line)
+	if res.error: return None, res.error
+
+	return optimize(res.value, keep_labels=profile_generate) if opt_level >= 1 else res.value, None
 
 class XSharpSyntaxHighlighter(SyntaxHighlighter):
 	def __init__(self, document):
@@ -193,7 +224,7 @@ class XSharpShell(QMainWindow):
 			
 			if "include operations" in result:
 				self.xsharp_text_highlighter.highlighting_rules[7] = (QRegularExpression(
-					r"(\+|-|\*|/|&|\||~|\^|=|:|#|\$)"
+					r"(\+|-|\*|/|%|&|\||~|\^|=|:|#|\$)"
 				), getattr(self.xsharp_text_highlighter, "operation_format"))
 			else:
 				self.xsharp_text_highlighter.highlighting_rules[7] = (QRegularExpression(
@@ -320,7 +351,9 @@ class XSharpShell(QMainWindow):
 		self.error.setText("")
 		self.result.setText("")
 		
-		result, error = xs_compile("<shell>", self.file_text.toPlainText().strip())
+		# A profile saved by running `python xsharp_profile.py programs/<file name>`, if there is one
+		profile = f"programs/{self.file_name.text().replace('.xs', '.profile')}" if self.file_name.text() else None
+		result, error = xs_compile("<shell>", self.file_text.toPlainText().strip(), profile_use=profile)
 		if error:
 			self.error.setText(f"{error}")
 		else: